@@ -0,0 +1,175 @@
+""" Caches of sightline quantities
+"""
+import warnings
+from collections import OrderedDict
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    from scipy.integrate import cumulative_trapezoid
+except ImportError:  # SciPy < 1.6
+    from scipy.integrate import cumtrapz as cumulative_trapezoid
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'extensions',
+                                     'evictions', 'maxsize', 'currsize',
+                                     'nbytes'])
+
+
+class DMProfileCache(object):
+    """
+    LRU cache of cumulative DM(d) profiles, one per direction.
+
+    Directions are quantized to `angle_tol` deg and the profiles are
+    sampled every `step_size` kpc from the Sun. A profile is extended
+    (doubling its range, up to `dmax`) when a query goes past its end.
+    The least recently used profiles are evicted beyond `maxsize`
+    directions or `max_samples` samples in total.
+    """
+
+    def __init__(self, density, maxsize=128, angle_tol=0.01,
+                 step_size=0.001, dmax=100., max_samples=2**23):
+        """
+        Arguments:
+        - `density`: NEobject used to build the profiles
+        - `maxsize`: Maximal number of cached directions
+        - `max_samples`: Maximal total number of cached samples (8 bytes
+                         each); the last profile is kept even if longer
+        - `angle_tol`: Angular quantization of the directions (deg)
+        - `step_size`: Sampling step of the profiles (kpc)
+        - `dmax`: Maximal extent of the profiles (kpc)
+        """
+        self._density = density
+        self.maxsize = maxsize
+        self.angle_tol = angle_tol
+        self.step_size = step_size
+        self.dmax = dmax
+        self.max_samples = max_samples
+        self._profiles = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        "Remove all the profiles and reset the statistics"
+        self._profiles.clear()
+        self._nsamples = 0
+        self.hits = 0
+        self.misses = 0
+        self.extensions = 0
+        self.evictions = 0
+
+    def info(self):
+        "Cache statistics"
+        return CacheInfo(self.hits, self.misses, self.extensions,
+                         self.evictions, self.maxsize, len(self._profiles),
+                         sum(dm.nbytes for dm in self._profiles.values()))
+
+    def key(self, l, b):
+        """
+        Quantized direction: a tuple for scalar `l`, `b`, else an integer
+        array of shape (..., 2)
+        """
+        l = np.rint(np.mod(l, 360)/self.angle_tol)
+        b = np.rint(np.divide(b, self.angle_tol))
+        key = np.stack(np.broadcast_arrays(l, b), axis=-1).astype(np.int64)
+        if key.ndim == 1:
+            return tuple(int(val) for val in key)
+        return key
+
+    def _directions(self, l, b, values):
+        """
+        Group the broadcast `l`, `b`, `values` by quantized direction
+
+        Returns the broadcast shape and yields, for each direction, the
+        flat indices of its elements, a representative `l`, `b`, and its
+        values.
+        """
+        l, b, values = [np.ravel(val) for val in
+                        np.broadcast_arrays(l, b, values)]
+        keys, first, inverse = np.unique(self.key(l, b), axis=0,
+                                         return_index=True,
+                                         return_inverse=True)
+        inverse = inverse.ravel()
+        for i, j in enumerate(first):
+            rows = np.flatnonzero(inverse == i)
+            yield rows, l[j], b[j], values[rows]
+
+    def profile(self, l, b, dist=0, DM=None):
+        """
+        Cumulative DM profile towards `l`, `b` extending at least to
+        `dist` and, if given, to `DM` (but not beyond `dmax`)
+
+        Returns
+        -------
+        d : ndarray
+          Distances (kpc)
+        dm : ndarray
+          Cumulative DM (pc cm**-3)
+        """
+        key = self.key(l, b)
+        nmax = int(np.ceil(self.dmax/self.step_size))
+        nmin = min(int(np.ceil(dist/self.step_size)), nmax)
+        try:
+            dm = self._profiles.pop(key)
+            self._nsamples -= dm.size
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            dm = np.zeros(1)
+        size = dm.size
+        while (dm.size - 1 < nmin or
+               (DM is not None and dm[-1] < DM and dm.size - 1 < nmax)):
+            dm = self._extend(key, dm, min(max(2*(dm.size - 1), nmin, 1000),
+                                           nmax))
+        if 1 < size < dm.size:
+            self.extensions += 1
+        self._profiles[key] = dm
+        self._nsamples += dm.size
+        while len(self._profiles) > 1 and (
+                len(self._profiles) > self.maxsize or
+                self._nsamples > self.max_samples):
+            self._nsamples -= self._profiles.popitem(last=False)[1].size
+            self.evictions += 1
+        return np.arange(dm.size)*self.step_size, dm
+
+    def _extend(self, key, dm, nsamp):
+        "Extend the profile `dm` to `nsamp` steps"
+        d_samp = np.arange(dm.size - 1, nsamp + 1)*self.step_size
+        l, b = np.array(key)*self.angle_tol
+        ne_samp = self._density._ne_sightlines(np.array([l]), np.array([b]),
+                                               d_samp[None, :])[0]
+        return np.append(dm, dm[-1] +
+                         cumulative_trapezoid(ne_samp,
+                                              dx=self.step_size)*1000)
+
+    def DM(self, l, b, d):
+        """
+        Dispersion measures (pc cm**-3) towards `l`, `b` to distances `d`
+        (broadcast); NaN, with a warning, beyond `dmax`
+        """
+        shape = np.broadcast(l, b, d).shape
+        DM = np.empty(int(np.prod(shape)))
+        for rows, l_i, b_i, d_i in self._directions(l, b, d):
+            d_samp, dm_samp = self.profile(l_i, b_i, dist=np.max(d_i))
+            DM[rows] = np.interp(d_i, d_samp, dm_samp)
+            DM[rows[d_i > self.dmax]] = np.nan
+        if np.any(np.isnan(DM)):
+            warnings.warn("Distances beyond the cached profiles ({} kpc): "
+                          "DM set to NaN".format(self.dmax))
+        return DM.reshape(shape)
+
+    def dist(self, l, b, DM):
+        """
+        Distances (kpc) to dispersion measures `DM` towards `l`, `b`
+        (broadcast); `dmax`, with a warning, where `DM` exceeds the profile
+        """
+        shape = np.broadcast(l, b, DM).shape
+        dist = np.empty(int(np.prod(shape)))
+        beyond = False
+        for rows, l_i, b_i, DM_i in self._directions(l, b, DM):
+            d_samp, dm_samp = self.profile(l_i, b_i, DM=np.max(DM_i))
+            dist[rows] = np.interp(DM_i, dm_samp, d_samp)
+            beyond |= np.any(DM_i > dm_samp[-1])
+        if beyond:
+            warnings.warn("DM exceeds the DM out to {} kpc: distance set to "
+                          "{} kpc".format(self.dmax, self.dmax))
+        return dist.reshape(shape)
@@ -0,0 +1,196 @@
+""" Streaming catalog input and output
+
+Catalogs are read and written in chunks of rows so that the memory use does
+not depend on their size. The text formats (CSV, TSV, without quoting) may
+start with a header line of column names; their columns are passed through
+to the output, followed by the results. The `.npy` files hold 2d float
+arrays; their header is read (and written) first, so they can be streamed
+from and to pipes.
+"""
+import io
+import itertools
+
+import numpy as np
+
+FORMATS = ('csv', 'tsv', 'npy')
+
+DELIMITERS = {'csv': ',', 'tsv': '\t'}
+
+NPY_HEADERS = {(1, 0): np.lib.format.read_array_header_1_0,
+               (2, 0): np.lib.format.read_array_header_2_0}
+
+
+def guess_format(name, default='csv'):
+    "Format of the file `name` from its extension (`default` if unknown)"
+    ext = str(name).rsplit('.', 1)[-1].lower()
+    return ext if ext in FORMATS else default
+
+
+def _is_number(field):
+    try:
+        float(field)
+    except ValueError:
+        return False
+    return True
+
+
+class CatalogReader(object):
+    """
+    Read a catalog in chunks
+
+    `names` holds the column names (None for text files without header and
+    for `.npy` files) and `nrows` the number of rows if known in advance
+    (`.npy` files only). Iterating yields `(fields, values)` per chunk:
+    the columns of each row (None for `.npy` files) and the float array
+    of the columns selected by `select`.
+    """
+
+    def __init__(self, fh, fmt='csv', chunk_size=65536):
+        """
+        Arguments:
+        - `fh`: Binary file object
+        - `fmt`: Format ('csv', 'tsv' or 'npy')
+        - `chunk_size`: Number of rows per chunk
+        """
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.names = None
+        self.nrows = None
+        self.usecols = None
+        if fmt == 'npy':
+            self._fh = fh
+            version = np.lib.format.read_magic(fh)
+            if version not in NPY_HEADERS:
+                raise ValueError("Unsupported .npy version {}".format(
+                    version))
+            shape, fortran_order, self.dtype = NPY_HEADERS[version](fh)
+            if len(shape) != 2 or fortran_order or self.dtype.names:
+                raise ValueError("The .npy input must be a C-ordered 2d "
+                                 "array")
+            self.nrows, self.ncols = shape
+        else:
+            self._fh = io.TextIOWrapper(fh, newline='')
+            self.delimiter = DELIMITERS[fmt]
+            first = self._fh.readline()
+            fields = self._split(first)
+            self.ncols = len(fields)
+            if all(_is_number(field) for field in fields):
+                self._first = [first]
+            else:
+                self.names = fields
+                self._first = []
+
+    def _split(self, line):
+        return [field.strip() for field in
+                line.rstrip('\r\n').split(self.delimiter)]
+
+    def select(self, columns, default):
+        """ Select the columns to read
+
+        Arguments:
+        - `columns`: Names or 0-based indices of the columns; if None,
+                     the columns named `default` if there is a header with
+                     these names, the first columns otherwise
+        - `default`: Default column names
+
+        Returns the column indices.
+        """
+        if columns is None:
+            if self.names is not None and set(default) <= set(self.names):
+                columns = default
+            else:
+                columns = range(len(default))
+        index = []
+        for column in columns:
+            column = str(column)
+            if self.names is not None and column in self.names:
+                index.append(self.names.index(column))
+            elif column.isdigit():
+                index.append(int(column))
+            else:
+                raise ValueError("Unknown column {}".format(column))
+        if len(index) != len(default) or max(index) >= self.ncols:
+            raise ValueError("Expected {} columns out of {}".format(
+                len(default), self.ncols))
+        self.usecols = index
+        return index
+
+    def __iter__(self):
+        if self.fmt == 'npy':
+            row_bytes = self.dtype.itemsize*self.ncols
+            for i0 in range(0, self.nrows, self.chunk_size):
+                nrows = min(self.chunk_size, self.nrows - i0)
+                data = self._fh.read(nrows*row_bytes)
+                if len(data) != nrows*row_bytes:
+                    raise ValueError("Truncated .npy input")
+                rows = np.frombuffer(data, dtype=self.dtype).reshape(
+                    nrows, self.ncols)
+                yield None, rows[:, self.usecols].astype(float)
+        else:
+            lines = itertools.chain(self._first, self._fh)
+            while True:
+                fields = [self._split(line) for line in
+                          itertools.islice(lines, self.chunk_size)
+                          if line.strip()]
+                if not fields:
+                    break
+                yield fields, np.array([[row[i] for i in self.usecols]
+                                        for row in fields], dtype=float)
+
+
+class CatalogWriter(object):
+    """
+    Write a catalog in chunks
+    """
+
+    def __init__(self, fh, fmt='csv', names=None, nrows=None,
+                 float_format='%.10g'):
+        """
+        Arguments:
+        - `fh`: Binary file object
+        - `fmt`: Format ('csv', 'tsv' or 'npy')
+        - `names`: Column names, written as a header of the text formats
+        - `nrows`: Total number of rows, required for `.npy` files
+        - `float_format`: Format of the numbers in text files
+        """
+        self.fmt = fmt
+        self.float_format = float_format
+        if fmt == 'npy':
+            if nrows is None or names is None:
+                raise ValueError("The number of rows of a .npy output must "
+                                 "be known in advance (use a .npy input)")
+            self._fh = fh
+            np.lib.format.write_array_header_1_0(
+                fh, dict(descr=np.lib.format.dtype_to_descr(np.dtype(float)),
+                         fortran_order=False, shape=(nrows, len(names))))
+        else:
+            self._fh = io.TextIOWrapper(fh, newline='')
+            self.delimiter = DELIMITERS[fmt]
+            if names is not None:
+                self._fh.write(self.delimiter.join(names) + '\n')
+
+    def write(self, fields, values, results):
+        """ Write a chunk of rows
+
+        Arguments:
+        - `fields`: Columns of the input rows (None to write `values`)
+        - `values`: Selected input columns (2d array)
+        - `results`: Results (2d array)
+        """
+        if self.fmt == 'npy':
+            self._fh.write(np.ascontiguousarray(
+                np.column_stack([values, results]), dtype=float).tobytes())
+            return
+        results = [[self.float_format % val for val in row]
+                   for row in results]
+        if fields is None:
+            fields = [[self.float_format % val for val in row]
+                      for row in values]
+        self._fh.write(''.join(self.delimiter.join(row + res) + '\n'
+                               for row, res in zip(fields, results)))
+
+    def close(self):
+        "Flush the output (the file object is left open)"
+        self._fh.flush()
+        if self.fmt != 'npy':
+            self._fh.detach()
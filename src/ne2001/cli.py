@@ -14,10 +14,221 @@ Why does this file exist, and why not put this in __main__?
 
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
 """
+from contextlib import ExitStack
+from inspect import signature
+
 import click
+import numpy as np
+
+from .catalog import FORMATS
+from .catalog import CatalogReader
+from .catalog import CatalogWriter
+from .catalog import guess_format
+from .density import ElectronDensity
+from .integrators import INTEGRATORS
+from .integrators import get_integrator
+
+# Former names of the integrators of the dm command
+ALIASES = {'trapz': 'trapezoid', 'simps': 'simpson'}
+
+
+@click.group()
+def main():
+    "NE2001 Galactic free electron density model"
+
+
+@main.command()
+@click.option('--socket', 'path', type=click.Path(),
+              help='Unix socket path (default: a localhost TCP port)')
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help='TCP host')
+@click.option('--port', default=0, show_default=True,
+              help='TCP port (0 for any free port)')
+@click.option('--window', default=2., show_default=True,
+              help='Time window (ms) in which requests are merged')
+@click.option('--max-batch', default=4096, show_default=True,
+              help='Maximal number of requests merged')
+@click.option('--max-samples', default=10**7, show_default=True,
+              help='Maximal number of density evaluations per request')
+@click.option('--backend', type=click.Choice(['numpy', 'numba']),
+              default='numpy', show_default=True,
+              help='Density evaluation backend')
+def serve(path, host, port, window, max_batch, max_samples, backend):
+    """Serve the model to JSON line requests (DM, dist, ne, reload,
+    metrics, ping)"""
+    from .server import serve as run_server
+
+    def ready(address):
+        click.echo('Serving NE2001 on {}'.format(address), err=True)
+
+    run_server(path=path, host=host, port=port, ready=ready,
+               window=window/1000, max_batch=max_batch,
+               max_samples=max_samples, backend=backend)
+
+
+def catalog_options(func):
+    "Options of the commands reading and writing catalogs"
+    options = [
+        click.argument('input', type=click.File('rb'), default='-'),
+        click.option('-o', '--output', type=click.File('wb'), default='-',
+                     help='Output file (default: stdout)'),
+        click.option('--format', 'in_format', type=click.Choice(FORMATS),
+                     help='Input format (default: from the file extension, '
+                     'csv for stdin)'),
+        click.option('--output-format', type=click.Choice(FORMATS),
+                     help='Output format (default: from the file extension, '
+                     'the input format for stdout)'),
+        click.option('--columns',
+                     help='Comma separated names or 0-based indices of the '
+                     'input columns'),
+        click.option('--chunk-size', default=65536, show_default=True,
+                     help='Number of rows evaluated at once'),
+        click.option('--workers', default=1, show_default=True,
+                     help='Number of worker processes (threads for ne)'),
+        click.option('--backend', type=click.Choice(['numpy', 'numba']),
+                     default='numpy', show_default=True,
+                     help='Density evaluation backend'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def run_catalog(input, output, in_format, output_format, columns,
+                chunk_size, default_columns, result_names, evaluate):
+    """ Stream a catalog through `evaluate`
+
+    Arguments:
+    - `default_columns`: Default names of the input columns
+    - `result_names`: Names of the result columns
+    - `evaluate`: Function of the input columns (1d arrays) returning the
+                  result columns (a 2d array)
+    """
+    in_format = in_format or guess_format(getattr(input, 'name', '-'))
+    output_format = output_format or guess_format(
+        getattr(output, 'name', '-'), in_format)
+    try:
+        reader = CatalogReader(input, in_format, chunk_size)
+        reader.select(None if columns is None else columns.split(','),
+                      default_columns)
+        if reader.names is not None:
+            names = reader.names + result_names
+        elif in_format == 'npy':
+            names = default_columns + result_names
+        else:
+            names = None
+        writer = CatalogWriter(output, output_format, names, reader.nrows)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+    for fields, values in reader:
+        writer.write(fields, values, evaluate(*values.T))
+    writer.close()
+
+
+def _DM_quad(model, l, b, d, epsrel, epsabs):
+    "Dispersion measures integrated with quad (one sightline at a time)"
+    return np.array([model.DM(li, bi, di, epsrel=epsrel,
+                              epsabs=epsabs).value
+                     for li, bi, di in zip(l, b, d)])
+
+
+def _DM_integrate(model, l, b, d, integrator, **options):
+    "Dispersion measures with an integrator of `ne2001.integrators`"
+    return model.DM_integrate(l, b, d, integrator, quantity=False,
+                              **options)[0]
+
+
+@main.command()
+@catalog_options
+@click.option('--integrator',
+              type=click.Choice(sorted(set(INTEGRATORS) | set(ALIASES))),
+              default='trapz', show_default=True,
+              help='Integrator of ne2001.integrators (quad integrates one '
+              'sightline at a time)')
+@click.option('--step-size', default=0.001, show_default=True,
+              help='Maximal sampling step (kpc)')
+@click.option('--nsamp', type=int,
+              help='Minimal number of steps per sightline of trapezoid and '
+              'simpson (default: 1000)')
+@click.option('--epsrel', default=1e-4, show_default=True,
+              help='Relative tolerance of the adaptive integrators')
+@click.option('--epsabs', default=1e-6, show_default=True,
+              help='Absolute tolerance of the adaptive integrators')
+def dm(input, output, in_format, output_format, columns, chunk_size,
+       workers, backend, integrator, step_size, nsamp, epsrel, epsabs):
+    """Dispersion measures (pc cm^-3) of a catalog of l (deg), b (deg),
+    d (kpc)"""
+    model = ElectronDensity.get(backend=backend)
+    if integrator == 'quad':
+        func, kwargs = _DM_quad, dict(epsrel=epsrel, epsabs=epsabs)
+    else:
+        integrator = ALIASES.get(integrator, integrator)
+        func = _DM_integrate
+        kwargs = dict(integrator=integrator, step_size=step_size,
+                      epsrel=epsrel, epsabs=epsabs)
+        if nsamp is not None:
+            if 'nsamp' not in signature(get_integrator(integrator)).parameters:
+                raise click.BadOptionUsage(
+                    'nsamp', '--nsamp does not apply to the {} '
+                    'integrator'.format(integrator))
+            kwargs['nsamp'] = nsamp
+    with ExitStack() as stack:
+        if workers > 1:
+            from .parallel import ModelPool
+            pool = stack.enter_context(ModelPool(model, workers))
+
+        def evaluate(l, b, d):
+            if workers > 1:
+                return pool.map(func, d, l, b, d, **kwargs)[:, None]
+            return func(model, l, b, d, **kwargs)[:, None]
+
+        run_catalog(input, output, in_format, output_format, columns,
+                    chunk_size, ['l', 'b', 'd'], ['DM'], evaluate)
+
+
+@main.command()
+@catalog_options
+@click.option('--step-size', default=0.001, show_default=True,
+              help='Maximal sampling step (kpc)')
+@click.option('--nsamp', type=int,
+              help='Number of samples per segment (default: from '
+              '--step-size)')
+@click.option('--dmax', default=100., show_default=True,
+              help='Maximal distance (kpc)')
+def dist(input, output, in_format, output_format, columns, chunk_size,
+         workers, backend, step_size, nsamp, dmax):
+    """Distances (kpc) of a catalog of l (deg), b (deg), DM (pc cm^-3);
+    beyond is 1 where DM exceeds the DM out to dmax"""
+    model = ElectronDensity.get(backend=backend)
+    kwargs = dict(step_size=step_size, nsamp=nsamp, dmax=dmax)
+    with ExitStack() as stack:
+        if workers > 1:
+            from .parallel import ModelPool
+            from .parallel import dist_many
+            pool = stack.enter_context(ModelPool(model, workers))
+
+        def evaluate(l, b, DM):
+            if workers > 1:
+                return np.column_stack(pool.map(dist_many, DM, l, b, DM,
+                                                **kwargs))
+            return np.column_stack(model.dist_many(l, b, DM, quantity=False,
+                                                   **kwargs))
+
+        run_catalog(input, output, in_format, output_format, columns,
+                    chunk_size, ['l', 'b', 'DM'], ['dist', 'beyond'],
+                    evaluate)
+
+
+@main.command()
+@catalog_options
+def ne(input, output, in_format, output_format, columns, chunk_size,
+       workers, backend):
+    """Electron densities (cm^-3) of a catalog of Galactocentric x, y, z
+    (kpc)"""
+    model = ElectronDensity.get(backend=backend)
 
+    def evaluate(x, y, z):
+        return model.ne_many(np.array([x, y, z]), workers=workers)[:, None]
 
-@click.command()
-@click.argument('names', nargs=-1)
-def main(names):
-    click.echo(repr(names))
+    run_catalog(input, output, in_format, output_format, columns,
+                chunk_size, ['x', 'y', 'z'], ['ne'], evaluate)
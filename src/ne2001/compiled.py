@@ -0,0 +1,308 @@
+""" Compiled electron density models
+
+`compile_density` flattens a tree of `OR` and `Add` nodes (OR and Add are
+associative), drops the components with a zero amplitude and replaces the
+analytic components by elementwise expressions in which the amplitudes and
+the parameter-derived scalars are folded into constants. The expressions
+are evaluated with numexpr if it is installed, and with numpy otherwise.
+The other components (spiral arms, clumps, voids...) are called as they
+are. The constants depend on the position of the Sun at compile time.
+
+The compiled model matches the tree to rounding only (relative differences
+of about 1e-15), not bit for bit: the folded constants and the flattened
+sums change the order of the floating point operations. The nodes evaluate
+the masked points in scratch buffers which they keep (one per thread) and
+reuse across calls.
+"""
+import threading
+from abc import ABC
+from abc import abstractmethod
+
+import numpy as np
+
+from . import density
+from .density import NEobject
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# Namespace evaluating the expressions with numpy
+NUMPY_FUNCTIONS = dict(where=np.where, cos=np.cos, cosh=np.cosh, exp=np.exp,
+                       sqrt=np.sqrt, abs=np.abs, __builtins__={})
+
+
+def thick_disk_expression(radius, height):
+    "Expression and constants of `density.thick_disk`"
+    return ('where(x**2 + y**2 < R2, '
+            'A*cos(sqrt(x**2 + y**2)*k)/cosh(z*ih)**2, 0)',
+            dict(R2=radius**2, k=np.pi/2/radius, ih=1/height,
+                 A=1/np.cos(density.RSUN*np.pi/2/radius)))
+
+
+def thin_disk_expression(radius, height):
+    "Expression and constants of `density.thin_disk`"
+    return ('where((abs(R - sqrt(x**2 + y**2)) <= 20) & (abs(z) <= 40), '
+            'A*exp(-(R - sqrt(x**2 + y**2))**2*c)/cosh(z*ih)**2, 0)',
+            dict(R=radius, c=1/1.8**2, ih=1/height, A=1.))
+
+
+def gc_expression(center, radius, height):
+    "Expression and constants of `density.gc`"
+    return ('where(((x - cx)**2 + (y - cy)**2)*iR2 + ((z - cz)*ih)**2 < 1, '
+            'A, 0)',
+            dict(cx=center[0], cy=center[1], cz=center[2],
+                 iR2=1/radius**2, ih=1/height, A=1.))
+
+
+def in_ellipsoid_expression(center, ellipsoid, theta):
+    "Expression and constants of `density.in_ellipsoid`"
+    m = density.Ellipsoid(center, ellipsoid, theta).transform
+    constants = dict(('m{}{}'.format(i, j), m[i, j])
+                     for i in range(3) for j in range(3))
+    constants.update(('b{}'.format(i), val)
+                     for i, val in enumerate(m.dot(center)))
+    constants['A'] = 1.
+    return ('where((m00*x + m01*y + m02*z - b0)**2 + '
+            '(m10*x + m11*y + m12*z - b1)**2 + '
+            '(m20*x + m21*y + m22*z - b2)**2 <= 1, A, 0)', constants)
+
+
+def in_cylinder_expression(center, cylinder, theta):
+    "Expression and constants of `density.in_cylinder`"
+    return ('where((((x - cx)/where((z <= 0) & (z >= zc), '
+            'a0 + a1*(1 - z/zc), c0))**2 + '
+            '((y - cy - t*z)*ic1)**2 <= 1) & (((z - cz)*ic2)**2 <= 1), A, 0)',
+            dict(cx=center[0], cy=center[1], cz=center[2],
+                 zc=center[2] - cylinder[2], a0=0.001, a1=cylinder[0] - 0.001,
+                 c0=cylinder[0], ic1=1/cylinder[1], ic2=1/cylinder[2],
+                 t=np.tan(theta), A=1.))
+
+
+def in_half_sphere_expression(center, radius):
+    "Expression and constants of `density.in_half_sphere`"
+    return ('where(((x - cx)**2 + (y - cy)**2 + (z - cz)**2 <= r2) & '
+            '(z >= 0), A, 0)',
+            dict(cx=center[0], cy=center[1], cz=center[2], r2=radius**2,
+                 A=1.))
+
+
+# Elementwise expressions of the density functions (with unit amplitude A)
+EXPRESSIONS = {density.thick_disk: thick_disk_expression,
+               density.thin_disk: thin_disk_expression,
+               density.gc: gc_expression,
+               density.in_ellipsoid: in_ellipsoid_expression,
+               density.in_cylinder: in_cylinder_expression,
+               density.in_half_sphere: in_half_sphere_expression}
+
+
+class Node(ABC):
+    """
+    Node of a compiled model
+
+    `add_at` adds the density of the node to `out` at the points
+    selected by `mask` that are within the bounds of the node; the
+    subclasses implement `_add`.
+    """
+    box = None
+
+    def _scratch(self, n):
+        "Zeroed buffer of `n` values, reused across the calls of a thread"
+        local = self.__dict__.setdefault('_local', threading.local())
+        buffer = getattr(local, 'buffer', None)
+        if buffer is None or buffer.size < n:
+            buffer = local.buffer = np.empty(n)
+        buffer = buffer[:n]
+        buffer[...] = 0
+        return buffer
+
+    def add_at(self, xyz, mask, out):
+        """
+        Arguments:
+        - `xyz`: Locations (3, n)
+        - `mask`: Boolean mask of the points to evaluate (None for all)
+        - `out`: Array (n) to which the density is added
+        """
+        if self.box is not None:
+            inside = np.ones(out.shape, dtype=bool) if mask is None else mask
+            for axis, (lo, hi) in enumerate(zip(*self.box)):
+                if np.isfinite(lo):
+                    inside = inside & (xyz[axis] >= lo)
+                if np.isfinite(hi):
+                    inside = inside & (xyz[axis] <= hi)
+            mask = inside
+        if mask is None:
+            return self._add(xyz, out)
+        index = np.flatnonzero(mask)
+        if index.size == out.size:
+            return self._add(xyz, out)
+        if index.size:
+            ne = self._scratch(index.size)
+            self._add(xyz[:, index], ne)
+            out[index] += ne
+
+    @abstractmethod
+    def _add(self, xyz, out):
+        "Add the density at all the points `xyz` to `out`"
+
+
+class Expression(Node):
+    """
+    Component evaluated as an elementwise expression
+    """
+
+    def __init__(self, expression, constants, box=None, use_numexpr=True):
+        self.expression = expression
+        self.constants = constants
+        self.box = box
+        self.use_numexpr = use_numexpr and numexpr is not None
+
+    def _add(self, xyz, out):
+        variables = dict(self.constants, x=xyz[0], y=xyz[1], z=xyz[2],
+                         out=out)
+        if self.use_numexpr:
+            numexpr.evaluate('out + ' + self.expression,
+                             local_dict=variables, out=out)
+        else:
+            out += eval(self.expression, NUMPY_FUNCTIONS, variables)
+
+
+class Call(Node):
+    """
+    Component evaluated by its own `ne` method
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.box = obj.box
+
+    def _add(self, xyz, out):
+        out += self.obj.ne(xyz)
+
+
+class Sum(Node):
+    "Sum of nodes"
+
+    def __init__(self, children):
+        self.children = children
+
+    def add_at(self, xyz, mask, out):
+        for child in self.children:
+            child.add_at(xyz, mask, out)
+
+    def _add(self, xyz, out):
+        self.add_at(xyz, None, out)
+
+
+class First(Node):
+    "Density of the first node which is > 0 (a chain of OR)"
+
+    def __init__(self, children):
+        self.children = children
+
+    def add_at(self, xyz, mask, out):
+        ne = self._scratch(out.size)
+        pending = mask
+        for child in self.children:
+            child.add_at(xyz, pending, ne)
+            pending = ne <= 0 if pending is None else pending & (ne <= 0)
+            if not pending.any():
+                break
+        out += ne
+
+    def _add(self, xyz, out):
+        self.add_at(xyz, None, out)
+
+
+def compile_node(obj, use_numexpr=True):
+    """
+    Compiled node of the NEobject `obj`; None if its density vanishes
+    """
+    if isinstance(obj, density.ElectronDensity):
+        return compile_node(obj._combined, use_numexpr)
+    if isinstance(obj, density.LocalISM):
+        return compile_node(obj._lism, use_numexpr)
+    if isinstance(obj, (density.OR, density.Add)):
+        kind = First if isinstance(obj, density.OR) else Sum
+        children = []
+        for child in (obj._object1, obj._object2):
+            node = compile_node(child, use_numexpr)
+            if isinstance(node, kind):
+                children.extend(node.children)
+            elif node is not None:
+                children.append(node)
+        if len(children) < 2:
+            return children[0] if children else None
+        return kind(children)
+    if isinstance(obj, density.NEobjects):
+        return Call(obj) if np.any(obj.ne0) else None
+
+    amplitude = getattr(obj, '_ne0', 1)
+    if amplitude == 0:
+        return None
+    try:
+        expression = EXPRESSIONS[obj._density_func]
+    except (AttributeError, KeyError):
+        return Call(obj)
+    expression, constants = expression(**obj._params)
+    constants['A'] *= amplitude
+    return Expression(expression, constants, obj.box, use_numexpr)
+
+
+class CompiledDensity(NEobject):
+    """
+    Compiled electron density model (see `compile_density`)
+    """
+
+    def __init__(self, root, fingerprint=None):
+        """
+        Arguments:
+        - `root`: Root node of the compiled model (None for a zero density)
+        - `fingerprint`: Fingerprint of the compiled model
+        """
+        self.root = root
+        self.fingerprint = fingerprint
+
+    def ne(self, xyz, out=None):
+        """
+        Electron density at the location `xyz`; written into `out`
+        (an array of the shape of `xyz[0]`) if given
+        """
+        self._count(np.size(xyz) // 3)
+        return self.electron_density(xyz, out)
+
+    def electron_density(self, xyz, out=None):
+        xyz = np.asarray(xyz, dtype=float)
+        if xyz.ndim == 1:
+            return self.electron_density(xyz[:, None])[0]
+        if out is None:
+            out = np.zeros(xyz.shape[1:])
+        else:
+            out[...] = 0
+        if self.root is not None:
+            flat = out.reshape(-1)
+            self.root.add_at(xyz.reshape(3, -1), None, flat)
+            if not np.shares_memory(flat, out):
+                out[...] = flat.reshape(out.shape)
+        return out
+
+
+def compile_density(obj, use_numexpr=None):
+    """ Compile the NEobject `obj` into a single evaluator
+
+    Parameters
+    ----------
+    obj : NEobject
+    use_numexpr : bool, optional
+      Evaluate the expressions with numexpr; by default if it is installed
+
+    Returns
+    -------
+    compiled : CompiledDensity
+
+    """
+    if use_numexpr is None:
+        use_numexpr = numexpr is not None
+    return CompiledDensity(compile_node(obj, use_numexpr),
+                           getattr(obj, 'fingerprint', None))
@@ -0,0 +1,360 @@
+""" Precomputed all-sky cumulative DM cube
+
+The cube holds the cumulative DM on an equal-area HEALPix (RING ordering)
+pixelization of the sky times a logarithmic distance grid. It is written as
+a `.npy` file with a `.json` sidecar holding the metadata, and is queried
+through a read-only memory map so that several processes share its pages.
+The DM is interpolated bilinearly between the pixel centers.
+"""
+import json
+import os
+
+import numpy as np
+
+from .density import DM_unit
+from .density import d_unit
+from .utils import interp_rows
+from .utils import parse_DM
+from .utils import parse_lbd
+
+try:
+    from scipy.integrate import cumulative_trapezoid
+except ImportError:  # SciPy < 1.6
+    from scipy.integrate import cumtrapz as cumulative_trapezoid
+
+CUBE_VERSION = 1
+
+
+def nside2npix(nside):
+    "Number of HEALPix pixels"
+    return 12*nside**2
+
+
+def pix2ang(nside, ipix):
+    """ Center of HEALPix pixels (RING ordering)
+
+    Parameters
+    ----------
+    nside : int
+    ipix : ndarray
+      Pixel indices
+
+    Returns
+    -------
+    theta : ndarray
+      Colatitude (rad)
+    phi : ndarray
+      Longitude (rad)
+
+    """
+    ipix = np.atleast_1d(ipix).astype(np.int64)
+    npix = nside2npix(nside)
+    ncap = 2*nside*(nside - 1)
+    z = np.zeros(ipix.shape)
+    phi = np.zeros(ipix.shape)
+
+    north = ipix < ncap
+    iring = (1 + np.sqrt(1 + 2*ipix[north]).astype(np.int64)) >> 1
+    iphi = ipix[north] + 1 - 2*iring*(iring - 1)
+    z[north] = 1 - iring**2/(3*nside**2)
+    phi[north] = (iphi - 0.5)*np.pi/(2*iring)
+
+    equator = (ipix >= ncap) & (ipix < npix - ncap)
+    ip = ipix[equator] - ncap
+    iring = ip // (4*nside) + nside
+    iphi = ip % (4*nside) + 1
+    fodd = 0.5*(1 + ((iring + nside) & 1))
+    z[equator] = (2*nside - iring)*2/(3*nside)
+    phi[equator] = (iphi - fodd)*np.pi/(2*nside)
+
+    south = ipix >= npix - ncap
+    ip = npix - ipix[south]
+    iring = (1 + np.sqrt(2*ip - 1).astype(np.int64)) >> 1
+    iphi = 4*iring + 1 - (ip - 2*iring*(iring - 1))
+    z[south] = -1 + iring**2/(3*nside**2)
+    phi[south] = (iphi - 0.5)*np.pi/(2*iring)
+
+    return np.arccos(z), phi
+
+
+def ang2pix(nside, theta, phi):
+    """ HEALPix pixels (RING ordering) containing the directions
+    `theta` (colatitude, rad), `phi` (longitude, rad)
+    """
+    z = np.cos(np.atleast_1d(theta))
+    za = np.abs(z)
+    tt = np.mod(np.atleast_1d(phi), 2*np.pi)*2/np.pi  # in [0, 4)
+    tt, z, za = np.broadcast_arrays(tt, z, za)
+    ipix = np.zeros(z.shape, dtype=np.int64)
+
+    equator = za <= 2/3
+    temp1 = nside*(0.5 + tt[equator])
+    temp2 = nside*z[equator]*0.75
+    jp = (temp1 - temp2).astype(np.int64)  # ascending edge line
+    jm = (temp1 + temp2).astype(np.int64)  # descending edge line
+    ir = nside + 1 + jp - jm  # ring number counted from z = 2/3
+    kshift = 1 - (ir & 1)
+    ip = ((jp + jm - nside + kshift + 1) // 2) % (4*nside)
+    ipix[equator] = 2*nside*(nside - 1) + (ir - 1)*4*nside + ip
+
+    cap = ~equator
+    tp = tt[cap] - tt[cap].astype(np.int64)
+    tmp = nside*np.sqrt(3*(1 - za[cap]))
+    jp = (tp*tmp).astype(np.int64)
+    jm = ((1 - tp)*tmp).astype(np.int64)
+    ir = jp + jm + 1  # ring number counted from the closest pole
+    ip = (tt[cap]*ir).astype(np.int64) % (4*ir)
+    ipix[cap] = np.where(z[cap] > 0, 2*ir*(ir - 1) + ip,
+                         nside2npix(nside) - 2*ir*(ir + 1) + ip)
+    return ipix
+
+
+def lb2pix(nside, l, b):
+    "HEALPix pixels containing the Galactic directions `l`, `b` (deg)"
+    return ang2pix(nside, np.radians(90 - np.asarray(b)), np.radians(l))
+
+
+def pix2lb(nside, ipix):
+    "Galactic directions `l`, `b` (deg) of the HEALPix pixel centers"
+    theta, phi = pix2ang(nside, ipix)
+    return np.degrees(phi), 90 - np.degrees(theta)
+
+
+def ring_info(nside, iring):
+    """ Rings `iring` (1 to 4*nside - 1, from the north pole)
+
+    Returns
+    -------
+    start : ndarray
+      First pixel of the rings
+    npix : ndarray
+      Number of pixels of the rings
+    theta : ndarray
+      Colatitude of the rings (rad)
+    shift : ndarray
+      Longitude of the first pixel center, in units of the pixel width
+
+    """
+    iring = np.asarray(iring, dtype=np.int64)
+    ir = np.minimum(iring, 4*nside - iring)  # counted from the closest pole
+    cap = ir < nside
+    npix = np.where(cap, 4*ir, 4*nside)
+    start = np.where(cap, 2*ir*(ir - 1),
+                     2*nside*(nside - 1) + (iring - nside)*4*nside)
+    start = np.where(iring > 3*nside, nside2npix(nside) - 2*ir*(ir + 1),
+                     start)
+    z = np.where(cap, 1 - ir**2/(3*nside**2),
+                 (2*nside - iring)*2/(3*nside))
+    z = np.where(iring > 3*nside, -z, z)
+    shift = np.where(cap | ((iring - nside) % 2 == 0), 0.5, 0.)
+    return start, npix, np.arccos(z), shift
+
+
+def interp_weights(nside, theta, phi):
+    """ Bilinear interpolation weights of the HEALPix pixel centers
+
+    The direction is interpolated linearly in longitude between the two
+    closest pixel centers of the rings above and below it, and then
+    linearly in colatitude between the rings. Beyond the first and last
+    rings (around the poles) only the closest ring is used.
+
+    Returns
+    -------
+    ipix : ndarray
+      Pixels, with shape (4, ...)
+    weights : ndarray
+      Their weights (summing to 1), with shape (4, ...)
+
+    """
+    theta, phi = np.broadcast_arrays(np.atleast_1d(theta),
+                                     np.atleast_1d(phi))
+    nrings = 4*nside - 1
+    # Ring above the direction (0 above the first ring)
+    ring_theta = ring_info(nside, np.arange(1, nrings + 1))[2]
+    above = np.searchsorted(ring_theta, theta, side='right')
+    ring1 = np.maximum(above, 1)
+    ring2 = np.minimum(above + 1, nrings)
+    ipix, weights = [], []
+    for iring in (ring1, ring2):
+        start, npix, _, shift = ring_info(nside, iring)
+        t = np.mod(phi, 2*np.pi)*npix/(2*np.pi) - shift
+        j = np.floor(t).astype(np.int64)
+        ipix += [start + j % npix, start + (j + 1) % npix]
+        weights += [1 - (t - j), t - j]
+    theta1 = ring_info(nside, ring1)[2]
+    theta2 = ring_info(nside, ring2)[2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w2 = np.where(ring1 == ring2, 0, (theta - theta1)/(theta2 - theta1))
+    ring_weights = np.array([1 - w2, 1 - w2, w2, w2])
+    return np.array(ipix), np.array(weights)*ring_weights
+
+
+def _paths(path):
+    "Data and metadata file names of the cube `path`"
+    if path.endswith('.npy'):
+        path = path[:-4]
+    return path + '.npy', path + '.json'
+
+
+def build_cube(density, path, nside=32, dmin=0.01, dmax=100., nd=128,
+               oversample=8, block_size=2**16):
+    """ Tabulate the cumulative DM over the sky and write it to `path`
+
+    Parameters
+    ----------
+    density : ElectronDensity
+    path : str
+      Output file name (`.npy`; a `.json` file is written alongside)
+    nside : int, optional
+      HEALPix resolution parameter
+    dmin : float, optional
+      First non-zero distance of the grid (kpc)
+    dmax : float, optional
+      Last distance of the grid (kpc)
+    nd : int, optional
+      Number of logarithmically spaced distances
+    oversample : int, optional
+      Integration samples per distance grid interval
+    block_size : int, optional
+      Maximal number of points passed to `ne` at once
+
+    Returns
+    -------
+    meta : dict
+      The cube metadata
+
+    """
+    npy_file, json_file = _paths(path)
+    # Written under temporary names and renamed, the sidecar last, so that
+    # readers never see a partial cube
+    tmp_npy, tmp_json = ['{}.{}.tmp'.format(name, os.getpid())
+                         for name in (npy_file, json_file)]
+    d_grid = np.append(0, np.logspace(np.log10(dmin), np.log10(dmax), nd))
+    d_fine = np.append(np.linspace(0, dmin, oversample + 1)[:-1],
+                       np.logspace(np.log10(dmin), np.log10(dmax),
+                                   (nd - 1)*oversample + 1))
+    icol = np.append(0, np.arange(oversample, d_fine.size, oversample))
+
+    npix = nside2npix(nside)
+    cube = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.float32,
+                                     shape=(npix, d_grid.size))
+    nrows = max(1, block_size // d_fine.size)
+    for i0 in range(0, npix, nrows):
+        ipix = np.arange(i0, min(i0 + nrows, npix))
+        l, b = pix2lb(nside, ipix)
+        d_samp = np.broadcast_to(d_fine, (ipix.size, d_fine.size))
+        ne = density._ne_sightlines(l, b, d_samp)
+        dm = cumulative_trapezoid(ne, d_fine, axis=-1, initial=0)*1000
+        cube[i0:i0 + ipix.size] = dm[:, icol]
+    cube.flush()
+    del cube
+    os.replace(tmp_npy, npy_file)
+
+    meta = dict(version=CUBE_VERSION, nside=nside, ordering='RING',
+                distance=d_grid.tolist(), oversample=oversample,
+                fingerprint=density.fingerprint)
+    with open(tmp_json, 'wt') as fh:
+        json.dump(meta, fh)
+    os.replace(tmp_json, json_file)
+    return meta
+
+
+class DMCube(object):
+    """
+    Query a precomputed all-sky cumulative DM cube
+
+    The DM is interpolated bilinearly between the four closest pixel
+    centers (see `interp_weights`) and linearly in distance.
+    """
+
+    def __init__(self, path, density=None):
+        """
+        Arguments:
+        - `path`: Cube file name written by `build_cube`
+        - `density`: If given, raise ValueError if the cube was built
+                     for a different model (a stale cube)
+        """
+        npy_file, json_file = _paths(path)
+        with open(json_file, 'rt') as fh:
+            self.meta = json.load(fh)
+        if self.meta['version'] != CUBE_VERSION:
+            raise ValueError("Cube version {} is not supported ({})".format(
+                self.meta['version'], CUBE_VERSION))
+        if density is not None and self.is_stale(density):
+            raise ValueError("Stale cube {}: built for a different model"
+                             .format(npy_file))
+        self.nside = self.meta['nside']
+        self.distance = np.array(self.meta['distance'])
+        self.cube = np.load(npy_file, mmap_mode='r')
+
+    def is_stale(self, density):
+        "Was the cube built for a model other than `density`?"
+        return self.meta['fingerprint'] != density.fingerprint
+
+    def _rows(self, l, b):
+        "Cumulative DM profiles towards `l`, `b`, interpolated in the sky"
+        ipix, weights = interp_weights(self.nside,
+                                       np.radians(90 - np.asarray(b)),
+                                       np.radians(l))
+        return np.einsum('ij,ijk->jk', weights,
+                         np.asarray(self.cube[ipix], dtype=float))
+
+    def DM(self, l, b, d, quantity=True):
+        """ Dispersion measures towards `l`, `b` to distances `d`
+
+        Distances beyond the grid are clipped to its last distance.
+
+        Parameters
+        ----------
+        l : array_like or Angle
+          Galactic longitudes; assumed deg if unitless
+        b : array_like or Angle
+          Galactic latitudes; assumed deg if unitless
+        d : array_like or Quantity
+          Distances; assumed kpc if unitless
+        quantity : bool, optional
+          If False return a plain ndarray in pc cm**-3
+
+        Returns
+        -------
+        DM : Quantity or ndarray
+
+        """
+        l, b, d = np.broadcast_arrays(*[np.atleast_1d(val) for val in
+                                        parse_lbd(l, b, d)])
+        dm = self._rows(l.ravel(), b.ravel())
+        d = np.clip(d.ravel(), 0, self.distance[-1])
+        k = np.clip(np.searchsorted(self.distance, d), 1,
+                    self.distance.size - 1)
+        rows = np.arange(d.size)
+        d0, d1 = self.distance[k-1], self.distance[k]
+        DM = dm[rows, k-1] + (dm[rows, k] - dm[rows, k-1])*(d - d0)/(d1 - d0)
+        DM = DM.reshape(l.shape)
+        if quantity:
+            return DM * DM_unit
+        return DM
+
+    def dist(self, l, b, DM, quantity=True):
+        """ Distances to dispersion measures `DM` towards `l`, `b`
+
+        Returns
+        -------
+        dist : Quantity or ndarray
+          Distances; the last grid distance where `DM` exceeds the cube
+        beyond : ndarray
+          Boolean flags set where `DM` exceeds the cube
+
+        """
+        l, b, _ = parse_lbd(l, b, 0)
+        l, b, DM = np.broadcast_arrays(np.atleast_1d(l), np.atleast_1d(b),
+                                       np.atleast_1d(parse_DM(DM)))
+        dm = self._rows(l.ravel(), b.ravel())
+        DM = DM.ravel()
+        beyond = DM > dm[:, -1]
+        dist = np.full(DM.shape, self.distance[-1])
+        dist[~beyond] = interp_rows(DM[~beyond], dm[~beyond],
+                                    np.broadcast_to(self.distance,
+                                                    dm[~beyond].shape))
+        if quantity:
+            return dist * d_unit, beyond
+        return dist, beyond
@@ -1,9 +1,15 @@
 "Free electron density model"
 from __future__ import division
 
+import hashlib
 import os
+import threading
+import warnings
 from builtins import super
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from functools import reduce
 
 import numpy as np
 from astropy import units as u
@@ -14,29 +20,81 @@ from numpy import exp
 from numpy import pi
 from numpy import sqrt
 from numpy import tan
-from scipy.integrate import cumtrapz
 from scipy.integrate import quad
+from scipy.optimize import brentq
+from scipy.spatial import cKDTree
+from scipy.special import erf
 
+from . import instrumentation
 from . import ne_io
+from .cache import DMProfileCache
+from .instrumentation import instrumented_DM
+from .integrators import _kronrod
+from .integrators import get_integrator
+from .integrators import trapezoid_rule
 from .spiral_arms import ne_spiral_arm
+from .spiral_arms import ne_spiral_arm_grid
+from .utils import fingerprint
 from .utils import galactic_to_galactocentric
+from .utils import interp_rows
 from .utils import lzproperty
 from .utils import matmul
 from .utils import parse_DM
 from .utils import parse_lbd
 from .utils import rad2d2
 from .utils import rad3d2
+from .utils import ray_box
+from .utils import relative_to
 from .utils import rotation
+from .utils import union_intervals
 
+try:
+    from scipy.integrate import cumulative_trapezoid
+except ImportError:  # SciPy < 1.6
+    from scipy.integrate import cumtrapz as cumulative_trapezoid
 
 # Units
 DM_unit = u.pc / u.cm**3
 d_unit = u.kpc
+EM_unit = u.pc / u.cm**6
+SM_unit = u.kpc / u.m**(20/3)
+tau_unit = u.ms
+scint_bw_unit = u.kHz
+
+# Spectral index of the (Kolmogorov) density fluctuations
+ALPHA = 11/3
+# SM (kpc m**-20/3) per kpc cm**-6 of the integral of F ne**2
+# (c_sm c_u of NE2001)
+SM_FACTOR = (ALPHA - 3)/(2*(2*pi)**(4 - ALPHA)) * 10.16
+
+SightlineIntegrals = namedtuple('SightlineIntegrals',
+                                ['DM', 'EM', 'SM', 'SM_tau', 'tau',
+                                 'scint_bw'])
 
 # Sun
 XYZ_SUN = np.array([0, 8.5, 0])
 RSUN = sqrt(rad2d2(XYZ_SUN))
 
+# Components of ElectronDensity
+COMPONENTS = ('thick_disk', 'thin_disk', 'spiral_arms', 'galactic_center',
+              'lism', 'clumps', 'voids')
+
+# Clumps and voids files
+CLUMPS_FILE = os.path.join(ne_io.DATA_PATH, "neclumpN.NE2001.dat")
+VOIDS_FILE = os.path.join(ne_io.DATA_PATH, "nevoidN.NE2001.dat")
+
+# Counts of evaluated points of the ne_many threads, merged into the
+# NEobject.npoints counters when the threads are done
+_THREAD_COUNTS = threading.local()
+
+# Options of DM(..., breakdown=True) (see NEobject.DM_breakdown)
+BREAKDOWN_OPTIONS = ('step_size', 'nsamp', 'integrator', 'block_size',
+                     'quantity')
+
+# Approximate peak working memory of the model per evaluated point (bytes),
+# the components computing in float64
+BYTES_PER_POINT = 1024
+
 
 def set_xyz_sun(xyz_sun):
     global XYZ_SUN
@@ -46,6 +104,21 @@ def set_xyz_sun(xyz_sun):
     RSUN = sqrt(rad2d2(XYZ_SUN))
 
 
+def tau_iss(d, SM_tau, nu=1.):
+    """ Pulse broadening time (ms) of a source at distance `d` (kpc) with
+    the scattering measure `SM_tau` (kpc m**-20/3) at `nu` (GHz)
+    """
+    return 1000*(SM_tau/292.)**1.2 * d * nu**(-4.4)
+
+
+def scint_bw(d, SM_tau, nu=1.):
+    """ Scintillation bandwidth (kHz) of a source at distance `d` (kpc)
+    with the scattering measure `SM_tau` (kpc m**-20/3) at `nu` (GHz)
+    """
+    with np.errstate(divide='ignore'):
+        return 1.16/(2*pi*tau_iss(d, SM_tau, nu))
+
+
 def thick_disk(xyz, radius, height):
     """ Calculate the contribution of the thick disk to the free electron density
     at x, y, z = `xyz`
@@ -91,10 +164,7 @@ def gc(xyz, center, radius, height):
     """
     # Here I'm using the expression in the NE2001 code which is inconsistent
     # with Cordes and Lazio 2011 (0207156v3) (See Table 2)
-    try:
-        xyz = xyz - center
-    except ValueError:
-        xyz = xyz - center[:, None]
+    xyz = relative_to(xyz, center)
 
     r_ratio2 = rad2d2(xyz)/radius**2
 
@@ -111,6 +181,10 @@ class NEobject(object):
     """
     A general electron density object
     """
+    # Number of points where the density was evaluated
+    npoints = 0
+    # Label of the object in the instrumentation statistics
+    _label = None
 
     def __init__(self, func, **params):
         """
@@ -133,6 +207,7 @@ class NEobject(object):
         except TypeError:
             self._func = partial(func, **params)
         self._params = params
+        self._density_func = func
 
     def __add__(self, other):
         return Add(self, other)
@@ -140,6 +215,22 @@ class NEobject(object):
     def __or__(self, other):
         return OR(self, other)
 
+    @property
+    def label(self):
+        """
+        Label of the object (see `ne2001.instrumentation`): its component
+        name in a model, the name of its density function or class otherwise
+        """
+        if self._label is not None:
+            return self._label
+        func = getattr(self, '_density_func', None)
+        return getattr(func, '__name__', type(self).__name__)
+
+    @label.setter
+    def label(self, label):
+        self._label = label
+
+    @instrumented_DM
     def DM(self, l, b, d,
            epsrel=1e-4, epsabs=1e-6, integrator=quad, step_size=0.001,
            *arg, **kwargs):
@@ -155,8 +246,15 @@ class NEobject(object):
           Distance to source; assumed kpc if unitless
         epsrel : float, optional
         epsabs : float, optional
-        integrator : method
+        integrator : method or str
+          quad, a sampling integrator (e.g. scipy trapezoid, simpson), or the name of
+          an integrator of `ne2001.integrators` (see `DM_integrate`)
         step_size : float, optional
+        intervals : bool, optional
+          Integrate only over the sightline intervals where the components
+          may be non zero (see `intervals`), split at the edges of the
+          intervals of their sub-components. Sums of components are
+          integrated term by term.
 
         Returns
         -------
@@ -164,27 +262,277 @@ class NEobject(object):
           Dispersion Measure with units pc cm**-3
 
         """
+        if isinstance(integrator, str):
+            DM, _ = self.DM_integrate(l, b, d, integrator, epsrel=epsrel,
+                                      epsabs=epsabs, step_size=step_size,
+                                      **kwargs)
+            if all(np.ndim(val) == 0 for val in parse_lbd(l, b, d)):
+                return DM[0]
+            return DM
         # Convert to floats
         l, b, d = parse_lbd(l, b, d)
+        if kwargs.pop('intervals', False):
+            return self._DM_intervals(l, b, d, epsrel, epsabs, integrator,
+                                      step_size, *arg, **kwargs) * DM_unit
         #
         xyz = galactic_to_galactocentric(l, b, d, [0, 0, 0])
 
         dfinal = sqrt(rad3d2(xyz))
-        if integrator.__name__ is 'quad':
+        if integrator.__name__ == 'quad':
             return integrator(lambda x: self.ne(XYZ_SUN + x*xyz),
                               0, 1, *arg, epsrel=epsrel, epsabs=epsabs,
                               **kwargs)[0]*dfinal*1000 * DM_unit
         else:   # Assuming sapling integrator
-            nsamp = max(1000, dfinal/step_size)
+            nsamp = int(max(1000, dfinal/step_size))
             x = np.linspace(0, 1, nsamp + 1)
             xyz = galactic_to_galactocentric(l, b, x*dfinal, XYZ_SUN)
             ne = self.ne(xyz)
             return integrator(ne)*dfinal*1000*x[1] * DM_unit
 
-    def dist(self, l, b, DM, step_size=0.001):
+    def DM_many(self, l, b, d, step_size=0.001, nsamp=None,
+                integrator=trapezoid_rule, block_size=2**14, quantity=True):
+        """ Calculate the dispersion measure towards many directions at once
+
+        The sightlines are sorted by distance and sampled in blocks of at
+        most `block_size` points, so that `ne` is evaluated once per block
+        on a (3, sightlines x samples) array.
+
+        Parameters
+        ----------
+        l : array_like or Angle
+          Galactic longitudes; assumed deg if unitless
+        b : array_like or Angle
+          Galactic latitudes; assumed deg if unitless
+        d : array_like or Quantity
+          Distances to the sources; assumed kpc if unitless
+        step_size : float, optional
+          Maximal sampling step along a sightline (kpc)
+        nsamp : int, optional
+          Number of samples per sightline. Default is
+          max(1000, d/step_size) for the farthest source of each block
+        integrator : method, optional
+          Sampling integrator accepting `dx` and `axis` (e.g. scipy trapezoid, simpson)
+        block_size : int, optional
+          Maximal number of points passed to `ne` at once
+        quantity : bool, optional
+          If False return a plain ndarray in pc cm**-3
+
+        Returns
+        -------
+        DM : Quantity or ndarray
+          Dispersion Measures with units pc cm**-3
+
+        """
+        l, b, d = np.broadcast_arrays(*[np.atleast_1d(val) for val in
+                                        parse_lbd(l, b, d)])
+        DM = np.zeros(d.shape)
+        d = d.ravel()
+        for rows, nsamp_block in _sightline_blocks(d, step_size, nsamp,
+                                                   block_size):
+            x = np.linspace(0, 1, nsamp_block + 1)
+            ne = self._ne_sightlines(l.flat[rows], b.flat[rows],
+                                     np.outer(d[rows], x))
+            DM.flat[rows] = integrator(ne, dx=x[1], axis=-1)*d[rows]*1000
+
+        if quantity:
+            return DM * DM_unit
+        return DM
+
+    def integrals(self, l, b, d, nu=1., step_size=0.001, nsamp=None,
+                  integrator=trapezoid_rule, quantity=True):
+        """ Dispersion, emission and scattering measures towards
+        direction l,b and the derived scattering quantities
+
+        See `integrals_many`; the results are scalars.
+        """
+        results = self.integrals_many(l, b, d, nu, step_size, nsamp,
+                                      integrator, quantity=quantity)
+        return SightlineIntegrals(*[result[0] for result in results])
+
+    def integrals_many(self, l, b, d, nu=1., step_size=0.001, nsamp=None,
+                       integrator=trapezoid_rule, block_size=2**14, quantity=True):
+        """ Dispersion, emission and scattering measures towards many
+        directions and the derived scattering quantities
+
+        The sightlines are sampled as in `DM_many`, and the density and F
+        ne**2 are evaluated once per sample (see `ne_F`) for all the
+        integrals. As in NE2001, the pulse broadening time and the
+        scintillation bandwidth are derived from `SM_tau`, the scattering
+        measure weighted by 6 s/d (1 - s/d) along the sightline.
+
+        Parameters
+        ----------
+        l : array_like or Angle
+          Galactic longitudes; assumed deg if unitless
+        b : array_like or Angle
+          Galactic latitudes; assumed deg if unitless
+        d : array_like or Quantity
+          Distances to the sources; assumed kpc if unitless
+        nu : float or Quantity, optional
+          Frequency of the scattering quantities; assumed GHz if unitless
+        step_size, nsamp, integrator, block_size : optional
+          See `DM_many`
+        quantity : bool, optional
+          If False return plain ndarrays in the units below
+
+        Returns
+        -------
+        integrals : SightlineIntegrals
+          DM (pc cm**-3), EM (pc cm**-6), SM and SM_tau (kpc m**-20/3),
+          tau (pulse broadening time, ms) and scint_bw (scintillation
+          bandwidth, kHz)
+
+        """
+        l, b, d = np.broadcast_arrays(*[np.atleast_1d(val) for val in
+                                        parse_lbd(l, b, d)])
+        nu = u.Quantity(nu, u.GHz).value
+        DM, EM, SM, SM_tau = [np.zeros(d.shape) for _ in range(4)]
+        d = d.ravel()
+        for rows, nsamp_block in _sightline_blocks(d, step_size, nsamp,
+                                                   block_size):
+            x = np.linspace(0, 1, nsamp_block + 1)
+            dist = np.outer(d[rows], x)
+            xyz = galactic_to_galactocentric(l.flat[rows][:, None],
+                                             b.flat[rows][:, None], dist,
+                                             XYZ_SUN)
+            ne, fne2 = [val.reshape(dist.shape)
+                        for val in self.ne_F(xyz.reshape(3, -1))]
+            samples = np.stack([ne, ne**2, fne2, 6*x*(1 - x)*fne2])
+            integral = integrator(samples, dx=x[1], axis=-1)*d[rows]
+            DM.flat[rows] = integral[0]*1000
+            EM.flat[rows] = integral[1]*1000
+            SM.flat[rows] = integral[2]*SM_FACTOR
+            SM_tau.flat[rows] = integral[3]*SM_FACTOR
+
+        d = d.reshape(DM.shape)
+        results = [DM, EM, SM, SM_tau, tau_iss(d, SM_tau, nu),
+                   scint_bw(d, SM_tau, nu)]
+        if quantity:
+            results = [result * unit for result, unit in zip(
+                results, [DM_unit, EM_unit, SM_unit, SM_unit, tau_unit,
+                          scint_bw_unit])]
+        return SightlineIntegrals(*results)
+
+    def DM_integrate(self, l, b, d, integrator='gauss-kronrod',
+                     quantity=True, **options):
+        """ Dispersion measures and their error estimates towards many
+        directions, with an integrator of `ne2001.integrators`
+
+        Parameters
+        ----------
+        l : array_like or Angle
+          Galactic longitudes; assumed deg if unitless
+        b : array_like or Angle
+          Galactic latitudes; assumed deg if unitless
+        d : array_like or Quantity
+          Distances to the sources; assumed kpc if unitless
+        integrator : str, optional
+          Name of the integrator ('quad', 'trapezoid', 'simpson',
+          'gauss-legendre' or 'gauss-kronrod')
+        quantity : bool, optional
+          If False return plain ndarrays in pc cm**-3
+        **options
+          Options of the integrator (`epsrel`, `epsabs` in kpc cm**-3,
+          `step_size`, `block_size`, ...)
+
+        Returns
+        -------
+        DM : Quantity or ndarray
+          Dispersion Measures with units pc cm**-3
+        error : Quantity or ndarray
+          Estimates of their absolute errors
+
+        """
+        integrate = get_integrator(integrator)
+        l, b, d = np.broadcast_arrays(*[np.atleast_1d(val) for val in
+                                        parse_lbd(l, b, d)])
+        uhat = galactic_to_galactocentric(l.ravel(), b.ravel(), 1.,
+                                          [0, 0, 0])
+
+        def ne(rows, s):
+            xyz = XYZ_SUN[:, None, None] + uhat[:, rows, None]*s
+            return self.ne(xyz.reshape(3, -1)).reshape(s.shape)
+
+        DM, error = integrate(ne, np.zeros(d.size), d.ravel(), **options)
+        DM, error = DM.reshape(d.shape)*1000, error.reshape(d.shape)*1000
+        if quantity:
+            return DM * DM_unit, error * DM_unit
+        return DM, error
+
+    def DM_breakdown(self, l, b, d, step_size=0.001, nsamp=None,
+                     integrator=trapezoid_rule, block_size=2**14, quantity=True):
+        """ Contribution of each part of the object to the dispersion
+        measure towards many directions
+
+        The sightlines are sampled as in `DM_many`, and the parts are
+        evaluated once per sample (see `ne_parts`).
+
+        Parameters
+        ----------
+        l, b, d : array_like, Angle or Quantity
+          See `DM_many`
+        step_size, nsamp, integrator, block_size : optional
+          See `DM_many`
+        quantity : bool, optional
+          If False return plain ndarrays in pc cm**-3
+
+        Returns
+        -------
+        DM : dict
+          Dispersion Measures of each part (see `part_labels`) and their
+          sum ('total'), with the broadcast shape of `l`, `b` and `d`
+
+        """
+        if getattr(integrator, '__name__', None) == 'quad':
+            raise ValueError("The DM breakdown requires a sampling "
+                             "integrator (e.g. scipy trapezoid, simpson)")
+        l, b, d = parse_lbd(l, b, d)
+        shape = np.broadcast(l, b, d).shape
+        l, b, d = [val.ravel() for val in np.broadcast_arrays(
+            *[np.atleast_1d(val) for val in (l, b, d)])]
+        labels = self.part_labels()
+        DM = np.zeros((len(labels), d.size))
+        for rows, nsamp_block in _sightline_blocks(d, step_size, nsamp,
+                                                   block_size):
+            x = np.linspace(0, 1, nsamp_block + 1)
+            dist = np.outer(d[rows], x)
+            xyz = galactic_to_galactocentric(l[rows][:, None],
+                                             b[rows][:, None], dist, XYZ_SUN)
+            parts = self.ne_parts(xyz.reshape(3, -1))
+            ne = np.stack([parts[label].reshape(dist.shape)
+                           for label in labels])
+            DM[:, rows] = integrator(ne, dx=x[1], axis=-1)*d[rows]*1000
+
+        DM = dict(zip(labels + ['total'],
+                      np.concatenate([DM, DM.sum(axis=0)[None]])))
+        for label in DM:
+            DM[label] = DM[label].reshape(shape)
+            if quantity:
+                DM[label] = DM[label] * DM_unit
+        return DM
+
+    def _ne_sightlines(self, l, b, dist):
+        """
+        Electron density at distances `dist` (kpc) along the sightlines
+        `l`, `b` (deg). `dist` has shape (len(l), nsamp)
+        """
+        xyz = galactic_to_galactocentric(l[:, None], b[:, None], dist,
+                                         XYZ_SUN)
+        return self.ne(xyz.reshape(3, -1)).reshape(dist.shape)
+
+    def dist(self, l, b, DM, step_size=None, tol=1e-4, dmax=100.,
+             max_step=1.):
         """ Estimate the distance to an object with dispersion measure `DM`
         Located at the direction `l ,b'
 
+        The DM is accumulated along the sightline segment by segment (with
+        the 7-15 Gauss-Kronrod rule) until it reaches `DM`, and the
+        distance is then found by root finding within the last segment.
+        The segments are halved where the error estimate of their DM
+        exceeds `tol` and doubled (up to `max_step`) where it is much
+        smaller, and end at the edges of the bounded components (see
+        `intervals`) so that small objects are not stepped over.
+
         Parameters
         ----------
         l : float or Angle
@@ -193,42 +541,344 @@ class NEobject(object):
           Galactic latitude; assumed deg if unitless
         DM : float or Quantity
           Dispersion Measure;  assumed pc cm**^-3 if unitless
-        step_size
+        step_size : float, optional
+          Deprecated alias of `max_step`
+        tol : float, optional
+          Relative tolerance of the DM of each segment and of the distance
+        dmax : float, optional
+          Maximal distance (kpc), returned with a warning if `DM` exceeds
+          the DM out to `dmax`
+        max_step : float, optional
+          Maximal length of the segments (kpc)
+
+        Returns
+        -------
+        dist : Quantity
+          Distance with units kpc
+
+        """
+        if step_size is not None:
+            warnings.warn("dist(step_size=...) is deprecated: use max_step",
+                          DeprecationWarning, stacklevel=2)
+            max_step = step_size
+        l, b, _ = parse_lbd(l, b, 0)
+        target = parse_DM(DM)/1000
+        if target <= 0:
+            return 0. * d_unit
+        uhat = galactic_to_galactocentric(l, b, 1., [0, 0, 0])
+        rows = np.zeros(1, dtype=int)
+
+        def ne(rows, s):
+            xyz = XYZ_SUN[:, None] + uhat[:, None]*s.ravel()
+            return self.ne(xyz).reshape(s.shape)
+
+        def segment(s0, s1):
+            "DM (kpc cm**-3) of the segment [s0, s1] and its error"
+            kronrod, gauss = _kronrod(ne, rows, np.array([s0]),
+                                      np.array([s1]), 2**14)
+            return kronrod[0], abs(kronrod[0] - gauss[0])
+
+        edges = np.unique(self._edges(l, b, dmax))
+        edges = np.append(edges[(edges > 0) & (edges < dmax)], dmax)
+        s = DM_s = 0.
+        step = min(0.01, max_step)
+        i = 0
+        while s < dmax:
+            while edges[i] <= s:
+                i += 1
+            s1 = min(s + step, edges[i])
+            DM_segment, error = segment(s, s1)
+            if (error > tol*DM_segment + 1e-12*(s1 - s) and
+                    s1 - s > 1e-6):
+                step = (s1 - s)/2
+                continue
+            if DM_s + DM_segment >= target:
+                return brentq(lambda t: DM_s + segment(s, t)[0] - target,
+                              s, s1, xtol=tol*s1) * d_unit
+            DM_s += DM_segment
+            if error <= tol*DM_segment/32:
+                step = min(2*step, max_step)
+            s = s1
+        warnings.warn("DM {} exceeds the DM out to {} kpc ({})".format(
+            target*1000, dmax, DM_s*1000))
+        return dmax * d_unit
+
+    def dist_many(self, l, b, DM, step_size=0.001, nsamp=None, dmax=100.,
+                  block_size=2**14, quantity=True):
+        """ Estimate the distances to many objects with dispersion measures
+        `DM` located at the directions `l`, `b`
+
+        The cumulative DM profile of each sightline is built segment by
+        segment. The range is doubled only for the sightlines which did not
+        reach their target DM yet, and the distances are interpolated in the
+        segment where the target is crossed.
+
+        Parameters
+        ----------
+        l : array_like or Angle
+          Galactic longitudes; assumed deg if unitless
+        b : array_like or Angle
+          Galactic latitudes; assumed deg if unitless
+        DM : array_like or Quantity
+          Dispersion Measures; assumed pc cm**^-3 if unitless
+        step_size : float, optional
+          Maximal sampling step along a sightline (kpc)
+        nsamp : int, optional
+          Number of samples per segment. Default is
+          max(1000, segment/step_size) for the longest segment of each block
+        dmax : float, optional
+          Maximal distance (kpc)
+        block_size : int, optional
+          Maximal number of points passed to `ne` at once
+        quantity : bool, optional
+          If False return the distances as a plain ndarray in kpc
 
         Returns
         -------
+        dist : Quantity or ndarray
+          Distances; `dmax` where `DM` exceeds the Galactic maximum
+        beyond : ndarray
+          Boolean flags set where `DM` exceeds the DM out to `dmax`
 
         """
-        # Parse
-        DM = parse_DM(DM)
+        l, b, _ = parse_lbd(l, b, 0)
+        l, b, DM = np.broadcast_arrays(np.atleast_1d(l), np.atleast_1d(b),
+                                       np.atleast_1d(parse_DM(DM)))
+        l, b, DM = l.ravel(), b.ravel(), DM.ravel()
+
+        dist = np.full(DM.shape, float(dmax))
+        beyond = np.zeros(DM.shape, dtype=bool)
 
         # Initial guess
-        dist0 = DM/self.params['thick_disk']['e_density']/1000
+        d0 = np.zeros(DM.shape)
+        d1 = np.clip(DM/self.params['thick_disk']['e_density']/1000,
+                     step_size, dmax)
+        DM0 = np.zeros(DM.shape)
+        active = np.arange(DM.size)
+
+        while active.size:
+            reached = np.zeros(DM.size, dtype=bool)
+            for rows, nsamp_block in _sightline_blocks(d1[active] - d0[active],
+                                                       step_size, nsamp,
+                                                       block_size):
+                rows = active[rows]
+                d_samp = (d0[rows, None] +
+                          np.outer(d1[rows] - d0[rows],
+                                   np.linspace(0, 1, nsamp_block + 1)))
+                ne_samp = self._ne_sightlines(l[rows], b[rows], d_samp)
+                dm_samp = DM0[rows, None] + cumulative_trapezoid(
+                    ne_samp, d_samp, axis=-1, initial=0)*1000
+                DM0[rows] = dm_samp[:, -1]
+                ok = dm_samp[:, -1] >= DM[rows]
+                if ok.any():
+                    dist[rows[ok]] = interp_rows(DM[rows[ok]], dm_samp[ok],
+                                                 d_samp[ok])
+                    reached[rows[ok]] = True
+            beyond[active[~reached[active] & (d1[active] >= dmax)]] = True
+            active = active[~reached[active] & (d1[active] < dmax)]
+            d0[active] = d1[active]
+            d1[active] = np.minimum(2*d1[active], dmax)
+
+        if quantity:
+            return dist * d_unit, beyond
+        return dist, beyond
+
+    def _DM_intervals(self, l, b, d, epsrel=1e-4, epsabs=1e-6,
+                      integrator=quad, step_size=0.001, *arg, **kwargs):
+        """
+        Dispersion measure (pc cm**-3) integrated over the sightline
+        intervals of the object, split at the edges of its sub-components
+        """
+        uhat = galactic_to_galactocentric(l, b, 1., [0, 0, 0])
+        edges = np.unique(self._edges(l, b, d))
+        DM = 0
+        for s1, s2 in self.intervals(l, b, d):
+            points = edges[(edges > s1) & (edges < s2)]
+            if integrator.__name__ == 'quad':
+                options = dict(epsrel=epsrel, epsabs=epsabs)
+                if points.size:
+                    options.update(points=points,
+                                   limit=max(50, 4*points.size))
+                options.update(kwargs)
+                DM += integrator(lambda s: self.ne(XYZ_SUN + s*uhat),
+                                 s1, s2, *arg, **options)[0]
+                continue
+            pieces = np.concatenate([[s1], points, [s2]])
+            for lo, hi in zip(pieces[:-1], pieces[1:]):
+                nsamp = int(max(10, np.ceil((hi - lo)/step_size)))
+                s = np.linspace(lo, hi, nsamp + 1)
+                ne = self.ne(XYZ_SUN[:, None] + uhat[:, None]*s)
+                DM += integrator(ne)*(s[1] - s[0])
+        return DM*1000
+
+    def bounds(self):
+        """
+        Axis-aligned box (lo, hi) in Galactocentric coordinates (kpc)
+        outside which the density vanishes; None if unbounded
+        """
+        try:
+            bounds = BOUNDS[self._density_func]
+        except (AttributeError, KeyError):
+            return None
+        return bounds(**self._params)
 
-        while self.DM(l, b, dist0).value < DM:
-            dist0 *= 2
+    @lzproperty
+    def box(self):
+        "Cached `bounds`"
+        return self.bounds()
 
-        nsamp = max(1000, dist0/step_size)
-        d_samp = np.linspace(0, dist0, nsamp + 1)
-        ne_samp = self.ne(galactic_to_galactocentric(l, b, d_samp, XYZ_SUN))
-        dm_samp = cumtrapz(ne_samp, dx=d_samp[1])*1000
-        return np.interp(DM, dm_samp, d_samp[1:]) * d_unit
+    def intervals(self, l, b, d):
+        """
+        Sorted disjoint intervals of distance from the Sun (kpc, shape
+        (n, 2)) along the sightline `l`, `b` up to `d` where the density
+        may be non zero
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            return np.array([[0., d]])
+        interval = ray_box(XYZ_SUN,
+                           galactic_to_galactocentric(l, b, 1., [0, 0, 0]),
+                           bounds[0], bounds[1], d)
+        return np.array([interval] if interval else []).reshape(-1, 2)
+
+    def _edges(self, l, b, d):
+        "Edges of the sightline intervals of the object and its parts"
+        return self.intervals(l, b, d).ravel()
+
+    def ne_many(self, xyz, out=None, max_memory=2**28, block_size=2**16,
+                workers=1, dtype=np.float64):
+        """ Electron density at many locations with bounded memory
+
+        The points are evaluated in blocks of at most `block_size` points,
+        small enough that the working memory of the blocks being evaluated
+        at once stays within `max_memory`. The blocks are run on a pool of
+        `workers` threads (numpy releases the GIL in the heavy ufuncs).
+
+        Parameters
+        ----------
+        xyz : array_like
+          Locations with shape (3, ...); may be a memory map
+        out : ndarray, optional
+          Output array with the shape of `xyz[0]`
+        max_memory : int, optional
+          Working memory budget (bytes), excluding `xyz` and `out`
+        block_size : int, optional
+          Maximal number of points per block
+        workers : int, optional
+          Number of threads
+        dtype : dtype, optional
+          Type of `out` (if not given). The density is always computed in
+          float64: a smaller type only saves the memory of the output
+
+        Returns
+        -------
+        ne : ndarray
+
+        """
+        shape = np.shape(xyz)[1:]
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError("out has shape {}, expected {}".format(
+                out.shape, shape))
+        xyz = np.reshape(xyz, (3, -1))
+        flat = out.reshape(-1)
+        size = max(1, min(block_size,
+                          max_memory // (workers*BYTES_PER_POINT)))
+
+        def evaluate(start):
+            stop = min(start + size, xyz.shape[1])
+            flat[start:stop] = self.ne(np.asarray(xyz[:, start:stop],
+                                                  dtype=float))
+
+        def evaluate_counted(start):
+            _THREAD_COUNTS.counts = counts = {}
+            try:
+                evaluate(start)
+            finally:
+                _THREAD_COUNTS.counts = None
+            return counts
+
+        starts = range(0, xyz.shape[1], size)
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                for counts in executor.map(evaluate_counted, starts):
+                    for obj, npoints in counts.values():
+                        obj.npoints += npoints
+        else:
+            for start in starts:
+                evaluate(start)
+        if not np.shares_memory(flat, out):
+            out[...] = flat.reshape(shape)
+        return out
+
+    def _count(self, npoints):
+        "Add `npoints` to the evaluated points (see `ne_many`)"
+        counts = getattr(_THREAD_COUNTS, 'counts', None)
+        if counts is None:
+            self.npoints += npoints
+        else:
+            counts.setdefault(id(self), [self, 0])[1] += npoints
 
     def ne(self, xyz):
         "Electron density at the location `xyz`"
-        return self.electron_density(xyz)
+        self._count(np.size(xyz) // 3)
+        stats = instrumentation.ACTIVE
+        if stats is None:
+            return self.electron_density(xyz)
+        return stats.evaluate(self, xyz)
+
+    def ne_F(self, xyz):
+        """ Electron density and F ne**2 at the location `xyz`
+
+        F is the fluctuation parameter of the object; the F ne**2 of
+        combined objects is that of the objects which set the density
+        (see `OR`)
+        """
+        ne = self.ne(xyz)
+        return ne, self._fparam*ne**2
+
+    def part_labels(self):
+        "Labels of the parts of the object (see `ne_parts`)"
+        return [self.label]
+
+    def ne_parts(self, xyz):
+        """ Contribution of each part of the object to the electron density
+        at the location `xyz`
+
+        Returns a dict of the densities by label (see `part_labels`),
+        whose sum is `ne(xyz)`; the parts of combined objects contribute
+        where the combination evaluates them (see `OR`)
+        """
+        return {self.label: self.ne(xyz)}
 
     def electron_density(self, xyz):
         "Electron density at the location `xyz`"
         return self._ne0*self._func(xyz)
 
 
-class OR(NEobject):
+def _sightline_blocks(lengths, step_size, nsamp, block_size):
     """
-    Return A or B where A and B are instance of
-    and the combined electron density is ne_A
-    for all ne_A > 0 and ne_B otherwise.
+    Split sightlines into blocks of at most `block_size` sampled points
+
+    Yields the indices of the sightlines in each block (farthest first)
+    together with the number of samples per sightline in that block
     """
+    order = np.argsort(-lengths)
+    i0 = 0
+    while i0 < order.size:
+        nsamp_block = nsamp or int(max(1000, lengths[order[i0]]/step_size))
+        i1 = min(i0 + max(1, block_size // (nsamp_block + 1)), order.size)
+        yield order[i0:i1], nsamp_block
+        i0 = i1
+
+
+class _Combination(NEobject):
+    """
+    Combination of two objects, non zero where either is
+    """
+    # Whether the right object is only evaluated where the left one is <= 0
+    _masked = False
 
     def __init__(self, object1, object2):
         """
@@ -236,28 +886,203 @@ class OR(NEobject):
         self._object1 = object1
         self._object2 = object2
 
-    def electron_density(self, *args):
-        ne1 = self._object1.ne(*args)
-        ne2 = self._object2.ne(*args)
-        return ne1 + ne2*(ne1 <= 0)
+    @property
+    def label(self):
+        "Labels of the objects joined by the operator (nested joins merged)"
+        if self._label is not None:
+            return self._label
+        operator = ' | ' if isinstance(self, OR) else ' + '
+        labels = []
+        for obj in (self._object1, self._object2):
+            label = obj.label
+            if type(obj) is type(self) and obj._label is None:
+                label = label[1:-1]
+            labels.append(label)
+        return '(' + operator.join(labels) + ')'
+
+    @label.setter
+    def label(self, label):
+        self._label = label
+
+    def bounds(self):
+        bounds1 = self._object1.bounds()
+        bounds2 = self._object2.bounds()
+        if bounds1 is None or bounds2 is None:
+            return None
+        return (np.minimum(bounds1[0], bounds2[0]),
+                np.maximum(bounds1[1], bounds2[1]))
+
+    def intervals(self, l, b, d):
+        return union_intervals(np.concatenate([
+            self._object1.intervals(l, b, d),
+            self._object2.intervals(l, b, d)]))
+
+    def _edges(self, l, b, d):
+        return np.concatenate([self._object1._edges(l, b, d),
+                               self._object2._edges(l, b, d)])
+
+    def part_labels(self):
+        return self._object1.part_labels() + self._object2.part_labels()
+
+    def ne_parts(self, xyz):
+        xyz = np.asarray(xyz, dtype=float)
+        shape = xyz.shape[1:]
+        xyz = xyz.reshape(3, -1)
+        parts = dict((label, np.zeros(xyz.shape[1]))
+                     for label in self.part_labels())
+        ne = np.zeros(xyz.shape[1])
+        for obj in (self._object1, self._object2):
+            index = None
+            if self._masked and obj is self._object2:
+                index = np.flatnonzero(ne <= 0)
+            index = self._subset(obj, xyz, index)
+            if isinstance(index, slice) or index.size:
+                for label, ne_part in obj.ne_parts(xyz[:, index]).items():
+                    parts[label][index] += ne_part
+                    ne[index] += ne_part
+        return dict((label, part.reshape(shape))
+                    for label, part in parts.items())
+
+    @staticmethod
+    def _subset(obj, xyz, index=None):
+        """
+        Indices of the points `xyz[:, index]` (all the points if `index` is
+        None) within the bounds of `obj`; slice(None) for all the points
+        """
+        box = obj.box
+        if box is not None:
+            points = xyz if index is None else xyz[:, index]
+            inside = np.all((points >= box[0][:, None]) &
+                            (points <= box[1][:, None]), axis=0)
+            index = (np.flatnonzero(inside) if index is None
+                     else index[inside])
+        stats = instrumentation.ACTIVE
+        if stats is not None and index is not None:
+            stats.mask(obj, xyz.shape[1] - index.size)
+        return slice(None) if index is None else index
+
+    @classmethod
+    def _ne_subset(cls, obj, xyz, index=None):
+        """
+        Density of `obj` at the points `xyz[:, index]` (all the points if
+        `index` is None) evaluated only on those within its bounds
 
+        Returns
+        -------
+        index : ndarray or slice
+          Indices of the points where the density was evaluated
+        ne : ndarray
+          Density at these points
+        """
+        index = cls._subset(obj, xyz, index)
+        if isinstance(index, slice):
+            return index, obj.ne(xyz)
+        if not index.size:
+            return index, np.zeros(0)
+        return index, obj.ne(xyz[:, index])
+
+    @classmethod
+    def _add_ne_F(cls, obj, xyz, index, ne, fne2):
+        """
+        Add the density and F ne**2 of `obj` at the points `xyz[:, index]`
+        within its bounds to `ne` and `fne2`
+        """
+        index = cls._subset(obj, xyz, index)
+        if isinstance(index, slice) or index.size:
+            ne_obj, fne2_obj = obj.ne_F(xyz[:, index])
+            ne[index] += ne_obj
+            fne2[index] += fne2_obj
+
+    @staticmethod
+    def _ne_point(obj, xyz):
+        "Density of `obj` at the point `xyz` if within its bounds"
+        box = obj.box
+        if box is not None and (np.any(xyz < box[0]) or
+                                np.any(xyz > box[1])):
+            stats = instrumentation.ACTIVE
+            if stats is not None:
+                stats.mask(obj, 1)
+            return 0.
+        return obj.ne(xyz)
+
+
+class OR(_Combination):
+    """
+    Return A or B where A and B are instance of
+    and the combined electron density is ne_A
+    for all ne_A > 0 and ne_B otherwise.
+    """
+    _masked = True
 
-class Add(NEobject):
+    def electron_density(self, xyz):
+        """
+        The right object is only evaluated where the left one is <= 0
+        """
+        xyz = np.asarray(xyz, dtype=float)
+        if xyz.ndim == 1:
+            ne1 = self._ne_point(self._object1, xyz)
+            if ne1 > 0:
+                return ne1
+            return ne1 + self._ne_point(self._object2, xyz)
+
+        shape = xyz.shape[1:]
+        xyz = xyz.reshape(3, -1)
+        ne = np.zeros(xyz.shape[1])
+        index, ne1 = self._ne_subset(self._object1, xyz)
+        ne[index] = ne1
+        index, ne2 = self._ne_subset(self._object2, xyz,
+                                     np.flatnonzero(ne <= 0))
+        ne[index] += ne2
+        return ne.reshape(shape)
+
+    def ne_F(self, xyz):
+        "F ne**2 of the object setting the density (see `NEobject.ne_F`)"
+        xyz = np.asarray(xyz, dtype=float)
+        shape = xyz.shape[1:]
+        xyz = xyz.reshape(3, -1)
+        ne, fne2 = np.zeros(xyz.shape[1]), np.zeros(xyz.shape[1])
+        self._add_ne_F(self._object1, xyz, None, ne, fne2)
+        self._add_ne_F(self._object2, xyz, np.flatnonzero(ne <= 0), ne, fne2)
+        return ne.reshape(shape), fne2.reshape(shape)
+
+
+class Add(_Combination):
     """
     Return A + B where A and B are instance of
     and the combined electron density is ne_A + ne_B.
     """
 
-    def __init__(self, object1, object2):
+    def electron_density(self, xyz):
         """
+        Objects are only evaluated within their bounds
         """
-        self._object1 = object1
-        self._object2 = object2
-
-    def electron_density(self, *args):
-        ne1 = self._object1.ne(*args)
-        ne2 = self._object2.ne(*args)
-        return ne1 + ne2
+        xyz = np.asarray(xyz, dtype=float)
+        if xyz.ndim == 1:
+            return (self._ne_point(self._object1, xyz) +
+                    self._ne_point(self._object2, xyz))
+
+        shape = xyz.shape[1:]
+        xyz = xyz.reshape(3, -1)
+        ne = np.zeros(xyz.shape[1])
+        for obj in (self._object1, self._object2):
+            index, ne_obj = self._ne_subset(obj, xyz)
+            ne[index] += ne_obj
+        return ne.reshape(shape)
+
+    def ne_F(self, xyz):
+        "Sums of the densities and F ne**2 (see `NEobject.ne_F`)"
+        xyz = np.asarray(xyz, dtype=float)
+        shape = xyz.shape[1:]
+        xyz = xyz.reshape(3, -1)
+        ne, fne2 = np.zeros(xyz.shape[1]), np.zeros(xyz.shape[1])
+        for obj in (self._object1, self._object2):
+            self._add_ne_F(obj, xyz, None, ne, fne2)
+        return ne.reshape(shape), fne2.reshape(shape)
+
+    def _DM_intervals(self, *args, **kwargs):
+        "The terms are integrated separately over their own intervals"
+        return (self._object1._DM_intervals(*args, **kwargs) +
+                self._object2._DM_intervals(*args, **kwargs))
 
 
 class LocalISM(NEobject):
@@ -276,6 +1101,8 @@ class LocalISM(NEobject):
         self.loop_out = NEobject(in_half_sphere, **params['loop_out'])
 
         self.loop = self.loop_in | self.loop_out
+        for name in ('ldr', 'lsb', 'lhb', 'loop_in', 'loop_out'):
+            getattr(self, name).label = name
         self._lism = (self.lhb |
                       (self.loop |
                        (self.lsb | self.ldr)))
@@ -287,6 +1114,18 @@ class LocalISM(NEobject):
         """
         return self._lism.ne(xyz)
 
+    def ne_F(self, xyz):
+        return self._lism.ne_F(xyz)
+
+    def bounds(self):
+        return self._lism.bounds()
+
+    def intervals(self, l, b, d):
+        return self._lism.intervals(l, b, d)
+
+    def _edges(self, l, b, d):
+        return self._lism._edges(l, b, d)
+
 
 class NEobjects(NEobject):
     """
@@ -295,8 +1134,22 @@ class NEobjects(NEobject):
 
     def __init__(self, objects_file):
         """
+        Arguments:
+        - `objects_file`: Objects file, or a Table (or structured array)
+                          of the objects
         """
-        self._data = Table.read(objects_file, format='ascii')
+        if isinstance(objects_file, (Table, np.ndarray)):
+            self._file = None
+            self._data = Table(objects_file, copy=False)
+        else:
+            self._file = objects_file
+            self._data = Table.read(objects_file, format='ascii')
+
+    def digest(self):
+        "SHA1 digest of the objects file (of the table if not from a file)"
+        if self._file is None:
+            return fingerprint(self._data)
+        return ne_io.file_digest(self._file)
 
     @lzproperty
     def use_flag(self):
@@ -351,6 +1204,20 @@ class NEobjects(NEobject):
         """
         return np.array(self._data['radius'])
 
+    @lzproperty
+    def support(self):
+        """
+        Radius of the region where each object contributes (kpc)
+        """
+        return sqrt(np.where(self.edge == 0, 5, 1)*self._radius2)
+
+    @lzproperty
+    def index(self):
+        """
+        KD-tree of the locations of the objects
+        """
+        return cKDTree(self.xyz.T)
+
     @lzproperty
     def ne0(self):
         """
@@ -358,6 +1225,13 @@ class NEobjects(NEobject):
         """
         return np.array(self._data['ne'])
 
+    @lzproperty
+    def F(self):
+        """
+        Fluctuation parameter of each object
+        """
+        return np.array(self._data['F'], dtype=float)
+
     @lzproperty
     def edge(self):
         """
@@ -398,12 +1272,158 @@ class NEobjects(NEobject):
         res[q5] = exp(-q2[q5])
         return res
 
+    def _pairs(self, xyz):
+        """
+        Indices of the (point, object) pairs with the point `xyz[:, i]`
+        within the support of the object `j`
+        """
+        pairs = cKDTree(xyz.T).sparse_distance_matrix(
+            self.index, np.max(self.support), output_type='ndarray')
+        ok = pairs['v'] <= self.support[pairs['j']]
+        return pairs['i'][ok], pairs['j'][ok]
+
+    def _q2(self, xyz, i, j):
+        """
+        Squared distance of the points `xyz[:, i]` from the objects `j`
+        in units of their radius
+        """
+        return rad3d2(xyz[:, i] - self.xyz[:, j]) / self._radius2[j]
+
+    def bounds(self):
+        return (np.min(self.xyz - self.support, axis=1),
+                np.max(self.xyz + self.support, axis=1))
+
+    def _support_intervals(self, l, b, d):
+        """
+        Intervals of the sightline `l`, `b` up to `d` within the support
+        of each object (shape (n, 2))
+        """
+        uhat = galactic_to_galactocentric(l, b, 1., [0, 0, 0])
+        xyz = self.xyz - XYZ_SUN[:, None]
+        s0 = uhat.dot(xyz)
+        half2 = self.support**2 - rad3d2(xyz) + s0**2
+        ok = half2 > 0
+        half = sqrt(half2[ok])
+        intervals = np.column_stack([np.clip(s0[ok] - half, 0, d),
+                                     np.clip(s0[ok] + half, 0, d)])
+        return intervals[intervals[:, 0] < intervals[:, 1]]
+
+    def intervals(self, l, b, d):
+        return union_intervals(self._support_intervals(l, b, d))
+
+    def _edges(self, l, b, d):
+        return self._support_intervals(l, b, d).ravel()
+
+    @lzproperty
+    def transform(self):
+        """
+        Matrices mapping Galactocentric locations to coordinates where
+        each object is a unit sphere
+        """
+        return np.eye(3)[None, :, :] / self.radius[:, None, None]
+
+    @lzproperty
+    def xyz_transform(self):
+        """
+        Transformed locations of the objects
+        """
+        return self.xyz / self.radius
+
+    def sightline(self, l, b, d):
+        """ Analytic line integrals of the objects along a sightline
+
+        Candidates are the objects whose cone seen from the Sun
+        (from `gl`, `gb`, `distance` and their support) contains the
+        direction `l`, `b`.
+
+        Parameters
+        ----------
+        l : float
+          Galactic longitude (deg)
+        b : float
+          Galactic latitude (deg)
+        d : float
+          Distance (kpc)
+
+        Returns
+        -------
+        DM : ndarray
+          Contribution of each intersected object (pc cm**-3)
+        s1, s2 : ndarray
+          Distances (kpc) where the sightline enters and leaves the
+          support of each intersected object
+        index : ndarray
+          Indices of the intersected objects
+        """
+        uhat = galactic_to_galactocentric(l, b, 1., [0, 0, 0])
+        ohat = galactic_to_galactocentric(self.gl, self.gb, 1., [0, 0, 0])
+        cone = np.arcsin(np.clip(self.support/self.distance, 0, 1))
+        cone[self.support >= self.distance] = pi
+        index = np.where(np.arccos(np.clip(uhat.dot(ohat), -1, 1)) <=
+                         cone)[0]
+
+        # q(s) = q0 + s*v in the frame where the object is a unit sphere
+        q0 = (matmul(self.transform[index], XYZ_SUN) -
+              self.xyz_transform[:, index].T)
+        v = matmul(self.transform[index], uhat)
+        v2 = np.sum(v**2, axis=1)
+        s0 = -np.sum(q0*v, axis=1)/v2
+        b2 = np.sum(q0**2, axis=1) - v2*s0**2
+        # NOTE: In the original NE2001 code q2 <= 5 is used instead of q <= 5.
+        q2max = np.where(self.edge[index] == 0, 5, 1)
+        half = sqrt(np.clip(q2max - b2, 0, None)/v2)
+        s1 = np.clip(s0 - half, 0, d)
+        s2 = np.clip(s0 + half, 0, d)
+        ok = (b2 < q2max) & (s2 > s1)
+        index, s0, s1, s2, b2, v2 = (index[ok], s0[ok], s1[ok], s2[ok],
+                                     b2[ok], v2[ok])
+
+        vnorm = sqrt(v2)
+        DM = np.where(self.edge[index] == 0,
+                      exp(-b2)*sqrt(pi)/2/vnorm *
+                      (erf(vnorm*(s2 - s0)) - erf(vnorm*(s1 - s0))),
+                      s2 - s1) * self.ne0[index] * 1000
+        return DM, s1, s2, index
+
     def electron_density(self, xyz):
         """
         The contribution of the object to the free
         electron density at x, y, z = `xyz`
+
+        For many points only the (point, object) pairs found with
+        the spatial index are evaluated
+        """
+        if xyz.ndim == 1:
+            return (self._factor(xyz)*self.ne0).sum(axis=-1)
+        shape = xyz.shape[1:]
+        xyz = xyz.reshape(3, -1)
+        i, j, ne = self._pair_density(xyz)
+        return np.bincount(i, ne, minlength=xyz.shape[1]).reshape(shape)
+
+    def ne_F(self, xyz):
+        "Density and sum of the F ne**2 of the objects (see `NEobject.ne_F`)"
+        xyz = np.asarray(xyz, dtype=float)
+        self._count(xyz.size // 3)
+        if xyz.ndim == 1:
+            ne = self._factor(xyz)*self.ne0
+            return ne.sum(axis=-1), (self.F*ne**2).sum(axis=-1)
+        shape = xyz.shape[1:]
+        xyz = xyz.reshape(3, -1)
+        i, j, ne = self._pair_density(xyz)
+        return (np.bincount(i, ne, minlength=xyz.shape[1]).reshape(shape),
+                np.bincount(i, self.F[j]*ne**2,
+                            minlength=xyz.shape[1]).reshape(shape))
+
+    def _pair_density(self, xyz):
+        """
+        Pairs (i, j) of points `xyz[:, i]` and objects `j` found with the
+        spatial index, and the density of the objects at the points
         """
-        return (self._factor(xyz)*self.ne0).sum(axis=-1)
+        i, j = self._pairs(xyz)
+        q2 = self._q2(xyz, i, j)
+        # NOTE: In the original NE2001 code q2 <= 5 is used instead of q <= 5.
+        factor = np.where(self.edge[j] == 0, exp(-q2)*(q2 <= 5), q2 <= 1)
+        return i, j, factor*self.ne0[j]
 
 
 class Clumps(NEobjects):
@@ -412,10 +1432,12 @@ class Clumps(NEobjects):
 
     def __init__(self, clumps_file=None):
         """
+        Arguments:
+        - `clumps_file`: Clumps file or Table (default: the NE2001 clumps)
         """
-        if not clumps_file:
-            this_dir, _ = os.path.split(__file__)
-            clumps_file = os.path.join(this_dir, "data", "neclumpN.NE2001.dat")
+        if (not isinstance(clumps_file, (Table, np.ndarray)) and
+                not clumps_file):
+            clumps_file = CLUMPS_FILE
         super().__init__(clumps_file)
 
 
@@ -425,10 +1447,12 @@ class Voids(NEobjects):
 
     def __init__(self, voids_file=None):
         """
+        Arguments:
+        - `voids_file`: Voids file or Table (default: the NE2001 voids)
         """
-        if not voids_file:
-            this_dir, _ = os.path.split(__file__)
-            voids_file = os.path.join(this_dir, "data", "nevoidN.NE2001.dat")
+        if (not isinstance(voids_file, (Table, np.ndarray)) and
+                not voids_file):
+            voids_file = VOIDS_FILE
         super().__init__(voids_file)
 
     @lzproperty
@@ -454,6 +1478,37 @@ class Voids(NEobjects):
         """
         return 1
 
+    @lzproperty
+    def support(self):
+        """
+        Radius of the region where each void contributes (kpc)
+        """
+        return (sqrt(np.where(self.edge == 0, 5, 1)) *
+                np.max(self.ellipsoid_abc, axis=0))
+
+    @property
+    def transform(self):
+        """
+        Matrices mapping Galactocentric locations to coordinates where
+        each void is a unit sphere
+        """
+        return self.rotation
+
+    @property
+    def xyz_transform(self):
+        """
+        Transformed locations of the voids
+        """
+        return self.xyz_rot
+
+    def _q2(self, xyz, i, j):
+        """
+        Squared ellipsoidal distance of the points `xyz[:, i]`
+        from the voids `j`
+        """
+        return rad3d2(np.einsum('kab,bk->ak', self.rotation[j], xyz[:, i]) -
+                      self.xyz_rot[:, j])
+
     @lzproperty
     def rotation(self):
         """
@@ -491,35 +1546,423 @@ class ElectronDensity(NEobject):
     """
     A class holding all the elements which contribute to free electron density
     """
+    # Set on the models shared by `get`
+    _shared = False
 
-    def __init__(self, clumps_file=None, voids_file=None,
-                 **params):
+    def __init__(self, clumps_file=None, voids_file=None, backend='numpy',
+                 components=None, **params):
         """
+        Arguments:
+        - `clumps_file`: Clumps file or Table (default: the NE2001 clumps)
+        - `voids_file`: Voids file or Table (default: the NE2001 voids)
+        - `backend`: 'numpy', or 'numba' to evaluate the density with the
+                     numba kernels (`ne2001.kernels`) if numba is installed;
+                     subsets of the components and the arm grid are
+                     evaluated with numpy (with a warning)
+        - `components`: Names of the components to include (default: all
+                        of `COMPONENTS`); the data files of the others are
+                        not read
+        - `**params`: Model parameters (see `ne_io.Params`)
         """
+        if backend not in ('numpy', 'numba'):
+            raise ValueError("Unknown backend {}".format(backend))
+        if components is None:
+            components = COMPONENTS
+        unknown = set(components) - set(COMPONENTS)
+        if unknown or not components:
+            raise ValueError("Invalid components {}".format(
+                sorted(unknown) or components))
+        # Ordered as COMPONENTS
+        self._components = tuple(name for name in COMPONENTS
+                                 if name in components)
+        if backend == 'numba':
+            from . import kernels
+            if kernels.numba is None:
+                warnings.warn("numba is not installed: using the numpy "
+                              "backend")
+                backend = 'numpy'
+        self.backend = backend
+        if 'spiral_arms' not in self._components:
+            params.setdefault('arms_file', None)
         self._params = ne_io.Params(**params)
-        self._thick_disk = NEobject(thick_disk, **self.params['thick_disk'])
-        self._thin_disk = NEobject(thin_disk, **self.params['thin_disk'])
-        self._galactic_center = NEobject(gc, **self.params['galactic_center'])
-        self._lism = LocalISM(**self.params)
-        self._spiral_arms = NEobject(ne_spiral_arm,
-                                     **self.params['spiral_arms'])
-        self._clumps = Clumps(clumps_file=clumps_file)
-        self._voids = Voids(voids_file=voids_file)
-        self._combined = ((self._voids |
-                          (self._lism |
-                           (self._thick_disk +
-                            self._thin_disk +
-                            self._spiral_arms +
-                            self._galactic_center))) +
-                          self._clumps)
+
+        def component(name, build, *args, **kwargs):
+            if name in self._components:
+                return build(*args, **kwargs)
+
+        self._thick_disk = component('thick_disk', NEobject, thick_disk,
+                                     **self.params.get('thick_disk', {}))
+        self._thin_disk = component('thin_disk', NEobject, thin_disk,
+                                    **self.params.get('thin_disk', {}))
+        self._galactic_center = component(
+            'galactic_center', NEobject, gc,
+            **self.params.get('galactic_center', {}))
+        self._lism = component('lism', LocalISM, **self.params)
+        self._spiral_arms = component('spiral_arms', NEobject, ne_spiral_arm,
+                                      **self.params.get('spiral_arms', {}))
+        self._clumps = component('clumps', Clumps, clumps_file=clumps_file)
+        self._voids = component('voids', Voids, voids_file=voids_file)
+        self._combine()
+        self._cache = None
+
+    @classmethod
+    def get(cls, clumps_file=None, voids_file=None, backend='numpy',
+            components=None, **params):
+        """ Model shared by the callers with the same arguments
+
+        The models are kept in `ne2001.state.REGISTRY` (the least recently
+        used are evicted first), keyed by the content of the data files and
+        the parameters: the first call builds the model and the next ones
+        return it. The shared models cannot be modified (`use_arm_grid` and
+        `enable_cache` raise ValueError).
+
+        Parameters
+        ----------
+        See `ElectronDensity`
+
+        Returns
+        -------
+        model : ElectronDensity
+
+        """
+        from .state import REGISTRY
+        return REGISTRY.get(clumps_file, voids_file, backend, components,
+                            **params)
+
+    @classmethod
+    def invalidate(cls, clumps_file=None, voids_file=None, backend='numpy',
+                   components=None, **params):
+        """
+        Drop the shared model with these arguments (see `get`); return
+        whether it was registered. `ne2001.state.REGISTRY.clear()` drops
+        all the shared models.
+        """
+        from .state import REGISTRY
+        return REGISTRY.invalidate(clumps_file, voids_file, backend,
+                                   components, **params)
+
+    def _combine(self):
+        "Combine the components into the full model"
+        for name, obj in self.components.items():
+            obj.label = name
+        # The cached profiles were computed with the previous components
+        if getattr(self, '_cache', None) is not None:
+            self._cache.clear()
+
+        def combine(operator, *objects):
+            objects = [obj for obj in objects if obj is not None]
+            return reduce(operator, objects) if objects else None
+
+        self._smooth = combine(OR, self._lism,
+                               combine(Add, self._thick_disk,
+                                       self._thin_disk, self._spiral_arms,
+                                       self._galactic_center))
+        self._combined = combine(Add, combine(OR, self._voids, self._smooth),
+                                 self._clumps)
+        # The numba kernels implement the full model with the exact spiral
+        # arms only
+        self._kernel = None
+        if self.backend == 'numba':
+            if (len(self._components) == len(COMPONENTS) and
+                    self._spiral_arms._density_func is ne_spiral_arm):
+                from .kernels import NumbaDensity
+                self._kernel = NumbaDensity(self)
+            else:
+                warnings.warn("The numba backend only implements the full "
+                              "model with the exact spiral arms: "
+                              "evaluating with numpy")
 
     def electron_density(self, xyz):
+        if self._kernel is not None:
+            return self._kernel(xyz, RSUN)
         return self._combined.ne(xyz)
 
+    def ne_F(self, xyz):
+        self._count(np.size(xyz) // 3)
+        return self._combined.ne_F(xyz)
+
+    def part_labels(self):
+        "The names of the components"
+        return self._combined.part_labels()
+
+    def ne_parts(self, xyz):
+        """
+        Contribution of each component to the electron density, after
+        the masking of the components by the voids and the local ISM
+        (see `NEobject.ne_parts`)
+        """
+        self._count(np.size(xyz) // 3)
+        return self._combined.ne_parts(xyz)
+
+    def compile(self, use_numexpr=None):
+        """ Compile the model into a single evaluator
+
+        The compiled densities match those of the model to rounding (the
+        operations are reordered). See `ne2001.compiled.compile_density`
+
+        Parameters
+        ----------
+        use_numexpr : bool, optional
+          Evaluate the analytic components with numexpr; by default if
+          it is installed
+
+        Returns
+        -------
+        compiled : CompiledDensity
+
+        """
+        from .compiled import compile_density
+        return compile_density(self, use_numexpr)
+
+    def map_DM(self, l, b, d, workers=None, **kwargs):
+        """ Calculate the dispersion measures of many sightlines with a
+        pool of processes sharing the model arrays
+
+        See `ne2001.parallel.map_DM`
+
+        Parameters
+        ----------
+        l : array_like or Angle
+          Galactic longitudes; assumed deg if unitless
+        b : array_like or Angle
+          Galactic latitudes; assumed deg if unitless
+        d : array_like or Quantity
+          Distances to the sources; assumed kpc if unitless
+        workers : int, optional
+          Number of processes (default: the number of CPUs)
+
+        Returns
+        -------
+        DM : Quantity
+          Dispersion Measures with units pc cm**-3
+
+        """
+        from .parallel import map_DM
+        return map_DM(self, l, b, d, workers=workers, **kwargs)
+
+    @property
+    def components(self):
+        "The components of the model by name"
+        return dict((name, getattr(self, '_' + name))
+                    for name in self._components)
+
+    def npoints_by_component(self):
+        "Number of points where each component was evaluated"
+        return {name: obj.npoints for name, obj in self.components.items()}
+
+    def reset_npoints(self):
+        "Reset the evaluation counters of the model and its components"
+        for obj in list(self.components.values()) + [self]:
+            obj.npoints = 0
+
+    def bounds(self):
+        return self._combined.bounds()
+
+    def intervals(self, l, b, d):
+        return self._combined.intervals(l, b, d)
+
+    def _edges(self, l, b, d):
+        return self._combined._edges(l, b, d)
+
+    def _DM_intervals(self, *args, **kwargs):
+        return self._combined._DM_intervals(*args, **kwargs)
+
+    def use_arm_grid(self, step=0.05, extent=20., cache=True):
+        """ Evaluate the spiral arms with a lookup table of their in-plane
+        factor (see `spiral_arms.SpiralArmGrid`)
+
+        Parameters
+        ----------
+        step : float, optional
+          Grid step (kpc)
+        extent : float, optional
+          Half side of the grid (kpc); points beyond are evaluated exactly
+        cache : bool, optional
+          Read and write the table from the cache directory
+
+        Returns
+        -------
+        grid : SpiralArmGrid
+          The table; `max_error` is its maximal interpolation error
+
+        """
+        self._check_arms()
+        self._spiral_arms = NEobject(ne_spiral_arm_grid, step=step,
+                                     extent=extent, cache=cache,
+                                     **self.params['spiral_arms'])
+        self._combine()
+        return self._spiral_arms._func
+
+    def use_exact_arms(self):
+        "Evaluate the spiral arms exactly (undo `use_arm_grid`)"
+        self._check_arms()
+        self._spiral_arms = NEobject(ne_spiral_arm,
+                                     **self.params['spiral_arms'])
+        self._combine()
+
+    def _check_arms(self):
+        self._check_shared()
+        if self._spiral_arms is None:
+            raise ValueError("The model has no spiral arms")
+
+    def _check_shared(self):
+        if self._shared:
+            raise ValueError("The models of ElectronDensity.get are shared "
+                             "and cannot be modified")
+
+    def enable_cache(self, maxsize=128, angle_tol=0.01, step_size=0.001,
+                     dmax=100., max_samples=2**23):
+        """ Answer `DM` and `dist` from cached cumulative DM profiles
+
+        Parameters
+        ----------
+        maxsize : int, optional
+          Maximal number of cached directions (least recently used
+          are evicted first)
+        angle_tol : float, optional
+          Angular quantization of the directions (deg)
+        step_size : float, optional
+          Sampling step of the profiles (kpc)
+        dmax : float, optional
+          Maximal extent of the profiles (kpc)
+        max_samples : int, optional
+          Maximal total number of cached samples (least recently used
+          profiles are evicted first)
+
+        Returns
+        -------
+        cache : DMProfileCache
+
+        """
+        self._check_shared()
+        self._cache = DMProfileCache(self, maxsize=maxsize,
+                                     angle_tol=angle_tol,
+                                     step_size=step_size, dmax=dmax,
+                                     max_samples=max_samples)
+        return self._cache
+
+    def disable_cache(self):
+        "Drop the DM profile cache"
+        self._check_shared()
+        self._cache = None
+
+    def cache_info(self):
+        "Statistics of the DM profile cache (None if disabled)"
+        if self._cache is not None:
+            return self._cache.info()
+
+    @instrumented_DM
+    def DM(self, l, b, d, *args, **kwargs):
+        """ Calculate the dispersion measure towards direction l,b
+
+        If the cache is enabled, the DM is interpolated from the cached
+        profile and the integration arguments are ignored.
+        With `analytic_objects=True` the clumps and voids are integrated
+        analytically (see `DM_analytic_objects`). With `breakdown=True`
+        the DM of each component is returned as a dict, computed with a
+        sampling integrator over arrays of sightlines (see `DM_breakdown`).
+        See `NEobject.DM`
+        """
+        if kwargs.pop('analytic_objects', False):
+            return self.DM_analytic_objects(l, b, d, *args, **kwargs)
+        if kwargs.pop('breakdown', False):
+            # The integration options of DM and DM_breakdown differ
+            unsupported = sorted(set(kwargs) - set(BREAKDOWN_OPTIONS))
+            if args or unsupported:
+                raise TypeError(
+                    "DM(..., breakdown=True) only takes the keyword "
+                    "arguments {} (got {})".format(
+                        ', '.join(BREAKDOWN_OPTIONS),
+                        ', '.join(unsupported) or 'positional arguments'))
+            return self.DM_breakdown(l, b, d, **kwargs)
+        if self._cache is None:
+            return super().DM(l, b, d, *args, **kwargs)
+        l, b, d = parse_lbd(l, b, d)
+        return self._cache.DM(l, b, d) * DM_unit
+
+    def DM_analytic_objects(self, l, b, d, epsrel=1e-4, epsabs=1e-6,
+                            integrator=quad, step_size=0.001,
+                            *arg, **kwargs):
+        """ Calculate the dispersion measure towards direction l,b
+        with the clumps and voids integrated analytically
+
+        The clumps and voids intersected by the sightline contribute their
+        exact line integrals (error functions for the Gaussian profiles and
+        chord lengths for the uniform ones). The smooth components are
+        integrated numerically only outside the voids, which replace them.
+
+        Parameters
+        ----------
+        See `NEobject.DM`
+
+        Returns
+        -------
+        DM : Quantity
+          Dispersion Measure with units pc cm**-3
+
+        """
+        l, b, d = parse_lbd(l, b, d)
+        DM_clumps = DM_voids = s1 = s2 = np.zeros(0)
+        masked = np.zeros(0, dtype=bool)
+        if self._clumps is not None:
+            DM_clumps = self._clumps.sightline(l, b, d)[0]
+        if self._voids is not None:
+            DM_voids, s1, s2, index = self._voids.sightline(l, b, d)
+            # The smooth components are masked where the voids density > 0
+            masked = self._voids.ne0[index] > 0
+        if self._smooth is None:
+            return (DM_clumps.sum() + DM_voids.sum()) * DM_unit
+
+        edges = np.unique(np.concatenate([[0, d], s1[masked], s2[masked]]))
+        mid = (edges[1:] + edges[:-1])/2
+        gaps = ~np.any((mid[:, None] >= s1[masked]) &
+                       (mid[:, None] <= s2[masked]), axis=1)
+
+        uhat = galactic_to_galactocentric(l, b, 1., [0, 0, 0])
+        DM = 0
+        for s_lo, s_hi in zip(edges[:-1][gaps], edges[1:][gaps]):
+            if integrator.__name__ == 'quad':
+                DM += integrator(
+                    lambda s: self._smooth.ne(XYZ_SUN + s*uhat), s_lo, s_hi,
+                    *arg, epsrel=epsrel, epsabs=epsabs, **kwargs)[0]*1000
+            else:
+                nsamp = int(max(1000, (s_hi - s_lo)/step_size))
+                s = np.linspace(s_lo, s_hi, nsamp + 1)
+                ne = self._smooth.ne(XYZ_SUN[:, None] + uhat[:, None]*s)
+                DM += integrator(ne)*(s[1] - s[0])*1000
+        return (DM + DM_clumps.sum() + DM_voids.sum()) * DM_unit
+
+    def dist(self, l, b, DM, *args, **kwargs):
+        """ Estimate the distance to an object with dispersion measure `DM`
+        Located at the direction `l ,b'
+
+        If the cache is enabled, the distance is interpolated from the
+        cached profile. See `NEobject.dist`
+        """
+        if self._cache is None:
+            return super().dist(l, b, DM, *args, **kwargs)
+        l, b, _ = parse_lbd(l, b, 0)
+        return self._cache.dist(l, b, parse_DM(DM)) * d_unit
+
     @property
     def params(self):
         return self._params
 
+    @lzproperty
+    def fingerprint(self):
+        """
+        SHA1 digest identifying the parameters, the components, the clumps
+        and voids files and the position of the Sun
+        """
+        sha = hashlib.sha1(self.params.fingerprint().encode())
+        if self._components != COMPONENTS:
+            sha.update(' '.join(self._components).encode())
+        for objects in (self._clumps, self._voids):
+            if objects is not None:
+                sha.update(objects.digest().encode())
+        sha.update(np.asarray(XYZ_SUN, dtype=float).tobytes())
+        return sha.hexdigest()
+
 
 class Ellipsoid(object):
     """
@@ -542,10 +1985,7 @@ class Ellipsoid(object):
         Test if xyz in the ellipsoid
         Theta in radians
         """
-        try:
-            xyz = xyz - self.center
-        except ValueError:
-            xyz = xyz - self.center[:, None]
+        xyz = relative_to(xyz, self.center)
 
         xyz = matmul(self.transform, xyz)
 
@@ -562,13 +2002,11 @@ def in_cylinder(xyz, center, cylinder, theta):
     Theta in radians
     """
     xyz0 = xyz
-    try:
-        xyz = xyz - center
-    except ValueError:
-        xyz = xyz - center[:, None]
-        cylinder = np.vstack([cylinder]*xyz.shape[-1]).T
+    xyz = relative_to(xyz, center)
     xyz[1] -= tan(theta)*xyz0[-1]
-    cylinder_p = cylinder
+    # Copy so that the parameters are not modified in place
+    cylinder_p = np.empty(xyz.shape)
+    cylinder_p[:] = np.reshape(cylinder, (3,) + (1,)*(xyz.ndim - 1))
     z_c = (center[-1] - cylinder[-1])
     izz = (xyz0[-1] <= 0)*(xyz0[-1] >= z_c)
     cylinder_p[0] = (0.001 +
@@ -582,10 +2020,7 @@ def in_cylinder(xyz, center, cylinder, theta):
 def in_half_sphere(xyz, center, radius):
     "Test if `xyz` in the sphere with radius r_sphere  centerd at `xyz_center`"
     xyz0 = xyz
-    try:
-        xyz = xyz - center
-    except ValueError:
-        xyz = xyz - center[:, None]
+    xyz = relative_to(xyz, center)
     distance2 = rad3d2(xyz)
     return (distance2 <= radius**2)*(xyz0[-1] >= 0)
 
@@ -604,3 +2039,53 @@ def object_factor(xyz, xyz0, r2, edge):
     res = 1.0*(q2 <= 1)*(edge == 1)
     res[q5] = exp(-q2[q5])
     return res
+
+
+def thick_disk_bounds(radius, height):
+    "Box outside which `thick_disk` vanishes"
+    return (np.array([-radius, -radius, -np.inf]),
+            np.array([radius, radius, np.inf]))
+
+
+def thin_disk_bounds(radius, height):
+    "Box outside which `thin_disk` vanishes"
+    return (np.array([-radius - 20., -radius - 20., -40.]),
+            np.array([radius + 20., radius + 20., 40.]))
+
+
+def gc_bounds(center, radius, height):
+    "Box outside which `gc` vanishes"
+    half = np.array([radius, radius, height])
+    return np.asarray(center) - half, np.asarray(center) + half
+
+
+def in_ellipsoid_bounds(center, ellipsoid, theta):
+    "Box bounding the ellipsoid"
+    half = np.sqrt(np.sum(np.linalg.inv(
+        Ellipsoid(center, ellipsoid, theta).transform)**2, axis=1))
+    return np.asarray(center) - half, np.asarray(center) + half
+
+
+def in_cylinder_bounds(center, cylinder, theta):
+    "Box bounding the (sheared and tapered) cylinder"
+    center = np.asarray(center)
+    z = center[-1] + np.array([-1, 1])*cylinder[-1]
+    y = center[1] + tan(theta)*z
+    return (np.array([center[0] - cylinder[0], y.min() - cylinder[1], z[0]]),
+            np.array([center[0] + cylinder[0], y.max() + cylinder[1], z[1]]))
+
+
+def in_half_sphere_bounds(center, radius):
+    "Box bounding the upper half sphere"
+    lo = np.asarray(center) - radius
+    lo[-1] = max(lo[-1], 0)
+    return lo, np.asarray(center) + radius
+
+
+# Boxes outside which the density functions vanish, used by `NEobject.bounds`
+BOUNDS = {thick_disk: thick_disk_bounds,
+          thin_disk: thin_disk_bounds,
+          gc: gc_bounds,
+          in_ellipsoid: in_ellipsoid_bounds,
+          in_cylinder: in_cylinder_bounds,
+          in_half_sphere: in_half_sphere_bounds}
@@ -0,0 +1,196 @@
+""" Opt-in evaluation counters and timers
+
+Within an `instrument()` block, every evaluation of an `NEobject` (the
+components, their `OR` and `Add` combinations, `LocalISM`, the clumps and
+voids, and the model itself) is recorded under the label of the object,
+and every `DM` call records its number of integrand evaluations and the
+integration warnings::
+
+    with instrument() as stats:
+        model.DM(30, 2, 10)
+    print(stats.report())
+
+Outside such a block the only cost is a test of the global `ACTIVE`.
+The evaluations made by other processes (`ne2001.parallel`) are not
+recorded.
+"""
+import json
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+# The Stats being recorded (None if disabled)
+ACTIVE = None
+
+# Counters of each component
+FIELDS = ('calls', 'points', 'masked', 'nonzero', 'time', 'self_time')
+
+
+class Stats(object):
+    """
+    Evaluation statistics
+
+    `components` maps the label of each evaluated object to its counters:
+    - `calls`: Number of evaluations
+    - `points`: Number of points evaluated
+    - `masked`: Number of points of the enclosing combination which were
+                not passed to the object (outside its bounds, or where the
+                left object of an `OR` is positive)
+    - `nonzero`: Number of points where the density is positive
+    - `time`: Wall time (s) of the evaluations, sub-objects included
+    - `self_time`: Wall time (s) of the evaluations, sub-objects excluded
+
+    `DM_calls` holds one dict per `DM` call with its sightline, integrator
+    (its name, or 'breakdown' for `DM(..., breakdown=True)`), wall time, number of integrand evaluations (`neval`) and of points
+    evaluated, and the warnings raised (e.g. by `quad`).
+    """
+
+    def __init__(self):
+        self.components = {}
+        self.DM_calls = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _counters(self, obj):
+        label = obj.label
+        counters = self.components.get(label)
+        if counters is None:
+            counters = self.components[label] = dict.fromkeys(FIELDS, 0)
+        return counters
+
+    def evaluate(self, obj, xyz):
+        "Evaluate and record `obj.electron_density(xyz)`"
+        stack = self._local.__dict__.setdefault('stack', [])
+        dm = getattr(self._local, 'dm', None)
+        npoints = np.size(xyz) // 3
+        if dm is not None and not stack:
+            # Evaluation of the integrand of a DM call
+            dm['neval'] += 1
+            dm['points'] += npoints
+        stack.append(0.)
+        start = time.perf_counter()
+        try:
+            ne = obj.electron_density(xyz)
+        finally:
+            elapsed = time.perf_counter() - start
+            child_time = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+        with self._lock:
+            counters = self._counters(obj)
+            counters['calls'] += 1
+            counters['points'] += npoints
+            counters['nonzero'] += int(np.count_nonzero(np.asarray(ne) > 0))
+            counters['time'] += elapsed
+            counters['self_time'] += elapsed - child_time
+        return ne
+
+    def mask(self, obj, npoints):
+        "Record that `npoints` points were not passed to `obj`"
+        if npoints:
+            with self._lock:
+                self._counters(obj)['masked'] += npoints
+
+    def DM(self, method, obj, l, b, d, args, kwargs):
+        "Call and record `method(obj, l, b, d, *args, **kwargs)`"
+        if getattr(self._local, 'dm', None) is not None:
+            # Nested call (e.g. ElectronDensity.DM calling NEobject.DM)
+            return method(obj, l, b, d, *args, **kwargs)
+        integrator = kwargs.get('integrator', args[2] if len(args) > 2
+                                else None)
+        if kwargs.get('breakdown'):
+            integrator = 'breakdown'
+        elif not isinstance(integrator, str):
+            # Function, or the default quad
+            integrator = getattr(integrator, '__name__', 'quad')
+        dm = dict(l=_float(l), b=_float(b), d=_float(d),
+                  integrator=integrator, neval=0, points=0, time=0., warnings=[])
+        self._local.dm = dm
+        start = time.perf_counter()
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                result = method(obj, l, b, d, *args, **kwargs)
+        finally:
+            dm['time'] = time.perf_counter() - start
+            self._local.dm = None
+            with self._lock:
+                self.DM_calls.append(dm)
+        for warning in caught:
+            dm['warnings'].append('{}: {}'.format(warning.category.__name__,
+                                                  warning.message))
+            warnings.warn_explicit(warning.message, warning.category,
+                                   warning.filename, warning.lineno)
+        return result
+
+    def as_dict(self):
+        "Statistics as a dict"
+        with self._lock:
+            return dict(components=dict((label, dict(counters))
+                                        for label, counters
+                                        in self.components.items()),
+                        DM_calls=[dict(dm, warnings=list(dm['warnings']))
+                                  for dm in self.DM_calls])
+
+    def to_json(self, **kwargs):
+        "Statistics as JSON (`kwargs` are passed to `json.dumps`)"
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def report(self):
+        "Table of the component counters, slowest first"
+        lines = ['{:>10} {:>12} {:>12} {:>12} {:>10} {:>10}  {}'.format(
+            'calls', 'points', 'masked', 'nonzero', 'time', 'self_time',
+            'component')]
+        for label, counters in sorted(self.components.items(),
+                                      key=lambda item: -item[1]['time']):
+            lines.append(
+                '{calls:10d} {points:12d} {masked:12d} {nonzero:12d} '
+                '{time:10.4f} {self_time:10.4f}  '.format(**counters) + label)
+        if self.DM_calls:
+            lines.append('{} DM calls: {} integrand evaluations, '
+                         '{} warnings'.format(
+                             len(self.DM_calls),
+                             sum(dm['neval'] for dm in self.DM_calls),
+                             sum(len(dm['warnings'])
+                                 for dm in self.DM_calls)))
+        return '\n'.join(lines)
+
+
+def _float(value):
+    "Plain float (or list) of a number, Quantity or Angle"
+    value = np.asarray(getattr(value, 'value', value), dtype=float)
+    return value.tolist()
+
+
+@contextmanager
+def instrument():
+    """ Record the evaluations within the block
+
+    Returns
+    -------
+    stats : Stats
+      The statistics, updated until the end of the block
+
+    """
+    global ACTIVE
+    previous = ACTIVE
+    ACTIVE = stats = Stats()
+    try:
+        yield stats
+    finally:
+        ACTIVE = previous
+
+
+def instrumented_DM(method):
+    "Record the calls of the DM method `method` within `instrument()`"
+    @wraps(method)
+    def DM(self, l, b, d, *args, **kwargs):
+        stats = ACTIVE
+        if stats is None:
+            return method(self, l, b, d, *args, **kwargs)
+        return stats.DM(method, self, l, b, d, args, kwargs)
+    return DM
@@ -0,0 +1,261 @@
+""" Integrators of many sightlines at once, selected by name
+
+All the integrators share the interface
+
+    integral, error = integrator(func, a, b, epsrel=1e-4, epsabs=1e-6,
+                                 step_size=0.001, block_size=2**14,
+                                 **options)
+
+where `func(rows, s)` evaluates the integrand of the sightlines `rows`
+(1d array of indices) at the abscissae `s` (shape (len(rows), n)), and `a`
+and `b` are the integration bounds of each sightline. They return the
+integrals and an estimate of their absolute errors, per sightline. The
+integrand is evaluated on at most about `block_size` points at once.
+
+- `quad`: scipy's adaptive QUADPACK, one sightline at a time
+- `trapezoid` and `simpson`: sampling with a step of at most `step_size`
+  and at least `nsamp` samples; the error is estimated by comparison with
+  every other sample (Richardson)
+- `gauss-legendre`: fixed `order` Gauss-Legendre on panels of at most
+  `step_size*order`; the error is estimated with half the order
+- `gauss-kronrod`: adaptive 7-15 Gauss-Kronrod, bisecting the intervals of
+  all the unconverged sightlines together
+
+`epsrel` and `epsabs` only apply to the adaptive integrators, and
+`step_size` to the fixed ones. `INTEGRATORS` maps the names to the
+functions; `register` adds new ones.
+"""
+import warnings
+
+import numpy as np
+from scipy.integrate import IntegrationWarning
+from scipy.integrate import quad as _quad
+
+try:
+    from scipy.integrate import simpson as simpson_rule
+    from scipy.integrate import trapezoid as trapezoid_rule
+except ImportError:  # SciPy < 1.6
+    from scipy.integrate import simps as simpson_rule
+    from scipy.integrate import trapz as trapezoid_rule
+
+# Integrators by name
+INTEGRATORS = {}
+
+# Nodes and weights of the 15-point Kronrod rule and of the embedded
+# 7-point Gauss rule (QUADPACK qk15), for the abscissae 0, +-XGK
+XGK = np.array([0.991455371120812639206854697526329,
+                0.949107912342758524526189684047851,
+                0.864864423359769072789712788640926,
+                0.741531185599394439863864773280788,
+                0.586087235467691130294144845693013,
+                0.405845151377397166906606412076961,
+                0.207784955007898467600689403773245,
+                0.000000000000000000000000000000000])
+WGK = np.array([0.022935322010529224963732008058970,
+                0.063092092629978553290700663189204,
+                0.104790010322250183839876322541518,
+                0.140653259715525918745189590510238,
+                0.169004726639267902826583426598550,
+                0.190350578064785409913256402421014,
+                0.204432940075298892414161999234649,
+                0.209482141084727828012999174891714])
+WG = np.array([0.129484966168869693270611432679082,
+               0.279705391489276667901467771423780,
+               0.381830050505118944950369775488975,
+               0.417959183673469387755102040816327])
+
+# The 15 nodes on [-1, 1], their Kronrod weights and the Gauss weights
+# (0 on the Kronrod-only nodes)
+_NODES_K15 = np.concatenate([-XGK[:-1], XGK[::-1]])
+_WEIGHTS_K15 = np.concatenate([WGK[:-1], WGK[::-1]])
+_WEIGHTS_G7 = np.zeros(15)
+_WEIGHTS_G7[1:7:2] = WG[:3]
+_WEIGHTS_G7[7] = WG[3]
+_WEIGHTS_G7[9:15:2] = WG[2::-1]
+
+
+def register(name):
+    "Decorator registering an integrator under the name `name`"
+    def decorator(func):
+        INTEGRATORS[name] = func
+        return func
+    return decorator
+
+
+def get_integrator(name):
+    "Integrator named `name`; raise ValueError if unknown"
+    try:
+        return INTEGRATORS[name]
+    except KeyError:
+        raise ValueError("Unknown integrator {} (one of {})".format(
+            name, ', '.join(sorted(INTEGRATORS))))
+
+
+def _evaluate(func, rows, s, block_size):
+    "`func(rows, s)` evaluated on blocks of at most `block_size` points"
+    if rows.size*s.shape[1] <= block_size:
+        return func(rows, s)
+    step = max(1, block_size // s.shape[1])
+    return np.concatenate([func(rows[i:i + step], s[i:i + step])
+                           for i in range(0, rows.size, step)])
+
+
+def _groups(length, step_size, nmin):
+    """
+    Split the sightlines of lengths `length` into groups sampled with the
+    same number of steps: `nmin` times a power of 2, so that the step is
+    at most `step_size`
+
+    Yields the indices of the sightlines and their number of steps.
+    """
+    with np.errstate(divide='ignore'):
+        k = np.ceil(np.log2(np.maximum(length/(step_size*nmin), 1)))
+    for ki in np.unique(k):
+        yield np.flatnonzero(k == ki), int(nmin*2**ki)
+
+
+def _sampled(rule, order, func, a, b, step_size, nsamp, block_size):
+    "Integrals and Richardson error estimates of a sampling rule"
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float),
+                               np.asarray(b, dtype=float))
+    integral = np.zeros(a.shape)
+    error = np.zeros(a.shape)
+    # Even numbers of steps, for the comparison with every other sample
+    nmin = 2*int(np.ceil(nsamp/2))
+    for rows, n in _groups(b - a, step_size, nmin):
+        x = np.linspace(0, 1, n + 1)
+        length = (b - a)[rows]
+        values = _evaluate(func, rows, a[rows, None] + length[:, None]*x,
+                           block_size)
+        fine = rule(values, dx=x[1], axis=-1)*length
+        coarse = rule(values[:, ::2], dx=x[2], axis=-1)*length
+        integral[rows] = fine
+        error[rows] = np.abs(fine - coarse)/(2**order - 1)
+    return integral, error
+
+
+@register('trapezoid')
+def trapezoid(func, a, b, epsrel=1e-4, epsabs=1e-6, step_size=0.001,
+              block_size=2**14, nsamp=1000):
+    "Trapezoidal rule with at least `nsamp` steps of at most `step_size`"
+    return _sampled(trapezoid_rule, 2, func, a, b, step_size, nsamp, block_size)
+
+
+@register('simpson')
+def simpson(func, a, b, epsrel=1e-4, epsabs=1e-6, step_size=0.001,
+            block_size=2**14, nsamp=1000):
+    "Simpson's rule with at least `nsamp` steps of at most `step_size`"
+    return _sampled(simpson_rule, 4, func, a, b, step_size, nsamp, block_size)
+
+
+@register('gauss-legendre')
+def gauss_legendre(func, a, b, epsrel=1e-4, epsabs=1e-6, step_size=0.001,
+                   block_size=2**14, order=8, npanels=16):
+    """
+    Composite Gauss-Legendre rule of order `order` on at least `npanels`
+    panels of at most `step_size*order`
+    """
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float),
+                               np.asarray(b, dtype=float))
+    integral = np.zeros(a.shape)
+    error = np.zeros(a.shape)
+    rules = [np.polynomial.legendre.leggauss(n)
+             for n in (order, max(1, order // 2))]
+    for rows, n in _groups(b - a, step_size*order, npanels):
+        panels = np.linspace(0, 1, n + 1)
+        length = (b - a)[rows]
+        results = []
+        for nodes, weights in rules:
+            # Abscissae (in units of the sightline length) by panel and node
+            x = (panels[:-1, None] + (nodes + 1)/2/n).ravel()
+            values = _evaluate(func, rows, a[rows, None] + length[:, None]*x,
+                               block_size)
+            results.append(values.dot(np.tile(weights, n))/2/n*length)
+        integral[rows] = results[0]
+        error[rows] = np.abs(results[0] - results[1])
+    return integral, error
+
+
+@register('quad')
+def quad(func, a, b, epsrel=1e-4, epsabs=1e-6, step_size=0.001,
+         block_size=2**14, limit=50):
+    "scipy.integrate.quad of each sightline"
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float),
+                               np.asarray(b, dtype=float))
+    integral = np.zeros(a.shape)
+    error = np.zeros(a.shape)
+    for i in range(a.size):
+        rows = np.array([i])
+        integral[i], error[i] = _quad(
+            lambda s: func(rows, np.array([[s]]))[0, 0], a[i], b[i],
+            epsrel=epsrel, epsabs=epsabs, limit=limit)
+    return integral, error
+
+
+def _kronrod(func, rows, lo, hi, block_size):
+    "15-point Kronrod and 7-point Gauss integrals over [lo, hi]"
+    half = (hi - lo)/2
+    values = _evaluate(func, rows,
+                       (lo + half)[:, None] + half[:, None]*_NODES_K15,
+                       block_size)
+    return values.dot(_WEIGHTS_K15)*half, values.dot(_WEIGHTS_G7)*half
+
+
+@register('gauss-kronrod')
+def gauss_kronrod(func, a, b, epsrel=1e-4, epsabs=1e-6, step_size=0.001,
+                  block_size=2**14, initial=16, limit=1000):
+    """ Adaptive 7-15 Gauss-Kronrod rule vectorized over the sightlines
+
+    The sightlines start with `initial` intervals. At each iteration, the
+    intervals of all the sightlines whose total error exceeds
+    max(epsabs, epsrel*|integral|) are evaluated together, and those
+    contributing more than their share (by length) of that tolerance are
+    bisected, largest errors first, up to `limit` intervals per sightline. An
+    IntegrationWarning is raised if the final error of some sightlines
+    exceeds their tolerance.
+    """
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float),
+                               np.asarray(b, dtype=float))
+    shape = a.shape
+    a, b = a.ravel(), b.ravel()
+    n = a.size
+    length = b - a
+    edges = a[:, None] + length[:, None]*np.linspace(0, 1, initial + 1)
+    rows = np.repeat(np.arange(n), initial)
+    lo, hi = edges[:, :-1].ravel(), edges[:, 1:].ravel()
+    # Integrals and errors of the accepted intervals
+    integral = np.zeros(n)
+    error = np.zeros(n)
+    nintervals = np.full(n, initial)
+    while rows.size:
+        kronrod, gauss = _kronrod(func, rows, lo, hi, block_size)
+        err = np.abs(kronrod - gauss)
+        total = integral + np.bincount(rows, kronrod, minlength=n)
+        total_err = error + np.bincount(rows, err, minlength=n)
+        tol = np.maximum(epsabs, epsrel*np.abs(total))
+        active = (total_err > tol) & (nintervals < limit)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            split = active[rows] & (err > tol[rows]*(hi - lo)/length[rows])
+        # At most limit - nintervals bisections per sightline
+        order = np.flatnonzero(split)
+        order = order[np.lexsort((-err[order], rows[order]))]
+        rank = (np.arange(order.size) -
+                np.searchsorted(rows[order], rows[order]))
+        split[order[rank >= (limit - nintervals)[rows[order]]]] = False
+        keep = ~split
+        integral += np.bincount(rows[keep], kronrod[keep], minlength=n)
+        error += np.bincount(rows[keep], err[keep], minlength=n)
+        nintervals += np.bincount(rows[split], minlength=n)
+        mid = (lo[split] + hi[split])/2
+        rows = np.repeat(rows[split], 2)
+        lo = np.stack([lo[split], mid], axis=-1).ravel()
+        hi = np.stack([mid, hi[split]], axis=-1).ravel()
+    # Also when no interval exceeded its share of a tolerance which
+    # decreased after their errors were accepted
+    unconverged = np.count_nonzero(error > np.maximum(epsabs,
+                                                      epsrel*np.abs(integral)))
+    if unconverged:
+        warnings.warn("{} sightlines did not reach the required accuracy "
+                      "(limit of {} intervals)".format(unconverged, limit),
+                      IntegrationWarning)
+    return integral.reshape(shape), error.reshape(shape)
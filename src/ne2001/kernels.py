@@ -0,0 +1,356 @@
+""" Numba kernels of the electron density model
+
+The whole density (voids, local ISM, disks, spiral arms, Galactic center
+and clumps) is evaluated point by point in a single loop parallelized over
+the cores with numba. The compiled functions are cached on disk so that
+the JIT compilation is paid once. The nearest polyline point of each arm
+is found by brute force among the points of the arms whose bounding box
+(widened by the arm width cut-off) contains the point, instead of the
+KD-trees of `spiral_arms.ArmSearch`.
+"""
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def njit(parallel=False):
+    "numba.njit with cached compilation; no-op without numba"
+    if numba is None:
+        return lambda func: func
+    return numba.njit(parallel=parallel, cache=True)
+
+
+prange = range if numba is None else numba.prange
+
+
+@njit()
+def thick_disk(x, y, z, radius, height, rsun):
+    "See `density.thick_disk`"
+    r_ratio = math.sqrt(x**2 + y**2)/radius
+    if r_ratio >= 1:
+        return 0.
+    return (math.cos(r_ratio*math.pi/2)/math.cos(rsun*math.pi/2/radius) /
+            math.cosh(z/height)**2)
+
+
+@njit()
+def thin_disk(x, y, z, radius, height):
+    "See `density.thin_disk`"
+    rad2 = math.sqrt(x**2 + y**2)
+    if abs(radius - rad2) > 20. or abs(z) > 40:
+        return 0.
+    return math.exp(-(radius - rad2)**2/1.8**2)/math.cosh(z/height)**2
+
+
+@njit()
+def gc(x, y, z, cx, cy, cz, radius, height):
+    "See `density.gc`"
+    r_ratio2 = ((x - cx)**2 + (y - cy)**2)/radius**2
+    if r_ratio2 + ((z - cz)/height)**2 < 1 and r_ratio2 <= 1:
+        return 1.
+    return 0.
+
+
+@njit()
+def in_ellipsoid(x, y, z, transform, center):
+    "See `density.in_ellipsoid`"
+    q2 = 0.
+    for i in range(3):
+        q2 += (transform[i, 0]*(x - center[0]) +
+               transform[i, 1]*(y - center[1]) +
+               transform[i, 2]*(z - center[2]))**2
+    return q2 <= 1
+
+
+@njit()
+def in_cylinder(x, y, z, center, cylinder, theta):
+    "See `density.in_cylinder`"
+    z_c = center[2] - cylinder[2]
+    cylinder_x = cylinder[0]
+    if z <= 0 and z >= z_c:
+        cylinder_x = 0.001 + (cylinder[0] - 0.001)*(1 - z/z_c)
+    return (((x - center[0])/cylinder_x)**2 +
+            ((y - center[1] - math.tan(theta)*z)/cylinder[1])**2 <= 1 and
+            ((z - center[2])/cylinder[2])**2 <= 1)
+
+
+@njit()
+def in_half_sphere(x, y, z, center, radius):
+    "See `density.in_half_sphere`"
+    return ((x - center[0])**2 + (y - center[1])**2 + (z - center[2])**2 <=
+            radius**2 and z >= 0)
+
+
+@njit()
+def lism(x, y, z, ne0, cylinder, spheres, transforms, centers):
+    """
+    See `density.LocalISM`: the first non zero of the local hot bubble,
+    the loop (inner and outer), the low density and the low density region
+    """
+    if ne0[0] > 0 and in_cylinder(x, y, z, cylinder[:3], cylinder[3:6],
+                                  cylinder[6]):
+        return ne0[0]
+    for k in range(2):
+        if ne0[1 + k] > 0 and in_half_sphere(x, y, z, spheres[k, :3],
+                                             spheres[k, 3]):
+            return ne0[1 + k]
+    for k in range(2):
+        if ne0[3 + k] > 0 and in_ellipsoid(x, y, z, transforms[k],
+                                           centers[k]):
+            return ne0[3 + k]
+    return 0.
+
+
+@njit()
+def objects(x, y, z, xyz, transforms, xyz_transform, support2, ne0, edge):
+    """
+    See `density.NEobjects`: density of the objects centered at `xyz`,
+    with the squared distance in units of the object size measured in the
+    frame transformed by `transforms` (`xyz_transform` are the transformed
+    centers)
+    """
+    ne = 0.
+    for j in range(ne0.size):
+        d2 = (x - xyz[0, j])**2 + (y - xyz[1, j])**2 + (z - xyz[2, j])**2
+        if d2 > support2[j]:
+            continue
+        q2 = 0.
+        for i in range(3):
+            q2 += (transforms[j, i, 0]*x + transforms[j, i, 1]*y +
+                   transforms[j, i, 2]*z - xyz_transform[i, j])**2
+        # NOTE: In the original NE2001 code q2 <= 5 is used instead of q <= 5.
+        if edge[j] == 0 and q2 <= 5:
+            ne += ne0[j]*math.exp(-q2)
+        elif edge[j] == 1 and q2 <= 1:
+            ne += ne0[j]
+    return ne
+
+
+@njit()
+def min_dist2(c, x, y, s0, s1, nstart, niter):
+    "See `spiral_arms._min_dist2` (one point, `c` with shape (2, 4))"
+    s = s0
+    dist2 = np.inf
+    for i in range(nstart):
+        si = s0 + (s1 - s0)*(i/(nstart - 1))
+        dx = ((c[0, 0]*si + c[0, 1])*si + c[0, 2])*si + c[0, 3] - x
+        dy = ((c[1, 0]*si + c[1, 1])*si + c[1, 2])*si + c[1, 3] - y
+        if dx*dx + dy*dy < dist2:
+            s = si
+            dist2 = dx*dx + dy*dy
+    dx = ((c[0, 0]*s + c[0, 1])*s + c[0, 2])*s + c[0, 3] - x
+    dy = ((c[1, 0]*s + c[1, 1])*s + c[1, 2])*s + c[1, 3] - y
+    for _ in range(niter):
+        d1x = (3*c[0, 0]*s + 2*c[0, 1])*s + c[0, 2]
+        d1y = (3*c[1, 0]*s + 2*c[1, 1])*s + c[1, 2]
+        grad = dx*d1x + dy*d1y
+        hess = (d1x*d1x + d1y*d1y + dx*(6*c[0, 0]*s + 2*c[0, 1]) +
+                dy*(6*c[1, 0]*s + 2*c[1, 1]))
+        s_new = s
+        if hess > 0:
+            s_new = min(max(s - grad/hess, s0), s1)
+        dx_new = ((c[0, 0]*s_new + c[0, 1])*s_new + c[0, 2])*s_new + \
+            c[0, 3] - x
+        dy_new = ((c[1, 0]*s_new + c[1, 1])*s_new + c[1, 2])*s_new + \
+            c[1, 3] - y
+        if dx_new*dx_new + dy_new*dy_new < dist2:
+            s, dx, dy = s_new, dx_new, dy_new
+            dist2 = dx*dx + dy*dy
+    return dist2
+
+
+@njit()
+def arm_distance(j, x, y, knots, kmax, coefs, nstart, niter):
+    "See `spiral_arms.ArmSearch.distance` (one point)"
+    kmin = 0
+    best = np.inf
+    for k in range(kmax[j]):
+        d2 = (knots[j, k, 0] - x)**2 + (knots[j, k, 1] - y)**2
+        if d2 < best:
+            kmin = k
+            best = d2
+    t0 = max(0, kmin - 1)
+    t1 = min(kmax[j], kmin + 1)
+    dist2 = np.inf
+    for lo, hi in ((t0, min(t0 + 1, t1)), (t0 + 1, max(t1, t0 + 1))):
+        piece = min(lo, kmax[j] - 2)
+        dist2 = min(dist2, min_dist2(coefs[j, :, :, piece], x, y,
+                                     lo - piece, hi - piece, nstart, niter))
+    return math.sqrt(dist2)
+
+
+@njit()
+def spiral_arms(x, y, z, params, arms, armmap, boxes, knots, kmax, coefs,
+                nstart, niter):
+    """
+    See `spiral_arms.ne_spiral_arm` and `spiral_arms.arm_inplane`
+
+    `params` holds Aa, wa, ha and `arms` the narm, warm, harm factors of
+    each (remapped) arm.
+    """
+    Aa, wa, ha = params[0], params[1], params[2]
+    if not abs(z/ha) < 10.:
+        return 0.
+    rr = x**2 + y**2
+    thxy = math.atan2(-x, y)*180/math.pi
+    if thxy < 0.:
+        thxy += 360.
+    nea = 0.
+    for j in range(armmap.size):
+        if (x < boxes[j, 0] or x > boxes[j, 1] or
+                y < boxes[j, 2] or y > boxes[j, 3]):
+            continue
+        smin = arm_distance(j, x, y, knots, kmax, coefs, nstart, niter)
+        if not smin < 3*wa:
+            continue
+        ga = math.exp(-(smin/arms[j, 1]/wa)**2)
+        if rr > Aa:
+            ga *= 1./(math.cosh((rr - Aa)/2.0))**2
+        if armmap[j] == 3:
+            th3a, th3b, fac3min = 290., 363., 0.0
+            test3 = thxy - th3a
+            if test3 < 0:
+                test3 += 360.
+            if 0. <= test3 < th3b - th3a:
+                arg = 6.2831853*(thxy - th3a)/(th3b - th3a)
+                ga *= ((1. + fac3min + (1. - fac3min)*math.cos(arg))/2.)**4.0
+        if armmap[j] == 2:
+            test2 = thxy - 35.
+            th2a, th2b, fac2min = 340., 370., 0.1
+            if test2 < 0.:
+                test2 += 360.
+            if 0. <= test2 < th2b - th2a:
+                arg = 6.2831853*(thxy - th2a)/(th2b - th2a)
+                ga *= (1. + fac2min + (1. - fac2min)*math.cos(arg))/2.
+        nea += arms[j, 0]*ga/math.cosh(z/(arms[j, 2]*ha))**2
+    return nea
+
+
+@njit(parallel=True)
+def electron_density(x, y, z, out, rsun, smooth, lism_ne0, cylinder,
+                     spheres, transforms, centers, arm_params, arms, armmap,
+                     boxes, knots, kmax, coefs, nstart, niter, clumps,
+                     voids):
+    """
+    See `density.ElectronDensity`:
+    (voids | (lism | (thick_disk + thin_disk + spiral_arms + gc))) + clumps
+    """
+    for i in prange(x.size):
+        ne = objects(x[i], y[i], z[i], *voids)
+        if not ne > 0:
+            ne += lism(x[i], y[i], z[i], lism_ne0, cylinder, spheres,
+                       transforms, centers)
+        if not ne > 0:
+            ne += (smooth[0]*thick_disk(x[i], y[i], z[i], smooth[1],
+                                        smooth[2], rsun) +
+                   smooth[3]*thin_disk(x[i], y[i], z[i], smooth[4],
+                                       smooth[5]) +
+                   arm_params[3]*spiral_arms(
+                       x[i], y[i], z[i], arm_params, arms, armmap, boxes,
+                       knots, kmax, coefs, nstart, niter) +
+                   smooth[6]*gc(x[i], y[i], z[i], smooth[7], smooth[8],
+                                smooth[9], smooth[10], smooth[11]))
+        out[i] = ne + objects(x[i], y[i], z[i], *clumps)
+
+
+class NumbaDensity(object):
+    """
+    Electron density of an `ElectronDensity` model (with the exact spiral
+    arms) evaluated by the numba kernels
+    """
+
+    def __init__(self, model):
+        """
+        Arguments:
+        - `model`: ElectronDensity
+        """
+        params = model.params
+
+        thick, thin, gc = (model._thick_disk, model._thin_disk,
+                           model._galactic_center)
+        self.smooth = np.array(
+            [thick._ne0, thick._params['radius'], thick._params['height'],
+             thin._ne0, thin._params['radius'], thin._params['height'],
+             gc._ne0] + list(gc._params['center']) +
+            [gc._params['radius'], gc._params['height']], dtype=float)
+
+        lism = model._lism
+        lhb = lism.lhb._params
+        self.lism_ne0 = np.array([lism.lhb._ne0, lism.loop_in._ne0,
+                                  lism.loop_out._ne0, lism.lsb._ne0,
+                                  lism.ldr._ne0], dtype=float)
+        self.cylinder = np.array(list(lhb['center']) +
+                                 list(lhb['cylinder']) + [lhb['theta']],
+                                 dtype=float)
+        self.spheres = np.array([
+            list(loop._params['center']) + [loop._params['radius']]
+            for loop in (lism.loop_in, lism.loop_out)], dtype=float)
+        ellipsoids = [lism.lsb._func.__self__, lism.ldr._func.__self__]
+        self.transforms = np.array([e.transform for e in ellipsoids])
+        self.centers = np.array([e.center for e in ellipsoids], dtype=float)
+
+        arm_params = params['spiral_arms']
+        adict = arm_params['adict']
+        search = adict['search']
+        armmap = np.array(adict['armmap'][:adict['narms']])
+        self.arm_params = np.array([arm_params['Aa'], arm_params['wa'],
+                                    arm_params['ha'],
+                                    model._spiral_arms._ne0], dtype=float)
+        self.arms = np.array([[arm_params['narms'][jj - 1],
+                               arm_params['warms'][jj - 1],
+                               arm_params['harms'][jj - 1]]
+                              for jj in armmap], dtype=float)
+        self.armmap = armmap
+        self.kmax = np.array(search.kmax[:adict['narms']])
+        self.knots = np.array(adict['arm'][:adict['narms']], dtype=float)
+        self.coefs = np.zeros((armmap.size, 2, 4, self.kmax.max() - 1))
+        self.boxes = np.zeros((armmap.size, 4))
+        for j, kmax in enumerate(self.kmax):
+            self.coefs[j, :, :, :kmax - 1] = search.coefs[j]
+            knots = self.knots[j, :kmax]
+            # Widened by the arm cut-off and one polyline step (for the
+            # extrapolation beyond the last point)
+            margin = 3*arm_params['wa'] + np.max(np.sqrt(np.sum(
+                np.diff(knots, axis=0)**2, axis=1)))
+            self.boxes[j] = [knots[:, 0].min() - margin,
+                             knots[:, 0].max() + margin,
+                             knots[:, 1].min() - margin,
+                             knots[:, 1].max() + margin]
+        self.nstart = search.nstart
+        self.niter = search.niter
+
+        self.clumps = self._objects(model._clumps)
+        self.voids = self._objects(model._voids)
+
+    @staticmethod
+    def _objects(objects):
+        "Arrays describing the clumps or voids"
+        nobj = objects.ne0.size
+        transforms = np.broadcast_to(objects.transform, (nobj, 3, 3))
+        return (np.ascontiguousarray(objects.xyz, dtype=float),
+                np.ascontiguousarray(transforms, dtype=float),
+                np.ascontiguousarray(objects.xyz_transform, dtype=float),
+                np.asarray(objects.support, dtype=float)**2,
+                np.asarray(objects.ne0, dtype=float),
+                np.asarray(objects.edge, dtype=np.int64))
+
+    def __call__(self, xyz, rsun):
+        "Electron density at `xyz` (shape (3,) or (3, ...))"
+        xyz = np.asarray(xyz, dtype=float)
+        if xyz.ndim == 1:
+            return self(xyz[:, None], rsun)[0]
+        shape = xyz.shape[1:]
+        x, y, z = np.ascontiguousarray(xyz.reshape(3, -1))
+        out = np.empty(x.size)
+        electron_density(x, y, z, out, rsun, self.smooth, self.lism_ne0,
+                         self.cylinder, self.spheres, self.transforms,
+                         self.centers, self.arm_params, self.arms,
+                         self.armmap, self.boxes, self.knots, self.kmax,
+                         self.coefs, self.nstart, self.niter, self.clumps,
+                         self.voids)
+        return out.reshape(shape)
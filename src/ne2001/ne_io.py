@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
 import json
 import os
 from builtins import super
@@ -13,8 +14,11 @@ from astropy.table import Table
 from scipy.interpolate import CubicSpline
 
 from . import __path__
+from .spiral_arms import ArmSearch
+from .utils import fingerprint
 
 DATA_PATH = os.path.join(__path__[0], 'data')
+ARMS_FILE = 'ne_arms_log_mod.inp'
 
 
 def numpify_dict(d):
@@ -39,20 +43,44 @@ class Params(dict):
 
     def __init__(self, ifile='ne2001_params.json', path=None, **new_params):
         """
+        Arguments:
+        - `ifile`: Parameters file; None to only use `new_params`
+        - `path`: Directory of `ifile` (default: the package data)
+        - `**new_params`: Parameters replacing those of `ifile`. The
+                          spiral arms file may be given as `arms_file`
+                          (None to skip the arms initialization)
         """
         if path is None:
             path = DATA_PATH
         self.path = path
         self.ifile = ifile
-        try:
-            params = numpify_dict(parse_json(os.path.join(self.path,
-                                                          self.ifile)))
-            params['spiral_arms']['adict'] = init_spiral_arms()
-        except IOError:
-            params = {}
+        arms_file = new_params.pop('arms_file', ARMS_FILE)
+        params = {}
+        if ifile is not None:
+            try:
+                params = numpify_dict(parse_json(os.path.join(self.path,
+                                                              self.ifile)))
+                if arms_file is not None:
+                    params['spiral_arms']['adict'] = init_spiral_arms(
+                        arms_file)
+            except IOError:
+                params = {}
         params.update(new_params)
         super().__init__(params)
 
+    def fingerprint(self):
+        "SHA1 digest identifying the parameter set"
+        return fingerprint(self)
+
+
+def file_digest(path):
+    "SHA1 digest of the content of the file `path`"
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
 
 def parse_json(json_file):
     "Parse json file"
@@ -130,7 +158,7 @@ def read_lism(ifile='ne_lism.json'):
     return lism_dict
 
 
-def init_spiral_arms(ifile='ne_arms_log_mod.inp'):
+def init_spiral_arms(ifile=ARMS_FILE):
     armsinp = os.path.join(DATA_PATH, ifile)
     # logarms = DATA_PATH + 'log_arms.out'
 
@@ -210,4 +238,5 @@ def init_spiral_arms(ifile='ne_arms_log_mod.inp'):
     arms_dict['narmpoints'] = narmpoints
     arms_dict['armmap'] = armmap
     arms_dict['arm'] = arm
+    arms_dict['search'] = ArmSearch(arms_dict)
     return arms_dict
@@ -0,0 +1,221 @@
+""" Adaptive octree approximation of the electron density
+
+The octree covers a cubic box in Galactocentric coordinates. A cell is
+split into 8 children until the trilinear interpolation of its corner
+values reproduces the density on the 3x3x3 lattice of the cell within
+`atol + rtol*max(ne)`, so the tree is fine where the density has steep
+gradients (clump edges, void and LISM boundaries, arm ridges) and coarse
+in the halo. The error bound is only tested on the lattice points:
+structures smaller than the cells at `min_depth` may be missed.
+"""
+import json
+
+import numpy as np
+
+from .density import NEobject
+
+# Corners of a unit cell; corner k is at (k & 1, k >> 1 & 1, k >> 2 & 1)
+CORNERS = np.array([[k & 1, k >> 1 & 1, k >> 2 & 1] for k in range(8)])
+# 3x3x3 lattice of a unit cell
+LATTICE = np.array([[i, j, k] for k in (0, 0.5, 1)
+                    for j in (0, 0.5, 1) for i in (0, 0.5, 1)])
+
+
+def trilinear_weights(t):
+    """
+    Weights of the 8 cell corners for the trilinear interpolation
+    at fractional positions `t` (shape (..., 3))
+    """
+    t = t[..., None, :]
+    return np.prod(np.where(CORNERS == 1, t, 1 - t), axis=-1)
+
+
+class DensityOctree(NEobject):
+    """
+    Adaptive octree approximation of an electron density model
+
+    Points outside the box are evaluated with `fallback` if given
+    (zero otherwise).
+    """
+
+    def __init__(self, lo, size, children, corners, meta=None,
+                 fallback=None):
+        """
+        Arguments:
+        - `lo`: Lower corner of the box (kpc)
+        - `size`: Side of the box (kpc)
+        - `children`: Index of the first child of each node (-1 for leaves)
+        - `corners`: Density at the 8 corners of each node
+        - `meta`: Build parameters
+        - `fallback`: NEobject evaluated outside the box
+        """
+        self.lo = np.asarray(lo, dtype=float)
+        self.size = float(size)
+        self.children = children
+        self.corners = corners
+        self.meta = meta or {}
+        self.fallback = fallback
+
+    @classmethod
+    def build(cls, density, center=(0, 0, 0), size=40., rtol=1e-2,
+              atol=1e-5, min_depth=3, max_depth=10, max_nodes=2**22,
+              block_size=2**16, fallback=True):
+        """ Build the octree of `density`
+
+        Parameters
+        ----------
+        density : NEobject
+        center : array_like, optional
+          Center of the box (Galactocentric, kpc)
+        size : float, optional
+          Side of the box (kpc)
+        rtol : float, optional
+          Relative interpolation tolerance
+        atol : float, optional
+          Absolute interpolation tolerance (cm**-3)
+        min_depth : int, optional
+          Depth to which all the cells are split
+        max_depth : int, optional
+          Maximal depth
+        max_nodes : int, optional
+          Stop splitting cells beyond this number of nodes
+        block_size : int, optional
+          Maximal number of points passed to `ne` at once
+        fallback : bool, optional
+          Evaluate `density` outside the box
+
+        Returns
+        -------
+        octree : DensityOctree
+
+        """
+        lo = np.asarray(center, dtype=float) - size/2
+        # Interpolation from the corners to the lattice
+        weights = trilinear_weights(LATTICE)
+        is_corner = np.all(LATTICE != 0.5, axis=1)
+        corner_index = [np.where(np.all(LATTICE == c, axis=1))[0][0]
+                        for c in CORNERS]
+
+        levels = []
+        cells = lo[None, :]
+        nodes = np.zeros(1, dtype=np.int64)
+        nnodes = 1
+        max_error = 0.
+        for depth in range(max_depth + 1):
+            cell_size = size/2**depth
+            points = (cells[:, None, :] + cell_size*LATTICE).reshape(-1, 3).T
+            values = np.concatenate([
+                density.ne(points[:, i:i + block_size])
+                for i in range(0, points.shape[1], block_size)
+            ]).reshape(-1, LATTICE.shape[0])
+
+            error = np.max(np.abs(values - values[:, corner_index].dot(
+                weights.T))[:, ~is_corner], axis=1)
+            scale = np.max(np.abs(values), axis=1)
+            split = (error > atol + rtol*scale) | (depth < min_depth)
+            if depth == max_depth or nnodes + 8*split.sum() > max_nodes:
+                split[:] = False
+            if (~split).any():
+                max_error = max(max_error, np.max(
+                    error[~split]/np.maximum(scale[~split], atol)))
+
+            first = nnodes + 8*np.arange(split.sum())
+            levels.append((nodes, values[:, corner_index], nodes[split],
+                           first))
+            if not split.any():
+                break
+            nnodes += 8*split.sum()
+            cells = (cells[split][:, None, :] +
+                     cell_size/2*CORNERS).reshape(-1, 3)
+            nodes = (first[:, None] + np.arange(8)).ravel()
+
+        children = np.full(nnodes, -1, dtype=np.int64)
+        corners = np.zeros((nnodes, 8), dtype=np.float32)
+        for nodes, values, parents, first in levels:
+            corners[nodes] = values
+            children[parents] = first
+
+        meta = dict(rtol=rtol, atol=atol, min_depth=min_depth,
+                    max_depth=max_depth, max_error=float(max_error),
+                    fingerprint=getattr(density, 'fingerprint', None))
+        return cls(lo, size, children, corners, meta=meta,
+                   fallback=density if fallback else None)
+
+    @property
+    def nnodes(self):
+        "Number of nodes"
+        return self.children.size
+
+    @property
+    def nleaves(self):
+        "Number of leaves"
+        return int(np.sum(self.children < 0))
+
+    def save(self, path):
+        """
+        Write the octree to `path` (npz); raise ValueError if its model has
+        no fingerprint (a stale file could not be detected by `load`)
+        """
+        if self.meta.get('fingerprint') is None:
+            raise ValueError("The octree model has no fingerprint and "
+                             "cannot be saved")
+        np.savez(path, lo=self.lo, size=self.size, children=self.children,
+                 corners=self.corners, meta=json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, path, density=None, fallback=True):
+        """ Read an octree written by `save`
+
+        Arguments:
+        - `path`: File name
+        - `density`: If given, raise ValueError if the octree was built for
+                     a different model (or if it has no fingerprint), and
+                     use it outside the box
+        - `fallback`: Evaluate `density` outside the box
+        """
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            if density is not None and getattr(density, 'fingerprint',
+                                               None) is None:
+                raise ValueError("The model has no fingerprint: cannot "
+                                 "check the octree {}".format(path))
+            if (density is not None and meta['fingerprint'] !=
+                    density.fingerprint):
+                raise ValueError("Stale octree {}: built for a different "
+                                 "model".format(path))
+            return cls(data['lo'], data['size'], data['children'],
+                       data['corners'], meta=meta,
+                       fallback=density if fallback else None)
+
+    def electron_density(self, xyz):
+        "Electron density interpolated at the location `xyz`"
+        xyz = np.asarray(xyz, dtype=float)
+        if xyz.ndim == 1:
+            return self.electron_density(xyz[:, None])[0]
+        if xyz.ndim > 2:
+            shape = xyz.shape[1:]
+            return self.electron_density(xyz.reshape(3, -1)).reshape(shape)
+        t = (xyz.T - self.lo)/self.size
+        inside = np.all((t >= 0) & (t <= 1), axis=1)
+        res = np.zeros(t.shape[0])
+
+        idx = np.where(inside)[0]
+        t = t[idx]
+        node = np.zeros(idx.size, dtype=np.int64)
+        while idx.size:
+            child = self.children[node]
+            leaf = child < 0
+            if leaf.any():
+                res[idx[leaf]] = np.sum(
+                    self.corners[node[leaf]] *
+                    trilinear_weights(t[leaf]), axis=1)
+            idx, t, node, child = (idx[~leaf], t[~leaf], node[~leaf],
+                                   child[~leaf])
+            # Descend into the octant containing the points
+            octant = np.minimum((2*t).astype(np.int64), 1)
+            node = child + octant.dot([1, 2, 4])
+            t = 2*t - octant
+
+        if self.fallback is not None and not inside.all():
+            res[~inside] = self.fallback.ne(xyz[:, ~inside])
+        return res
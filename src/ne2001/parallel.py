@@ -0,0 +1,288 @@
+""" Process-pool evaluation with the model state in shared memory
+
+`SharedState` copies the arrays of the model state (see `ne2001.state`)
+into a single `multiprocessing.shared_memory` block, and the worker
+processes `attach` views of the block (without copying) and rebuild the
+model with `model_from_state`, skipping the parsing of the data files.
+Without `multiprocessing.shared_memory` (Python < 3.8), the state is
+pickled to each worker process instead.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+from . import density
+from .state import _join
+from .state import _layout
+from .state import _pack
+from .state import _split
+from .state import _unpack
+from .state import model_from_state
+from .state import model_state
+from .utils import parse_DM
+from .utils import parse_lbd
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# The shared memory and the model of a worker process
+_worker = {}
+
+
+class SharedState(object):
+    """
+    Copy of a state tree with its arrays in a shared memory block
+
+    `spec` (picklable) is passed to the processes calling `attach`. The
+    block is released by `close` (or at the end of a `with` block).
+    Without shared memory, `spec` holds the state itself.
+    """
+
+    def __init__(self, state):
+        """
+        Arguments:
+        - `state`: Tree of dicts and lists (see `model_state`)
+        """
+        if shared_memory is None:
+            self.shm = None
+            self.spec = dict(state=state)
+            return
+        arrays = []
+        skeleton = _split(state, arrays)
+        layout, size = _layout(arrays)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        _pack(arrays, layout, self.shm.buf)
+        self.spec = dict(name=self.shm.name, layout=layout,
+                         skeleton=skeleton)
+
+    def close(self):
+        "Release the shared memory block"
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach(spec):
+    """ Attach a shared state (see `SharedState.spec`)
+
+    Returns
+    -------
+    shm : SharedMemory or None
+      The block, which must be kept open while the state is used (None
+      without shared memory)
+    state : dict
+      The state tree with read-only views of the shared arrays
+
+    """
+    if 'state' in spec:
+        return None, spec['state']
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    arrays = _unpack(spec['layout'], shm.buf, writeable=False)
+    return shm, _join(spec['skeleton'], arrays)
+
+
+def _init_worker(spec):
+    "Rebuild the model in a worker process"
+    shm, state = attach(spec)
+    _worker['shm'] = shm
+    _worker['model'] = model_from_state(state)
+
+
+def _call(func, args, kwargs):
+    "Call `func` with the model of the worker process"
+    return func(_worker['model'], *args, **kwargs)
+
+
+def DM_many(model, l, b, d, **kwargs):
+    "`model.DM_many` returning a plain ndarray (see `ModelPool.map`)"
+    return model.DM_many(l, b, d, quantity=False, **kwargs)
+
+
+def dist_many(model, l, b, DM, **kwargs):
+    "`model.dist_many` returning plain ndarrays (see `ModelPool.map`)"
+    return model.dist_many(l, b, DM, quantity=False, **kwargs)
+
+
+def _batches(d, nbatches):
+    """
+    Split the sightlines of distances `d` into at most `nbatches` batches
+    of about the same total length, the longest sightlines first
+    """
+    order = np.argsort(-d, kind='stable')
+    total = np.cumsum(d[order])
+    if total[-1] <= 0:
+        return np.array_split(order, min(nbatches, order.size))
+    cuts = np.searchsorted(total, total[-1]*np.arange(1, nbatches)/nbatches)
+    return [batch for batch in np.split(order, np.unique(cuts)) if batch.size]
+
+
+class ModelPool(object):
+    """
+    Pool of processes evaluating a model whose state is in shared memory
+
+    The model state is put in shared memory once, and the worker processes
+    rebuild the model from it. The pool is released by `close` (or at the
+    end of a `with` block).
+
+    The processes are spawned by default: forking a process running
+    threads (thread pools, numba kernels) may deadlock. As for any spawned
+    process, the main module of a script using the pool must be guarded by
+    `if __name__ == '__main__'`.
+    """
+
+    def __init__(self, model, workers=None, batches_per_worker=4,
+                 start_method='spawn'):
+        """
+        Arguments:
+        - `model`: ElectronDensity
+        - `workers`: Number of processes (default: the number of CPUs)
+        - `batches_per_worker`: Number of batches per process, for load
+                                balancing
+        - `start_method`: Start method of the processes ('spawn',
+                          'forkserver' or 'fork')
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.batches_per_worker = batches_per_worker
+        self._shared = SharedState(model_state(model))
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=get_context(start_method),
+            initializer=_init_worker, initargs=(self._shared.spec,))
+
+    def map(self, func, weights, *args, **kwargs):
+        """ Evaluate `func(model, *args, **kwargs)` on the processes
+
+        Parameters
+        ----------
+        func : callable
+          Module-level function of the model and of the 1d arrays `args`
+          returning an array (or a tuple of arrays) of the same length
+        weights : ndarray
+          Cost of each element of the arrays; the elements are split into
+          batches of about the same total cost
+        *args : ndarray
+          Arrays of the same length
+        **kwargs
+          Passed to `func`
+
+        Returns
+        -------
+        result : ndarray or tuple of ndarray
+          Results in the order of the input
+
+        """
+        batches = _batches(np.asarray(weights, dtype=float),
+                           self.workers*self.batches_per_worker)
+        futures = [self._executor.submit(_call, func,
+                                         [arg[rows] for arg in args], kwargs)
+                   for rows in batches]
+        result = None
+        for rows, future in zip(batches, futures):
+            res = future.result()
+            values = res if isinstance(res, tuple) else (res,)
+            if result is None:
+                result = [np.empty(len(weights), dtype=np.asarray(val).dtype)
+                          for val in values]
+            for out, val in zip(result, values):
+                out[rows] = val
+        return tuple(result) if isinstance(res, tuple) else result[0]
+
+    def DM(self, l, b, d, quantity=True, **kwargs):
+        """ Dispersion measures of the sightlines computed with `DM_many`
+
+        See `map_DM`
+        """
+        l, b, d = np.broadcast_arrays(*[np.atleast_1d(val) for val in
+                                        parse_lbd(l, b, d)])
+        DM = np.zeros(d.shape)
+        if d.size:
+            DM.flat[:] = self.map(DM_many, d.ravel(), l.ravel(), b.ravel(),
+                                  d.ravel(), **kwargs)
+        if quantity:
+            return DM * density.DM_unit
+        return DM
+
+    def dist(self, l, b, DM, quantity=True, **kwargs):
+        """ Distances to dispersion measures `DM` towards `l`, `b`
+        computed with `dist_many`
+
+        Returns
+        -------
+        dist : Quantity or ndarray
+          Distances; `dmax` where `DM` exceeds the Galactic maximum
+        beyond : ndarray
+          Boolean flags set where `DM` exceeds the DM out to `dmax`
+
+        """
+        l, b, _ = parse_lbd(l, b, 0)
+        l, b, DM = np.broadcast_arrays(np.atleast_1d(l), np.atleast_1d(b),
+                                       np.atleast_1d(parse_DM(DM)))
+        dist = np.zeros(DM.shape)
+        beyond = np.zeros(DM.shape, dtype=bool)
+        if DM.size:
+            dist.flat[:], beyond.flat[:] = self.map(
+                dist_many, DM.ravel(), l.ravel(), b.ravel(), DM.ravel(),
+                **kwargs)
+        if quantity:
+            return dist * density.d_unit, beyond
+        return dist, beyond
+
+    def close(self):
+        "Stop the processes and release the shared memory"
+        self._executor.shutdown()
+        self._shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def map_DM(model, l, b, d, workers=None, batches_per_worker=4,
+           start_method='spawn', quantity=True, **kwargs):
+    """ Dispersion measures of many sightlines computed by a process pool
+
+    The sightlines are split into batches of about the same total length,
+    which are evaluated with `DM_many` (see `ModelPool`).
+
+    Parameters
+    ----------
+    model : ElectronDensity
+    l : array_like or Angle
+      Galactic longitudes; assumed deg if unitless
+    b : array_like or Angle
+      Galactic latitudes; assumed deg if unitless
+    d : array_like or Quantity
+      Distances to the sources; assumed kpc if unitless
+    workers : int, optional
+      Number of processes (default: the number of CPUs)
+    batches_per_worker : int, optional
+      Number of batches per process, for load balancing
+    start_method : str, optional
+      Start method of the processes ('spawn', 'forkserver' or 'fork')
+    quantity : bool, optional
+      If False return a plain ndarray in pc cm**-3
+    **kwargs
+      Passed to `DM_many` (`step_size`, `nsamp`, `integrator`,
+      `block_size`)
+
+    Returns
+    -------
+    DM : Quantity or ndarray
+      Dispersion Measures with units pc cm**-3, in the order of the input
+
+    """
+    with ModelPool(model, workers, batches_per_worker,
+                   start_method) as pool:
+        return pool.DM(l, b, d, quantity=quantity, **kwargs)
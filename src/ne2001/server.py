@@ -0,0 +1,385 @@
+""" Local model server with request micro-batching
+
+The server keeps one `ElectronDensity` in memory and answers JSON requests,
+one per line, on a Unix socket or a localhost TCP port::
+
+    {"id": 1, "op": "DM", "l": 30, "b": 2, "d": 5}
+    {"id": 1, "result": [51.3...]}
+
+The `DM`, `dist` and `ne` requests arriving within `window` seconds of each
+other are merged into a single vectorized call (`DM_many`, `dist_many`,
+`ne`), evaluated in a thread so that the server keeps reading requests.
+The options of the requests (`step_size`, `nsamp`, `dmax`) are validated,
+and requests needing more than `max_samples` density evaluations are
+refused. `reload` rebuilds the model (with new parameters if given),
+`metrics` returns the request latencies and batch sizes, and `ping` checks
+that the server is alive.
+"""
+import asyncio
+import json
+import socket
+import time
+from collections import deque
+
+import numpy as np
+
+from .density import ElectronDensity
+
+# Keyword arguments of the batched calls which may be given in requests
+OPTIONS = {'DM': ('step_size', 'nsamp'),
+           'dist': ('step_size', 'nsamp', 'dmax'),
+           'ne': ()}
+
+# Types and lower bounds (exclusive for the floats) of the options
+OPTION_TYPES = {'step_size': (float, 0.), 'nsamp': (int, 1),
+                'dmax': (float, 0.)}
+
+# Defaults of the options of DM_many and dist_many
+DEFAULTS = {'step_size': 0.001, 'dmax': 100.}
+
+# Arguments of the batched calls
+ARGUMENTS = {'DM': ('l', 'b', 'd'),
+             'dist': ('l', 'b', 'DM'),
+             'ne': ('x', 'y', 'z')}
+
+
+class RequestError(ValueError):
+    "Invalid request"
+
+
+class Metrics(object):
+    """
+    Request latencies and batch sizes
+
+    Only the last `maxlen` latencies and batch sizes are kept.
+    """
+
+    def __init__(self, maxlen=10000):
+        self.start = time.time()
+        self.requests = {}
+        self.errors = 0
+        self.latencies = deque(maxlen=maxlen)
+        self.batch_sizes = deque(maxlen=maxlen)
+        self.batches = 0
+
+    def add_request(self, op, latency):
+        "Record a request to `op` answered in `latency` s"
+        self.requests[op] = self.requests.get(op, 0) + 1
+        self.latencies.append(latency)
+
+    def add_batch(self, size):
+        "Record a batch of `size` requests"
+        self.batches += 1
+        self.batch_sizes.append(size)
+
+    def summary(self):
+        "Dict of the metrics (latencies in ms)"
+        summary = dict(uptime=time.time() - self.start,
+                       requests=dict(self.requests), errors=self.errors,
+                       batches=self.batches)
+        if self.latencies:
+            latency = np.array(self.latencies)*1000
+            summary['latency_ms'] = dict(
+                zip(('p50', 'p90', 'p99'),
+                    np.percentile(latency, [50, 90, 99]).tolist()),
+                mean=latency.mean(), max=latency.max())
+        if self.batch_sizes:
+            sizes = np.array(self.batch_sizes)
+            summary['batch_size'] = dict(mean=sizes.mean(),
+                                         max=int(sizes.max()))
+        return summary
+
+
+class ModelServer(object):
+    """
+    Serve a warm electron density model, merging concurrent requests
+    into vectorized calls
+    """
+
+    def __init__(self, model=None, window=0.002, max_batch=4096,
+                 max_samples=10**7, **params):
+        """
+        Arguments:
+        - `model`: ElectronDensity (default: built from `params`)
+        - `window`: Time window (s) in which requests are merged
+        - `max_batch`: Maximal number of requests merged
+        - `max_samples`: Maximal number of density evaluations of a
+                         request (from its options), larger requests are
+                         refused
+        - `**params`: Arguments of ElectronDensity
+        """
+        self.params = params
+        self.model = ElectronDensity(**params) if model is None else model
+        self.window = window
+        self.max_batch = max_batch
+        self.max_samples = max_samples
+        self.metrics = Metrics()
+        self._pending = {}
+
+    async def handle(self, request):
+        "Answer the request `request` (a dict)"
+        start = time.time()
+        op = request.get('op')
+        try:
+            if op in ARGUMENTS:
+                result = await self._batched(op, request)
+            elif op == 'reload':
+                result = await self.reload(**request.get('params', {}))
+            elif op == 'metrics':
+                result = self.metrics.summary()
+            elif op == 'ping':
+                result = 'pong'
+            else:
+                raise RequestError("Unknown op {}".format(op))
+        except Exception as exc:
+            self.metrics.errors += 1
+            return dict(id=request.get('id'),
+                        error='{}: {}'.format(type(exc).__name__, exc))
+        self.metrics.add_request(op, time.time() - start)
+        return dict(id=request.get('id'), result=result)
+
+    async def reload(self, **params):
+        """
+        Rebuild the model, with the parameters `params` replacing those of
+        the last build; return its fingerprint
+        """
+        self.params = dict(self.params, **params)
+        loop = asyncio.get_running_loop()
+        self.model = await loop.run_in_executor(
+            None, lambda: ElectronDensity(**self.params))
+        return self.model.fingerprint
+
+    async def _batched(self, op, request):
+        "Queue the request for the next batch of `op` and wait for it"
+        try:
+            args = [np.atleast_1d(np.asarray(request[key], dtype=float))
+                    for key in ARGUMENTS[op]]
+            args = [arg.ravel() for arg in np.broadcast_arrays(*args)]
+        except KeyError as exc:
+            raise RequestError("Missing argument {}".format(exc))
+        options = self._options(op, request, args)
+
+        key = (op, options)
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            asyncio.ensure_future(self._flush_later(key))
+        batch.append((args, future))
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        return await future
+
+    def _options(self, op, request, args):
+        """
+        Validated options of the request (sorted tuple of pairs); raise
+        RequestError if they are invalid or if the request would evaluate
+        the density more than `max_samples` times
+        """
+        options = {}
+        for key in OPTIONS[op]:
+            if key not in request:
+                continue
+            kind, lower = OPTION_TYPES[key]
+            value = request[key]
+            if (isinstance(value, bool) or
+                    not isinstance(value, (int, float)) or
+                    not np.isfinite(value) or value < lower or
+                    (kind is float and value == lower) or
+                    (kind is int and value != int(value))):
+                raise RequestError("Invalid {} {!r}".format(key, value))
+            options[key] = kind(value)
+
+        # Samples per sightline of DM_many and dist_many
+        npoints = args[0].size
+        step_size = options.get('step_size', DEFAULTS['step_size'])
+        nsamp = options.get('nsamp')
+        if op == 'DM' and npoints:
+            npoints *= nsamp or max(1000, np.max(np.abs(args[2]))/step_size)
+        elif op == 'dist' and npoints:
+            dmax = options.get('dmax', DEFAULTS['dmax'])
+            # Segments doubling from step_size to dmax
+            nsegments = 1 + max(0, np.ceil(np.log2(dmax/step_size)))
+            npoints *= (nsamp*nsegments if nsamp
+                        else 2*dmax/step_size + 1000*nsegments)
+        if npoints > self.max_samples:
+            raise RequestError("The request needs {:.3g} density evaluations "
+                               "(at most {})".format(npoints,
+                                                     self.max_samples))
+        return tuple(sorted(options.items()))
+
+    async def _flush_later(self, key):
+        "Flush the batch `key` at the end of the time window"
+        await asyncio.sleep(self.window)
+        self._flush(key)
+
+    def _flush(self, key):
+        "Evaluate the pending batch `key` in a thread"
+        batch = self._pending.pop(key, None)
+        if batch:
+            self.metrics.add_batch(len(batch))
+            asyncio.ensure_future(self._evaluate(key, batch))
+
+    async def _evaluate(self, key, batch):
+        "Evaluate the batch `key` and set the results of its requests"
+        op, options = key
+        args = [np.concatenate(arg) for arg in zip(*[a for a, _ in batch])]
+        model = self.model
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                None, lambda: _call(model, op, args, dict(options)))
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        offsets = np.cumsum([0] + [a[0].size for a, _ in batch])
+        for (_, future), i0, i1 in zip(batch, offsets[:-1], offsets[1:]):
+            if not future.done():
+                future.set_result(
+                    [result[i0:i1].tolist() for result in results]
+                    if isinstance(results, tuple)
+                    else results[i0:i1].tolist())
+
+    async def _client(self, reader, writer):
+        "Answer the requests of a connection"
+        async def answer(line):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise RequestError("The request must be an object")
+            except ValueError as exc:
+                self.metrics.errors += 1
+                response = dict(id=None, error='RequestError: {}'.format(exc))
+            else:
+                response = await self.handle(request)
+            writer.write(json.dumps(response).encode() + b'\n')
+
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(answer(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        """ Start listening
+
+        Parameters
+        ----------
+        path : str, optional
+          Unix socket path; a TCP socket is used if not given
+        host : str, optional
+          TCP host
+        port : int, optional
+          TCP port (0 for any free port)
+
+        Returns
+        -------
+        server : asyncio.Server
+
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self._client, path=path)
+        return await asyncio.start_server(self._client, host=host, port=port)
+
+
+def _call(model, op, args, options):
+    "Batched call of the op `op`"
+    if op == 'DM':
+        return model.DM_many(*args, quantity=False, **options)
+    if op == 'dist':
+        return model.dist_many(*args, quantity=False, **options)
+    return model.ne(np.array(args))
+
+
+def serve(path=None, host='127.0.0.1', port=0, ready=None, **kwargs):
+    """ Run a `ModelServer` until interrupted
+
+    Parameters
+    ----------
+    path : str, optional
+      Unix socket path; a TCP socket is used if not given
+    host : str, optional
+      TCP host
+    port : int, optional
+      TCP port (0 for any free port)
+    ready : callable, optional
+      Called with the listening address once the server is started
+    **kwargs
+      Arguments of ModelServer
+
+    """
+    async def run():
+        server = await ModelServer(**kwargs).start(path, host, port)
+        if ready is not None:
+            ready(path if path is not None
+                  else server.sockets[0].getsockname()[:2])
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+class Client(object):
+    """
+    Blocking client of a `ModelServer`
+    """
+
+    def __init__(self, path=None, host='127.0.0.1', port=None, timeout=None):
+        """
+        Arguments:
+        - `path`: Unix socket path of the server
+        - `host`, `port`: TCP address of the server if `path` is not given
+        - `timeout`: Socket timeout (s)
+        """
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port), timeout)
+        self._file = self.sock.makefile('rb')
+        self._id = 0
+
+    def call(self, op, **kwargs):
+        """
+        Send the request `op` with the arguments `kwargs` and return
+        its result; raise RequestError if the server reported an error
+        """
+        self._id += 1
+        request = dict(kwargs, op=op, id=self._id)
+        self.sock.sendall(json.dumps(request, default=_tolist).encode() +
+                          b'\n')
+        response = json.loads(self._file.readline())
+        if 'error' in response:
+            raise RequestError(response['error'])
+        return response['result']
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _tolist(obj):
+    "JSON serializable version of arrays"
+    return np.asarray(obj).tolist()
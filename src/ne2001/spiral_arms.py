@@ -5,12 +5,117 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+
 import numpy as np
 from scipy.interpolate import CubicSpline
+from scipy.spatial import cKDTree
 
+from .utils import cache_dir
+from .utils import fingerprint
 from .utils import rad2d2
 
 
+class ArmSearch(object):
+    """
+    Distance of points in the Galactic plane from the axes of the spiral arms
+
+    The nearest point of each arm polyline is found with a KD-tree and
+    refined on the cubic spline through the polyline, in the range of one
+    polyline point on each side, by Newton iterations on the precomputed
+    spline coefficients.
+    """
+
+    def __init__(self, adict, nstart=5, niter=4):
+        """
+        Arguments:
+        - `adict`: Spiral arms dict (see `ne_io.init_spiral_arms`)
+        - `nstart`: Number of starting points of the refinement per
+                    spline piece
+        - `niter`: Number of Newton iterations
+        """
+        self.nstart = nstart
+        self.niter = niter
+        self.kmax = np.array(adict['kmax'])
+        self.trees = []
+        self.coefs = []
+        for j in range(adict['narms']):
+            arm = adict['arm'][j, :self.kmax[j]]
+            self.trees.append(cKDTree(arm))
+            # x and y spline coefficients, each with shape (4, pieces)
+            self.coefs.append(CubicSpline(np.arange(self.kmax[j]),
+                                          arm).c.transpose(2, 0, 1))
+
+    def distance(self, j, x, y):
+        """ Minimal distance of `x`, `y` from the axis of arm `j`
+
+        Parameters
+        ----------
+        j : int
+          Arm index
+        x, y : ndarray
+          Galactocentric coordinates (kpc)
+
+        Returns
+        -------
+        smin : ndarray
+          Distance (kpc)
+
+        """
+        kmax = self.kmax[j]
+        npoints = len(x)
+        kmin = self.trees[j].query(np.column_stack([x, y]))[1]
+
+        # The spline is searched in [kmin - 1, kmin + 1] (extrapolated
+        # beyond the last point) which covers at most two spline pieces
+        t0 = np.maximum(0, kmin - 1)
+        t1 = np.minimum(kmax, kmin + 1)
+        lo = np.concatenate([t0, t0 + 1])
+        hi = np.concatenate([np.minimum(t0 + 1, t1), np.maximum(t1, t0 + 1)])
+        piece = np.minimum(lo, kmax - 2)
+        cx, cy = self.coefs[j][:, :, piece]
+        dist2 = _min_dist2(cx, cy, np.tile(x, 2), np.tile(y, 2),
+                           lo - piece, hi - piece, self.nstart, self.niter)
+        return np.sqrt(np.minimum(dist2[:npoints], dist2[npoints:]))
+
+
+def _min_dist2(cx, cy, x, y, s0, s1, nstart, niter):
+    """
+    Minimal squared distance of `x`, `y` from the cubic pieces with
+    coefficients `cx`, `cy` (shape (4, N)) with the local parameter
+    in [`s0`, `s1`]
+    """
+    def offset(s):
+        return (((cx[0]*s + cx[1])*s + cx[2])*s + cx[3] - x,
+                ((cy[0]*s + cy[1])*s + cy[2])*s + cy[3] - y)
+
+    # Coarse start
+    s = s0 + (s1 - s0)*np.linspace(0, 1, nstart)[:, None]
+    dx, dy = offset(s)
+    ibest = np.argmin(dx*dx + dy*dy, axis=0)
+    s = s[ibest, np.arange(len(x))]
+    dx, dy = offset(s)
+    dist2 = dx*dx + dy*dy
+
+    # Newton iterations on d(dist2)/ds = 0
+    for _ in range(niter):
+        d1x = (3*cx[0]*s + 2*cx[1])*s + cx[2]
+        d1y = (3*cy[0]*s + 2*cy[1])*s + cy[2]
+        grad = dx*d1x + dy*d1y
+        hess = (d1x*d1x + d1y*d1y + dx*(6*cx[0]*s + 2*cx[1]) +
+                dy*(6*cy[0]*s + 2*cy[1]))
+        ok = hess > 0
+        s_new = np.clip(s - grad/np.where(ok, hess, 1)*ok, s0, s1)
+        dx_new, dy_new = offset(s_new)
+        dist2_new = dx_new*dx_new + dy_new*dy_new
+        better = dist2_new < dist2
+        s = np.where(better, s_new, s)
+        dx = np.where(better, dx_new, dx)
+        dy = np.where(better, dy_new, dy)
+        dist2 = np.where(better, dist2_new, dist2)
+    return dist2
+
+
 def ne_spiral_arm(xyz, Aa, wa, ha, farms, harms, narms, warms, adict):
     """
     Parameters
@@ -44,6 +149,46 @@ def ne_spiral_arm(xyz, Aa, wa, ha, farms, harms, narms, warms, adict):
     else:
         flg_float = False
 
+    # Cut on values near the disk
+    nea = np.zeros_like(x)
+    icutz = np.where(np.abs(z/ha) < 10.)[0]
+    if len(icutz) == 0:
+        # Time to return
+        return nea
+    weight = arm_inplane(x[icutz], y[icutz], Aa, wa, narms, warms, adict)
+    for j in range(adict['narms']):
+        jj = adict['armmap'][j]
+        nea[icutz] += weight[j] / np.cosh(z[icutz]/(harms[jj - 1]*ha))**2
+    if flg_float:
+        nea = float(nea[0])
+
+    # Return
+    return nea
+
+    '''
+    Farms = 0
+    if(whicharm_spiralmodel .eq. 0) then
+    whicharm = 0
+    else
+      whicharm = armmap(whicharm_spiralmodel)	! remap arm number
+      Farms = Fa * farm(whicharm)
+    endif
+    return
+    end
+    '''
+
+
+def arm_inplane(x, y, Aa, wa, narms, warms, adict):
+    """
+    In-plane factor of the density of each spiral arm at `x`, `y`:
+    the arm weighting factor `ga` with the radial roll-off and the
+    arm-2/arm-3 reweighting, times `narms`
+
+    Returns
+    -------
+    weight : ndarray
+      Array with shape (narms, len(x))
+    """
     # see get_parameters for definitions of narm, warm, harm.
     # narmsmax = 5
     # common/armfactors/
@@ -53,12 +198,9 @@ def ne_spiral_arm(xyz, Aa, wa, ha, farms, harms, narms, warms, adict):
     rad = 180/np.pi
     # ks = 3
     # NN = 7
-    nfine = 1000
 
     # rr
-    rr = rad2d2(xyz)
-    if flg_float:
-        rr = np.array([rr])
+    rr = rad2d2([x, y])
 
     #
     # Get spiral arm component:  30 do loop finds a coarse minimum distance
@@ -69,67 +211,27 @@ def ne_spiral_arm(xyz, Aa, wa, ha, farms, harms, narms, warms, adict):
     # of arms allows (TJL)
 
     # Init
-    whicharm = np.zeros_like(x).astype(int)
-    nea = np.zeros_like(x)
+    weight = np.zeros((adict['narms'], len(x)))
 
     # thxy
     thxy = np.arctan2(-x, y) * rad  # measured ccw from +y axis (different from tc93 theta)
     neg_th = thxy < 0.
     thxy[neg_th] += 360.
-    # Cut on values near the disk
-    icutz = np.where(np.abs(z/ha) < 10.)[0]
-    if len(icutz) > 0:
-        cutx = x[icutz]
-        cuty = y[icutz]
-        cutz = z[icutz]
-        sminmin = 1.e10 * np.ones_like(cutx)
-    else:
-        # Time to return
-        return nea
-    # Find closest distance to each arm and then assign arm
-    #   We will brute force with a spline
-    #   Could get memory intensive
-    #   Could refine
+    # Find closest distance to each arm
+    search = adict.get('search')
+    if search is None:
+        search = adict['search'] = ArmSearch(adict)
     for j in range(adict['narms']):
         # do 50 j=1,narms
         jj = adict['armmap'][j]
-        # Crude
-        xarm = adict['arm'][j, :adict['kmax'][j], 0]
-        yarm = adict['arm'][j, :adict['kmax'][j], 1]
-
-        xtmp = np.outer(cutx, np.ones_like(xarm))
-        ytmp = np.outer(cuty, np.ones_like(yarm))
-        xatmp = np.outer(np.ones_like(cutx), xarm)
-        yatmp = np.outer(np.ones_like(cuty), yarm)
-        dist = (xtmp-xatmp)**2 + (ytmp-yatmp)**2
-        kmin = np.argmin(dist, axis=1)
-
-        # Refine with a Spline? -- Requires a loop
-        csp_xarm = CubicSpline(np.arange(adict['kmax'][j]),
-                               adict['arm'][j, :adict['kmax'][j], 0])
-        csp_yarm = CubicSpline(np.arange(adict['kmax'][j]),
-                               adict['arm'][j, :adict['kmax'][j], 1])
-        jtmp = np.zeros((len(cutx), nfine))
-        for ii, ix in enumerate(cutx):
-            j0 = max(0, kmin[ii]-1)
-            j1 = min(adict['kmax'][j], kmin[ii]+1)
-            jtmp[ii, :] = np.linspace(j0, j1, num=nfine)
-        xjarm = csp_xarm(jtmp)
-        yjarm = csp_yarm(jtmp)
-        xtmp = np.outer(cutx, np.ones(nfine))
-        ytmp = np.outer(cuty, np.ones(nfine))
-        dist = (xtmp-xjarm)**2 + (ytmp-yjarm)**2
-        # kmin2 = np.argmin(dist, axis=1)
-        min_dist2 = np.amin(dist, axis=1)
-
-        smin = np.sqrt(min_dist2)  # Distance of (x,y,z) from this arm's axis
+        smin = search.distance(j, x, y)  # Distance of (x,y,z) from this arm's axis
         # Close enough?
         gd_wa = np.where(smin < (3*wa))[0]
         if len(gd_wa) > 0:
             # ga
             ga = np.exp(-(smin[gd_wa]/warms[jj - 1]/wa)**2)  # arm, get the arm weighting factor
             # Galactocentric radial dependence of arms
-            tmp_rr = rr[icutz[gd_wa]]
+            tmp_rr = rr[gd_wa]
             lg_rr = tmp_rr > Aa
             if np.sum(lg_rr) > 0:
                 ga[lg_rr] *= 1. / (np.cosh((tmp_rr[lg_rr]-Aa)/2.0))**2
@@ -143,12 +245,12 @@ def ne_spiral_arm(xyz, Aa, wa, ha, farms, harms, narms, warms, adict):
                 th3b = 363.
                 th3b = 363.
                 fac3min = 0.0
-                test3 = thxy[icutz[gd_wa]]-th3a
+                test3 = thxy[gd_wa]-th3a
                 neg_t3 = test3 < 0
                 test3[neg_t3] += 360.
                 gd_t3 = (0. <= test3) & (test3 < (th3b-th3a))
                 if np.sum(gd_t3) > 0:
-                    arg = 6.2831853*(thxy[icutz[gd_wa]][gd_t3]-th3a)/(th3b-th3a)
+                    arg = 6.2831853*(thxy[gd_wa][gd_t3]-th3a)/(th3b-th3a)
                     fac = (1.+fac3min + (1.-fac3min)*np.cos(arg))/2.
                     fac = fac**4.0
                     # Update ga
@@ -158,7 +260,7 @@ def ne_spiral_arm(xyz, Aa, wa, ha, farms, harms, narms, warms, adict):
             if adict['armmap'][j] == 2:
                 th2a = 35.
                 th2b = 55.
-                test2 = thxy[icutz[gd_wa]]-th2a
+                test2 = thxy[gd_wa]-th2a
                 fac = 1.
                 if False:
                     #    first: as in tc93 (note different definition of theta)
@@ -181,34 +283,148 @@ def ne_spiral_arm(xyz, Aa, wa, ha, farms, harms, narms, warms, adict):
                 test2[neg_t2] += 360.
                 gd_t2_snd = (0. <= test2) & (test2 < (th2b-th2a))
                 if np.sum(gd_t2_snd) > 0:
-                    arg = 6.2831853*(thxy[icutz[gd_wa]][gd_t2_snd]-th2a)/(th2b-th2a)
+                    arg = 6.2831853*(thxy[gd_wa][gd_t2_snd]-th2a)/(th2b-th2a)
                     fac = (1.+fac2min + (1.-fac2min)*np.cos(arg))/2.
                     # Update ga
                     ga[gd_t2_snd] *= fac
 
-            # Find the ones which are closer than any previous arm
-            iclosest = smin[gd_wa] < sminmin[gd_wa]
-            if np.sum(iclosest) > 0:
-                whicharm[icutz[gd_wa[iclosest]]] = adict['armmap'][j]
+            weight[j, gd_wa] = narms[jj - 1] * ga
+    return weight
 
-            # Update nea
-            nea[icutz[gd_wa]] += narms[jj - 1] * (
-                ga / (np.cosh(cutz[gd_wa]/(harms[jj - 1]*ha))**2))
-    if flg_float:
-        nea = float(nea[0])
-        whicharm = int(whicharm[0])
 
-    # Return
-    return nea
+class SpiralArmGrid(object):
+    """
+    Lookup table of the in-plane factor (see `arm_inplane`) of each spiral
+    arm on a square grid of the Galactic plane.
 
-    '''
-    Farms = 0
-    if(whicharm_spiralmodel .eq. 0) then
-    whicharm = 0
-    else
-      whicharm = armmap(whicharm_spiralmodel)	! remap arm number
-      Farms = Fa * farm(whicharm)
-    endif
-    return
-    end
-    '''
+    The density is the bilinear interpolation of the table times the
+    analytic sech**2 vertical profile of each arm. Points outside the
+    grid are evaluated exactly.
+    """
+
+    def __init__(self, weight, extent, step, max_error, params):
+        """
+        Arguments:
+        - `weight`: In-plane factor with shape (narms, ny, nx)
+        - `extent`: Half side of the grid (kpc)
+        - `step`: Grid step (kpc)
+        - `max_error`: Maximal interpolation error of the in-plane factor
+        - `params`: Spiral arms parameters
+        """
+        self.weight = weight
+        self.extent = extent
+        self.step = step
+        self.max_error = max_error
+        self.params = params
+
+    @property
+    def max_rel_error(self):
+        "Maximal interpolation error relative to the peak in-plane factor"
+        return self.max_error/np.max(self.weight)
+
+    @classmethod
+    def build(cls, step=0.05, extent=20., cache=True, block_size=2**16,
+              **params):
+        """ Tabulate the in-plane factor of the spiral arms
+
+        The table is cached in `utils.cache_dir()` for each set of
+        parameters, `step` and `extent`.
+
+        Parameters
+        ----------
+        step : float, optional
+          Grid step (kpc)
+        extent : float, optional
+          Half side of the grid (kpc)
+        cache : bool, optional
+          Read and write the table from the cache directory
+        block_size : int, optional
+          Maximal number of points evaluated at once
+        **params :
+          Spiral arms parameters (see `ne_spiral_arm`)
+
+        Returns
+        -------
+        grid : SpiralArmGrid
+
+        """
+        inplane_params = dict(
+            (key, params[key])
+            for key in ('Aa', 'wa', 'narms', 'warms', 'adict'))
+        path = os.path.join(cache_dir(), 'arm_grid_{}.npz'.format(
+            fingerprint(dict(inplane_params, step=step, extent=extent))))
+        if cache and os.path.exists(path):
+            with np.load(path) as data:
+                return cls(data['weight'], extent, step,
+                           float(data['max_error']), params)
+
+        nodes = np.linspace(-extent, extent, int(round(2*extent/step)) + 1)
+        weight = _tabulate(nodes, nodes, inplane_params, block_size)
+        # The interpolation error is largest at the cell centers
+        centers = nodes[:-1] + (nodes[1] - nodes[0])/2
+        exact = _tabulate(centers, centers, inplane_params, block_size)
+        interp = (weight[:, :-1, :-1] + weight[:, 1:, :-1] +
+                  weight[:, :-1, 1:] + weight[:, 1:, 1:])/4
+        max_error = float(np.max(np.abs(interp - exact)))
+
+        weight = weight.astype(np.float32)
+        if cache:
+            np.savez(path, weight=weight, max_error=max_error)
+        return cls(weight, extent, step, max_error, params)
+
+    def __call__(self, xyz):
+        "Spiral arms density at x, y, z = `xyz`"
+        x, y, z = (np.atleast_1d(xyz[0]), np.atleast_1d(xyz[1]),
+                   np.atleast_1d(xyz[-1]))
+        params = self.params
+        adict = params['adict']
+        nea = np.zeros(x.shape)
+        icutz = np.where(np.abs(z/params['ha']) < 10.)[0]
+        x, y, z = x[icutz], y[icutz], z[icutz]
+
+        weight = np.zeros((adict['narms'], len(icutz)))
+        inside = (np.abs(x) <= self.extent) & (np.abs(y) <= self.extent)
+        nmax = self.weight.shape[-1] - 2
+        fx = (x[inside] + self.extent)/self.step
+        fy = (y[inside] + self.extent)/self.step
+        ix = np.clip(fx.astype(int), 0, nmax)
+        iy = np.clip(fy.astype(int), 0, nmax)
+        tx = fx - ix
+        ty = fy - iy
+        weight[:, inside] = (
+            (1 - ty)*((1 - tx)*self.weight[:, iy, ix] +
+                      tx*self.weight[:, iy, ix + 1]) +
+            ty*((1 - tx)*self.weight[:, iy + 1, ix] +
+                tx*self.weight[:, iy + 1, ix + 1]))
+        if not inside.all():
+            weight[:, ~inside] = arm_inplane(
+                x[~inside], y[~inside], params['Aa'], params['wa'],
+                params['narms'], params['warms'], adict)
+
+        harms = params['harms']
+        for j in range(adict['narms']):
+            jj = adict['armmap'][j]
+            nea[icutz] += weight[j] / np.cosh(z/(harms[jj - 1] *
+                                                 params['ha']))**2
+        if np.ndim(xyz[0]) == 0:
+            return float(nea[0])
+        return nea
+
+
+def _tabulate(xnodes, ynodes, params, block_size):
+    "In-plane factor on the grid `xnodes` x `ynodes`"
+    x, y = np.meshgrid(xnodes, ynodes)
+    x, y = x.ravel(), y.ravel()
+    weight = np.concatenate([
+        arm_inplane(x[i:i + block_size], y[i:i + block_size], **params)
+        for i in range(0, x.size, block_size)], axis=1)
+    return weight.reshape(-1, len(ynodes), len(xnodes))
+
+
+def ne_spiral_arm_grid(step=0.05, extent=20., cache=True, **params):
+    """
+    Spiral arms density function using a `SpiralArmGrid` lookup table
+    (see `ne_spiral_arm` for the parameters)
+    """
+    return SpiralArmGrid.build(step=step, extent=extent, cache=cache,
+                               **params)
@@ -0,0 +1,369 @@
+""" Numeric state and compiled artifacts of the electron density model
+
+`model_state` reduces an `ElectronDensity` to a tree of dicts and lists whose
+leaves are numbers, strings and numeric arrays (parameters, arm polylines,
+clump and void tables, positions and void rotation matrices), and
+`model_from_state` rebuilds the model from it without reading the data
+files. The state is shared with worker processes by `ne2001.parallel`, and
+saved as a single `.npz` file by `save_state`. `load_model` keeps these
+compiled models in the cache directory, keyed by the input files and the
+parameters, and `REGISTRY` shares the models built with the same inputs
+within a process (see `ElectronDensity.get`).
+"""
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from collections import namedtuple
+
+import numpy as np
+from astropy.table import Table
+
+from . import density
+from . import ne_io
+from .spiral_arms import ArmSearch
+from .utils import cache_dir
+from .utils import fingerprint
+
+# Version of the compiled model files
+STATE_VERSION = 2
+
+# Alignment of the arrays packed in a single buffer (bytes)
+ALIGN = 64
+
+RegistryInfo = namedtuple('RegistryInfo', ['hits', 'misses', 'evictions',
+                                           'maxsize', 'currsize'])
+
+
+def model_state(model):
+    """ Numeric state of the model `model`
+
+    Parameters
+    ----------
+    model : ElectronDensity
+
+    Returns
+    -------
+    state : dict
+      Tree of dicts and lists holding numbers, strings and arrays
+
+    """
+    params = dict(model.params)
+    if 'adict' in params.get('spiral_arms', {}):
+        arms = params['spiral_arms'] = dict(params['spiral_arms'])
+        adict = arms['adict'] = dict((key, val) for key, val
+                                     in arms['adict'].items()
+                                     if key != 'search')
+        adict['table'] = np.asarray(adict['table'].as_array())
+    state = dict(params=params, components=list(model.components),
+                 xyz_sun=np.asarray(density.XYZ_SUN, dtype=float),
+                 backend=model.backend, fingerprint=model.fingerprint)
+    if model._clumps is not None:
+        state['clumps'] = dict(
+            data=np.asarray(model._clumps._data.as_array()),
+            xyz=model._clumps.xyz)
+    if model._voids is not None:
+        state['voids'] = dict(data=np.asarray(model._voids._data.as_array()),
+                              xyz=model._voids.xyz,
+                              rotation=model._voids.rotation,
+                              xyz_rot=model._voids.xyz_rot)
+    return state
+
+
+def model_from_state(state, backend=None):
+    """ Rebuild the model from its state (see `model_state`)
+
+    The arrays of the state are used without copies, except the position
+    of the Sun which is set globally (see `density.set_xyz_sun`).
+
+    Arguments:
+    - `state`: State of the model
+    - `backend`: Backend of the model (default: that of the state)
+    """
+    density.set_xyz_sun(np.array(state['xyz_sun']))
+    params = dict(state['params'])
+    if 'adict' in params.get('spiral_arms', {}):
+        arms = params['spiral_arms'] = dict(params['spiral_arms'])
+        adict = arms['adict'] = dict(arms['adict'])
+        adict['table'] = Table(adict['table'], copy=False)
+        adict['search'] = ArmSearch(adict)
+    model = density.ElectronDensity(
+        clumps_file=state.get('clumps', {}).get('data'),
+        voids_file=state.get('voids', {}).get('data'),
+        backend=backend or state['backend'],
+        components=state['components'], ifile=None, **params)
+    if model._clumps is not None:
+        model._clumps._xyz = state['clumps']['xyz']
+    if model._voids is not None:
+        model._voids._xyz = state['voids']['xyz']
+        model._voids._rotation = state['voids']['rotation']
+        model._voids._xyz_rot = state['voids']['xyz_rot']
+    model._fingerprint = state['fingerprint']
+    return model
+
+
+def _split(tree, arrays):
+    """
+    Replace the numeric arrays of `tree` by references ({'__array__': i})
+    to their index in `arrays`
+    """
+    if isinstance(tree, dict):
+        return dict((key, _split(val, arrays)) for key, val in tree.items())
+    if isinstance(tree, (list, tuple)):
+        return type(tree)(_split(val, arrays) for val in tree)
+    if isinstance(tree, np.ndarray) and not tree.dtype.hasobject:
+        arrays.append(tree)
+        return {'__array__': len(arrays) - 1}
+    return tree
+
+
+def _join(tree, arrays):
+    "Inverse of `_split`"
+    if isinstance(tree, dict):
+        if list(tree) == ['__array__']:
+            return arrays[tree['__array__']]
+        return dict((key, _join(val, arrays)) for key, val in tree.items())
+    if isinstance(tree, (list, tuple)):
+        return type(tree)(_join(val, arrays) for val in tree)
+    return tree
+
+
+def _layout(arrays):
+    """ Layout of `arrays` packed in a single buffer
+
+    Returns
+    -------
+    layout : list
+      Offset (bytes), dtype (str or descr) and shape of each array
+    size : int
+      Size of the buffer (bytes)
+
+    """
+    layout = []
+    size = 0
+    for array in arrays:
+        layout.append((size, array.dtype.descr if array.dtype.names
+                       else array.dtype.str, array.shape))
+        size += -(-array.nbytes // ALIGN)*ALIGN
+    return layout, size
+
+
+def _dtype(dtype):
+    "dtype of a layout, possibly read back from JSON (lists for tuples)"
+    if isinstance(dtype, list):
+        dtype = [tuple(_dtype(item) if isinstance(item, list) else item
+                       for item in field) for field in dtype]
+    return np.dtype(dtype)
+
+
+def _pack(arrays, layout, buffer):
+    "Copy `arrays` into `buffer` at the offsets of `layout`"
+    for array, (offset, dtype, shape) in zip(arrays, layout):
+        np.ndarray(shape, dtype=_dtype(dtype), buffer=buffer,
+                   offset=offset)[...] = array
+
+
+def _unpack(layout, buffer, writeable=True):
+    "Views of the arrays packed in `buffer` (see `_layout`)"
+    arrays = []
+    for offset, dtype, shape in layout:
+        array = np.ndarray(tuple(shape), dtype=_dtype(dtype), buffer=buffer,
+                           offset=offset)
+        array.flags.writeable = writeable
+        arrays.append(array)
+    return arrays
+
+
+def save_state(path, state):
+    """ Write the state tree `state` to `path` (npz)
+
+    The arrays are packed in a single member, so that the file is read
+    at once.
+    """
+    arrays = []
+    skeleton = _split(state, arrays)
+    layout, size = _layout(arrays)
+    data = np.zeros(size, dtype=np.uint8)
+    _pack(arrays, layout, data)
+    header = json.dumps(dict(skeleton=skeleton, layout=layout),
+                        default=lambda obj: np.asarray(obj).tolist())
+    np.savez(path, header=header, version=STATE_VERSION, data=data)
+
+
+def load_state(path):
+    """ Read a state tree written by `save_state`
+
+    Raise ValueError if the file was written by another version.
+    """
+    with np.load(path) as data:
+        if int(data['version']) != STATE_VERSION:
+            raise ValueError("Model file {} version {} is not supported "
+                             "({})".format(path, int(data['version']),
+                                           STATE_VERSION))
+        header = json.loads(str(data['header']))
+        buffer = data['data']
+    return _join(header['skeleton'], _unpack(header['layout'], buffer))
+
+
+def model_key(clumps_file=None, voids_file=None, components=None, **params):
+    """
+    SHA1 digest of the input files and parameters of
+    `ElectronDensity(clumps_file, voids_file, components=components,
+    **params)`, and of the position of the Sun
+    """
+    components = [name for name in density.COMPONENTS
+                  if components is None or name in components]
+    params = dict(params)
+    path = params.pop('path', None) or ne_io.DATA_PATH
+    ifile = params.pop('ifile', 'ne2001_params.json')
+    # No parameters file with ifile=None: all the parameters are in params
+    files = [] if ifile is None else [os.path.join(path, ifile)]
+    arms_file = params.pop('arms_file', ne_io.ARMS_FILE)
+    if 'spiral_arms' in components and arms_file is not None:
+        files.append(os.path.join(ne_io.DATA_PATH, arms_file))
+    if 'clumps' in components:
+        files.append(density.CLUMPS_FILE if clumps_file is None
+                     else clumps_file)
+    if 'voids' in components:
+        files.append(density.VOIDS_FILE if voids_file is None
+                     else voids_file)
+
+    sha = hashlib.sha1(str(STATE_VERSION).encode())
+    for name in files:
+        if isinstance(name, (Table, np.ndarray)):
+            sha.update(fingerprint(Table(name, copy=False)).encode())
+        else:
+            sha.update(ne_io.file_digest(name).encode())
+    sha.update(fingerprint(dict(params=params,
+                                components=components)).encode())
+    sha.update(np.asarray(density.XYZ_SUN, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+def load_model(clumps_file=None, voids_file=None, backend='numpy',
+               components=None, cache=True, **params):
+    """ Electron density model, loaded from its compiled file if cached
+
+    The model is built from the data files on first use and compiled into
+    the cache directory (see `utils.cache_dir`), as one file per set of
+    input files, parameters and position of the Sun.
+
+    Parameters
+    ----------
+    clumps_file : str, optional
+      Clumps file (default: the NE2001 clumps)
+    voids_file : str, optional
+      Voids file (default: the NE2001 voids)
+    backend : str, optional
+      'numpy' or 'numba' (see ElectronDensity)
+    components : list, optional
+      Names of the components to include (default: all)
+    cache : bool, optional
+      Read and write the compiled model from the cache directory
+    **params
+      Model parameters (see `ne_io.Params`)
+
+    Returns
+    -------
+    model : ElectronDensity
+
+    """
+    if cache:
+        path = os.path.join(cache_dir(), 'model_{}.npz'.format(model_key(
+            clumps_file, voids_file, components, **params)))
+        if os.path.exists(path):
+            try:
+                return model_from_state(load_state(path), backend)
+            except (IOError, ValueError, KeyError, EOFError,
+                    zipfile.BadZipFile):
+                pass  # Rebuilt below (corrupt or outdated file)
+
+    model = density.ElectronDensity(clumps_file, voids_file, backend,
+                                    components, **params)
+    if cache:
+        # Written under a temporary name so that concurrent readers never
+        # see a partial file
+        tmp_path = '{}.{}.npz'.format(path[:-4], os.getpid())
+        save_state(tmp_path, model_state(model))
+        os.replace(tmp_path, path)
+    return model
+
+
+class ModelRegistry(object):
+    """
+    LRU registry of shared electron density models
+
+    The models are keyed by `model_key` and their backend, so that a data
+    file modified on disk gives a new model. The registered models are
+    shared: `use_arm_grid` and `enable_cache` raise ValueError on them.
+    """
+
+    def __init__(self, maxsize=8):
+        """
+        Arguments:
+        - `maxsize`: Maximal number of registered models
+        """
+        self.maxsize = maxsize
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        "Remove all the models and reset the statistics"
+        with self._lock:
+            self._models.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        "Registry statistics"
+        return RegistryInfo(self.hits, self.misses, self.evictions,
+                            self.maxsize, len(self._models))
+
+    @staticmethod
+    def key(clumps_file=None, voids_file=None, backend='numpy',
+            components=None, **params):
+        "Key of the model built with these arguments"
+        return (model_key(clumps_file, voids_file, components, **params),
+                backend)
+
+    def get(self, clumps_file=None, voids_file=None, backend='numpy',
+            components=None, **params):
+        """
+        Shared model built with the arguments of ElectronDensity;
+        loaded on first use through `load_model` (compiled model cache)
+        """
+        key = self.key(clumps_file, voids_file, backend, components,
+                       **params)
+        with self._lock:
+            model = self._models.pop(key, None)
+            if model is None:
+                self.misses += 1
+                model = load_model(clumps_file, voids_file, backend,
+                                   components, **params)
+                model._shared = True
+            else:
+                self.hits += 1
+            self._models[key] = model
+            while len(self._models) > self.maxsize:
+                self._models.popitem(last=False)
+                self.evictions += 1
+            return model
+
+    def invalidate(self, clumps_file=None, voids_file=None, backend='numpy',
+                   components=None, **params):
+        """
+        Remove the model built with these arguments; return whether it
+        was registered
+        """
+        key = self.key(clumps_file, voids_file, backend, components,
+                       **params)
+        with self._lock:
+            return self._models.pop(key, None) is not None
+
+
+# Registry of the models shared by `ElectronDensity.get`
+REGISTRY = ModelRegistry()
@@ -1,6 +1,10 @@
 "Some utility methods"
 from __future__ import division
 
+import hashlib
+import json
+import os
+
 import numpy as np
 from numpy import cos
 from numpy import pi
@@ -95,6 +99,51 @@ def galactic_to_galactocentric(l, b, distance, xyz_sun):
     return np.array([xc, yc, zc])
 
 
+def interp_rows(y, yp, xp):
+    """
+    Row by row linear interpolation of `y` in the monotonically
+    increasing rows of `yp`
+    """
+    k = np.clip(np.argmax(yp >= y[:, None], axis=1), 1, yp.shape[1] - 1)
+    rows = np.arange(len(y))
+    y0, y1 = yp[rows, k-1], yp[rows, k]
+    x0, x1 = xp[rows, k-1], xp[rows, k]
+    return x0 + (x1 - x0)*(y - y0)/np.where(y1 > y0, y1 - y0, 1)
+
+
+def ray_box(origin, direction, lo, hi, length):
+    """
+    Interval (s1, s2) of the ray `origin` + s*`direction`, 0 <= s <= `length`,
+    inside the axis-aligned box [`lo`, `hi`] (slab method); None if it misses
+    """
+    s1, s2 = 0., float(length)
+    for p, u, a, b in zip(origin, direction, lo, hi):
+        if u == 0:
+            if p < a or p > b:
+                return None
+            continue
+        ta, tb = (a - p)/u, (b - p)/u
+        s1, s2 = max(s1, min(ta, tb)), min(s2, max(ta, tb))
+        if s1 >= s2:
+            return None
+    return s1, s2
+
+
+def union_intervals(intervals):
+    "Sorted disjoint union of the intervals (an array of shape (n, 2))"
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+    if not intervals.size:
+        return intervals
+    intervals = intervals[np.argsort(intervals[:, 0])]
+    # An interval starts a new group if it begins after all the previous end
+    start = np.append(True, intervals[1:, 0] >
+                      np.maximum.accumulate(intervals[:-1, 1]))
+    group = np.cumsum(start) - 1
+    hi = np.full(group[-1] + 1, -np.inf)
+    np.maximum.at(hi, group, intervals[:, 1])
+    return np.column_stack([intervals[start, 0], hi])
+
+
 def lzproperty(attribute):
     """
     Lazy property: evaluate property only once
@@ -139,6 +188,12 @@ def rad3d2(xyz):
     return xyz[0]**2 + xyz[1]**2 + xyz[-1]**2
 
 
+def relative_to(xyz, center):
+    "Locations `xyz` (shape (3,) or (3, ...)) relative to `center`"
+    xyz = np.asarray(xyz)
+    return xyz - np.reshape(center, (3,) + (1,)*(xyz.ndim - 1))
+
+
 def rad2d2(xyz):
     return xyz[0]**2 + xyz[1]**2
 
@@ -148,3 +203,36 @@ def matmul(a, b):
         return a.__matmul__(b)
     except AttributeError:
         return np.matmul(a, b)
+
+
+def _jsonify(obj):
+    "JSON serializable version of `obj` (used for fingerprints)"
+    try:
+        return obj.as_array().tolist()  # astropy Table
+    except AttributeError:
+        pass
+    try:
+        return obj.tolist()
+    except AttributeError:
+        return type(obj).__name__
+
+
+def fingerprint(obj):
+    "SHA1 digest identifying `obj` (a dict of parameters and arrays)"
+    return hashlib.sha1(json.dumps(obj, sort_keys=True,
+                                   default=_jsonify).encode()).hexdigest()
+
+
+def cache_dir():
+    """
+    Directory for files cached by ne2001: $NE2001_CACHE_DIR,
+    or ne2001 in the user cache directory
+    """
+    path = os.environ.get('NE2001_CACHE_DIR')
+    if not path:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.join(os.path.expanduser('~'), '.cache'),
+                            'ne2001')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
@@ -0,0 +1,243 @@
+""" Benchmarks of the electron density model
+
+Times each component, the full model density over 1 to 10**7 points (in
+memory-bounded blocks with `ne_many` beyond 10**5 points), the
+DM with each integrator over short and 100 kpc sightlines, the distance
+estimates, and the model construction and import. The wall time is the
+best of `--repeat` runs, and the peak memory is measured by tracemalloc in
+a separate run (tracemalloc slows down the allocations)::
+
+    python tests/profile/benchmark_ne2001.py -o bench.json
+    python tests/profile/benchmark_ne2001.py --baseline bench.json
+
+With `--baseline`, the run fails (exit status 1) if a benchmark is slower
+than the baseline by more than `--time-tol` (relative, and at least
+`--time-floor` s), or uses more than `--memory-tol` more memory.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.integrate import quad
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) +
+                '/../../src/')
+
+from ne2001 import density  # noqa: E402 isort:skip
+from ne2001.integrators import simpson_rule  # noqa: E402 isort:skip
+from ne2001.integrators import trapezoid_rule  # noqa: E402 isort:skip
+from ne2001.state import load_model  # noqa: E402 isort:skip
+
+# Components evaluated separately: attribute of ElectronDensity
+COMPONENTS = {'thick_disk': '_thick_disk',
+              'thin_disk': '_thin_disk',
+              'gc': '_galactic_center',
+              'LocalISM': '_lism',
+              'Clumps': '_clumps',
+              'Voids': '_voids',
+              'ne_spiral_arm': '_spiral_arms'}
+
+# Largest number of points evaluated by a single `ne` call: the working
+# memory is about 1 kB per point (see density.BYTES_PER_POINT)
+MAX_NE = 10**5
+
+# Named as in the earlier results
+INTEGRATORS = {'quad': quad, 'trapz': trapezoid_rule, 'simps': simpson_rule}
+
+# Sightlines (l, b, d) of the DM benchmarks
+SIGHTLINES = {'short': (-2, 12, 1), 'long': (30, 5, 100)}
+
+
+def parser(options=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the NE2001 model')
+    parser.add_argument("-o", "--output", help="JSON output file")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--max-n", type=float, default=1e7, help="Largest number of points of the density benchmarks")
+    parser.add_argument("--sightlines", type=int, default=100, help="Number of sightlines of the DM_many and dist_many benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs")
+    parser.add_argument("--only", help="Run only the benchmarks whose name contains this string")
+    parser.add_argument("--backend", default='numpy', help="Model backend (numpy or numba)")
+    parser.add_argument("--time-tol", type=float, default=0.25, help="Allowed relative slowdown")
+    parser.add_argument("--time-floor", type=float, default=0.002, help="Allowed absolute slowdown (s)")
+    parser.add_argument("--memory-tol", type=float, default=0.25, help="Allowed relative memory increase")
+    parser.add_argument("--quick", action='store_true', help="Same as --max-n 1e5 --sightlines 10 --repeat 1")
+
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+    if args.quick:
+        args.max_n = min(args.max_n, 1e5)
+        args.sightlines = min(args.sightlines, 10)
+        args.repeat = 1
+    return args
+
+
+def random_points(n, seed=0):
+    "`n` random Galactocentric positions (kpc) within the model box"
+    rng = np.random.RandomState(seed)
+    return (rng.uniform(-20, 20, (3, n)) *
+            np.array([[1], [1], [0.1]]))
+
+
+def benchmarks(model, max_n=1e7, nsightlines=100):
+    """
+    Dict of the benchmarks: name -> (function to time, number of points
+    or sightlines)
+    """
+    bench = {}
+    xyz = random_points(10**5)
+    for name, attr in COMPONENTS.items():
+        bench['component.' + name] = (
+            lambda obj=getattr(model, attr): obj.ne(xyz), xyz.shape[1])
+
+    # Beyond MAX_NE points, in memory-bounded blocks (ne_many)
+    n = 1
+    while n <= max_n:
+        if n <= MAX_NE:
+            bench['ne.{:.0e}'.format(n)] = (
+                lambda n=n: model.ne(random_points(n)), n)
+        else:
+            bench['ne_many.{:.0e}'.format(n)] = (
+                lambda n=n: model.ne_many(random_points(n)), n)
+        n *= 10
+
+    for sname, (l, b, d) in SIGHTLINES.items():
+        for iname, integrator in INTEGRATORS.items():
+            bench['DM.{}.{}'.format(iname, sname)] = (
+                lambda l=l, b=b, d=d, integrator=integrator:
+                model.DM(l, b, d, integrator=integrator), 1)
+
+    rng = np.random.RandomState(1)
+    l = rng.uniform(0, 360, nsightlines)
+    b = rng.uniform(-10, 10, nsightlines)
+    bench['DM_many'] = (lambda: model.DM_many(l, b, 10), l.size)
+    bench['dist'] = (lambda: model.dist(30, 0, 50), 1)
+    bench['dist_many'] = (lambda: model.dist_many(l, b, 50), l.size)
+
+    bench['construct'] = (lambda: density.ElectronDensity(
+        backend=model.backend), 1)
+    bench['construct.cached'] = (lambda: load_model(
+        backend=model.backend), 1)
+    return bench
+
+
+def measure(func, repeat=3):
+    """ Wall time and peak memory of `func()`
+
+    Returns
+    -------
+    result : dict
+      `time` (best of `repeat` runs, s), `median` (s) and `peak_memory`
+      (bytes allocated at the peak, over those allocated before the call)
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    # Started afresh for each benchmark, so that the peak is its own
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return dict(time=min(times), median=float(np.median(times)),
+                peak_memory=peak)
+
+
+def import_time(repeat=3):
+    "Wall time of `import ne2001.density` in a new interpreter"
+    code = ('import time; start = time.perf_counter(); '
+            'import ne2001.density; print(time.perf_counter() - start)')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    times = [float(subprocess.check_output([sys.executable, '-c', code],
+                                           env=env))
+             for _ in range(repeat)]
+    return dict(time=min(times), median=float(np.median(times)),
+                peak_memory=None)
+
+
+def run(pargs):
+    "Run the benchmarks; return the results dict"
+    model = density.ElectronDensity(backend=pargs.backend)
+    bench = benchmarks(model, pargs.max_n, pargs.sightlines)
+    bench['import'] = (None, 1)
+    results = {}
+    for name, (func, n) in bench.items():
+        if pargs.only and pargs.only not in name:
+            continue
+        if func is None:
+            results[name] = dict(import_time(pargs.repeat), n=n)
+        else:
+            func()  # Warm up (caches, compilation)
+            results[name] = dict(measure(func, pargs.repeat), n=n)
+        print("{:24s} {:12.6f} s {:>14} B".format(
+            name, results[name]['time'],
+            results[name]['peak_memory'] or '-'))
+    return dict(results=results,
+                machine=dict(python=platform.python_version(),
+                             numpy=np.__version__,
+                             platform=platform.platform(),
+                             processor=platform.processor()),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                backend=pargs.backend, repeat=pargs.repeat)
+
+
+def compare(results, baseline, time_tol=0.25, time_floor=0.002,
+            memory_tol=0.25):
+    """ Regressions of `results` with respect to `baseline`
+
+    Returns
+    -------
+    regressions : list
+      Messages describing the regressions (empty if none)
+
+    """
+    regressions = []
+    for name, res in sorted(results['results'].items()):
+        ref = baseline['results'].get(name)
+        if ref is None:
+            continue
+        if (res['time'] > ref['time']*(1 + time_tol) and
+                res['time'] - ref['time'] > time_floor):
+            regressions.append("{}: time {:.6f} s > {:.6f} s".format(
+                name, res['time'], ref['time']))
+        if (res['peak_memory'] is not None and ref['peak_memory'] and
+                res['peak_memory'] > ref['peak_memory']*(1 + memory_tol)):
+            regressions.append("{}: peak memory {} B > {} B".format(
+                name, res['peak_memory'], ref['peak_memory']))
+    return regressions
+
+
+def main(pargs):
+    """ Run
+    """
+    results = run(pargs)
+    if pargs.output:
+        with open(pargs.output, 'w') as fh:
+            json.dump(results, fh, indent=1, sort_keys=True)
+    if pargs.baseline:
+        with open(pargs.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, pargs.time_tol,
+                              pargs.time_floor, pargs.memory_tol)
+        for message in regressions:
+            print("REGRESSION " + message)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parser()))
@@ -0,0 +1,100 @@
+""" Tests on the command line app """
+
+import io
+import subprocess
+import sys
+
+import numpy as np
+from click.testing import CliRunner
+
+from ne2001 import density
+from ne2001.catalog import CatalogReader
+from ne2001.catalog import CatalogWriter
+from ne2001.cli import main
+
+
+def test_dm():
+    runner = CliRunner()
+    result = runner.invoke(main, ['dm', '--nsamp', '500', '--chunk-size',
+                                  '2'],
+                           input='name,l,b,d\nA,30,2,5\nB,10,1,1\n\n'
+                           'C,200,5,2\n')
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0] == 'name,l,b,d,DM'
+    DM = np.array([float(line.split(',')[-1]) for line in lines[1:]])
+    ed = density.ElectronDensity()
+    assert np.allclose(DM, ed.DM_integrate([30, 10, 200], [2, 1, 5],
+                                           [5, 1, 2], 'trapezoid', nsamp=500,
+                                           quantity=False)[0])
+    assert [line.split(',')[0] for line in lines[1:]] == ['A', 'B', 'C']
+
+    result = runner.invoke(main, ['dm', '--format', 'tsv', '--integrator',
+                                  'quad', '--columns', '2,0,1'],
+                           input='2\t5\t30\n')
+    assert result.exit_code == 0, result.output
+    assert np.isclose(float(result.output.split('\t')[-1]),
+                      ed.DM(30, 2, 5).value)
+
+    result = runner.invoke(main, ['dm', '--integrator', 'gauss-kronrod',
+                                  '--epsrel', '1e-8'],
+                           input='l,b,d\n30,2,5\n')
+    assert result.exit_code == 0, result.output
+    assert np.isclose(float(result.output.splitlines()[-1].split(',')[-1]),
+                      ed.DM_integrate(30, 2, 5, epsrel=1e-8,
+                                      quantity=False)[0], rtol=1e-12)
+    result = runner.invoke(main, ['dm', '--integrator', 'gauss-legendre',
+                                  '--nsamp', '10'],
+                           input='l,b,d\n30,2,5\n')
+    assert result.exit_code == 2
+
+    result = runner.invoke(main, ['dm', '--columns', 'l,b'],
+                           input='l,b,d\n30,2,5\n')
+    assert result.exit_code == 2
+
+
+def test_lazy_imports():
+    # The process pools (and shared memory) are only loaded for --workers
+    code = ('import sys, ne2001.cli; '
+            'print("ne2001.parallel" in sys.modules)')
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b'False'
+
+
+def test_dist_ne(tmp_path):
+    runner = CliRunner()
+    path = str(tmp_path / 'in.npy')
+    np.save(path, np.array([[30., 2, 50], [30, 2, 1e5]]))
+    out = str(tmp_path / 'out.npy')
+    result = runner.invoke(main, ['dist', path, '-o', out, '--workers', '2',
+                                  '--nsamp', '500'])
+    assert result.exit_code == 0, result.output
+    dist = np.load(out)
+    assert dist.shape == (2, 5)
+    assert dist[1, 3] == 100 and dist[1, 4] == 1
+    assert np.isclose(dist[0, 3], density.ElectronDensity().dist_many(
+        30, 2, 50, nsamp=500, quantity=False)[0][0])
+
+    result = runner.invoke(main, ['ne', '--output-format', 'tsv'],
+                           input='x,y,z\n0,8.5,0\n')
+    assert result.output.splitlines() == ['x\ty\tz\tne', '0\t8.5\t0\t0.005']
+
+
+def test_catalog_npy():
+    data = np.arange(15.).reshape(5, 3)
+    fh = io.BytesIO()
+    np.save(fh, data)
+    fh.seek(0)
+    reader = CatalogReader(fh, 'npy', chunk_size=2)
+    assert reader.select(None, ['a', 'b']) == [0, 1]
+    chunks = [values for _, values in reader]
+    assert [len(values) for values in chunks] == [2, 2, 1]
+
+    out = io.BytesIO()
+    writer = CatalogWriter(out, 'npy', names=['a', 'b', 'sum'], nrows=5)
+    for values in chunks:
+        writer.write(None, values, values.sum(axis=1)[:, None])
+    writer.close()
+    out.seek(0)
+    assert np.array_equal(np.load(out), np.column_stack(
+        [data[:, :2], data[:, :2].sum(axis=1)]))
@@ -0,0 +1,79 @@
+""" Tests on the compiled density models """
+
+import numpy as np
+import pytest
+from numpy.random import rand
+from numpy.random import seed
+from numpy.testing import assert_allclose
+
+from ne2001 import compiled
+from ne2001 import density
+from ne2001 import ne_io
+
+PARAMS = ne_io.Params()
+
+
+def random_points(n=20000):
+    "Points in the Galaxy, many of them in the local ISM and at the center"
+    seed(4)
+    xyz = (rand(3, n) - 0.5)*np.array([[30], [30], [4]])
+    xyz[:, :n//4] = (density.XYZ_SUN[:, None] +
+                     (rand(3, n//4) - 0.5)*np.array([[2], [2], [1]]))
+    xyz[:, n//4:n//3] = (rand(3, n//3 - n//4) - 0.5)*0.4
+    return xyz
+
+
+@pytest.mark.parametrize('use_numexpr', [False, True])
+def test_compile(use_numexpr):
+    if use_numexpr:
+        pytest.importorskip('numexpr')
+    ed = density.ElectronDensity()
+    model = ed.compile(use_numexpr=use_numexpr)
+    assert model.fingerprint == ed.fingerprint
+    # Flattened: voids | lhb | loop_in | loop_out | lsb | ldr | disks...
+    assert len(model.root.children) == 2
+    assert len(model.root.children[0].children) == 7
+
+    # Equal to rounding (the operations are in a different order)
+    xyz = random_points()
+    ne = ed.ne(xyz)
+    assert_allclose(model.ne(xyz), ne, rtol=1e-12, atol=1e-14)
+    assert_allclose(model.ne(xyz[:, 0]), ne[0], rtol=1e-12, atol=1e-14)
+    out = np.empty((2, xyz.shape[1]//2))
+    assert model.ne(xyz.reshape(3, 2, -1), out=out) is out
+    assert_allclose(out.ravel(), ne, rtol=1e-12, atol=1e-14)
+    assert model.ne(np.zeros((3, 0))).shape == (0,)
+
+
+def test_compile_zero_amplitude():
+    gc = dict(PARAMS['galactic_center'], e_density=0)
+    ed = density.ElectronDensity(galactic_center=gc)
+    model = compiled.compile_density(ed)
+    disks = model.root.children[0].children[-1]
+    assert len(disks.children) == 3
+    xyz = random_points()
+    assert_allclose(model.ne(xyz), ed.ne(xyz), rtol=1e-12, atol=1e-14)
+
+
+def test_node():
+    # The nodes implement _add
+    with pytest.raises(TypeError):
+        compiled.Node()
+    xyz = random_points(100)
+    ed = density.ElectronDensity()
+    out = np.zeros(xyz.shape[1])
+    compiled.compile_density(ed).root._add(xyz, out)
+    assert_allclose(out, ed.ne(xyz), rtol=1e-12, atol=1e-14)
+
+
+def test_scratch_buffers():
+    ed = density.ElectronDensity()
+    model = ed.compile()
+    xyz = random_points()
+    ne = model.ne(xyz)
+    first = model.root.children[0]
+    buffer = first._local.buffer
+    # Reused by the next calls, smaller or not
+    assert_allclose(model.ne(xyz[:, :100]), ne[:100], rtol=1e-12)
+    assert np.array_equal(model.ne(xyz), ne)
+    assert first._local.buffer is buffer
@@ -0,0 +1,67 @@
+""" Tests on the all-sky DM cube """
+
+import numpy as np
+import pytest
+
+from ne2001 import cube
+from ne2001 import density
+
+
+def test_healpix():
+    for nside in (1, 4, 16):
+        ipix = np.arange(cube.nside2npix(nside))
+        theta, phi = cube.pix2ang(nside, ipix)
+        assert all(cube.ang2pix(nside, theta, phi) == ipix)
+        l, b = cube.pix2lb(nside, ipix)
+        assert all(cube.lb2pix(nside, l, b) == ipix)
+        # The interpolation reproduces the pixel centers
+        ipix_w, weights = cube.interp_weights(nside, theta, phi)
+        assert np.allclose((weights*(ipix_w == ipix)).sum(axis=0), 1)
+
+
+def test_interp_weights():
+    nside = 4
+    theta = np.random.RandomState(2).uniform(0, np.pi, 1000)
+    phi = np.random.RandomState(3).uniform(0, 2*np.pi, 1000)
+    ipix, weights = cube.interp_weights(nside, theta, phi)
+    assert np.allclose(weights.sum(axis=0), 1) and np.all(weights >= 0)
+    # Exact for a field linear in colatitude between the rings
+    theta_pix = cube.pix2ang(nside, np.arange(cube.nside2npix(nside)))[0]
+    inside = (theta > theta_pix.min()) & (theta < theta_pix.max())
+    assert np.allclose((weights*theta_pix[ipix]).sum(axis=0)[inside],
+                       theta[inside])
+
+
+def test_cube(tmpdir):
+    tol = 2e-2
+    ne = density.ElectronDensity()
+    path = str(tmpdir.join('dm_cube.npy'))
+    meta = cube.build_cube(ne, path, nside=1, nd=128, dmin=0.01, dmax=50.)
+    assert meta['fingerprint'] == ne.fingerprint
+
+    dm_cube = cube.DMCube(path, density=ne)
+    assert dm_cube.cube.shape == (12, 129)
+    assert isinstance(dm_cube.cube, np.memmap)
+
+    l, b = cube.pix2lb(1, np.arange(12))
+    d = np.linspace(0.5, 5, 12)
+    DM = dm_cube.DM(l, b, d)
+    DMs = ne.DM_many(l, b, d)
+    assert all(abs(DM - DMs)/DMs < tol)
+
+    dist, beyond = dm_cube.dist(l, b, DM)
+    assert not beyond.any()
+    assert all(abs(dist.value - d)/d < tol)
+    dist, beyond = dm_cube.dist(l[0], b[0], 1e4, quantity=False)
+    assert beyond[0] and np.isclose(dist[0], 50.)
+
+    # Continuous across the pixel boundaries (l = 45 deg in the plane)
+    DM = dm_cube.DM([45 - 1e-6, 45 + 1e-6], 0, 5, quantity=False)
+    assert abs(DM[1] - DM[0]) < 1e-4*DM[0]
+    assert not [name for name in tmpdir.listdir() if name.ext == '.tmp']
+
+    stale = density.ElectronDensity(thick_disk=dict(e_density=0.03,
+                                                    height=1, radius=17))
+    assert dm_cube.is_stale(stale)
+    with pytest.raises(ValueError):
+        cube.DMCube(path, density=stale)
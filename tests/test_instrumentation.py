@@ -0,0 +1,77 @@
+""" Tests on the evaluation counters and timers """
+
+import json
+import warnings
+
+import numpy as np
+from numpy.random import rand
+from numpy.random import seed
+from scipy.integrate import quad
+
+from ne2001 import density
+from ne2001 import instrumentation
+from ne2001.instrumentation import instrument
+
+
+def test_instrument():
+    seed(8)
+    xyz = (rand(3, 2000) - 0.5)*np.array([[40], [40], [4]])
+    ed = density.ElectronDensity()
+    ne = ed.ne(xyz)
+    with instrument() as stats:
+        assert instrumentation.ACTIVE is stats
+        assert np.array_equal(ed.ne(xyz), ne)
+    assert instrumentation.ACTIVE is None
+
+    components = stats.components
+    assert components['ElectronDensity']['calls'] == 1
+    assert components['ElectronDensity']['points'] == xyz.shape[1]
+    assert (components['ElectronDensity']['nonzero'] ==
+            np.count_nonzero(ne > 0))
+    for name in ed.components:
+        assert 0 <= components[name]['self_time'] <= components[name]['time']
+    # Points passed to a component or masked by its combination
+    for name in ('voids', 'clumps'):
+        assert (components[name]['points'] + components[name]['masked'] ==
+                xyz.shape[1])
+    # The smooth components are only evaluated outside the voids
+    smooth = components[ed._smooth.label]
+    assert smooth['masked'] == np.count_nonzero(ed._voids.ne(xyz) > 0)
+    assert ed._smooth.label.startswith('(lism | (thick_disk + thin_disk')
+
+    # Not recorded outside the block
+    ed.ne(xyz)
+    assert components['ElectronDensity']['calls'] == 1
+    assert json.loads(stats.to_json()) == stats.as_dict()
+    assert 'spiral_arms' in stats.report()
+
+
+def test_instrument_DM():
+    ed = density.ElectronDensity(components=['thick_disk', 'thin_disk'])
+    with instrument() as stats:
+        DM = ed.DM(30, 2, 10)
+        ed.DM(30, 2, 10, integrator=np.trapz)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            ed.DM(30, 2, 10, integrator=quad, epsabs=1e-12, epsrel=1e-14,
+                  limit=2)
+        ed.DM(30, 2, 10, integrator='gauss-kronrod')
+        ed.DM(30, 2, 10, breakdown=True)
+    assert DM == ed.DM(30, 2, 10)
+
+    dm_quad, dm_trapz, dm_limit, dm_named, dm_breakdown = stats.DM_calls
+    assert dm_quad['integrator'] == 'quad'
+    assert dm_quad['neval'] == dm_quad['points'] > 0
+    # The breakdown evaluates the components without the model
+    assert (sum(dm['neval'] for dm in stats.DM_calls[:-1]) ==
+            stats.components['ElectronDensity']['calls'])
+    assert not dm_quad['warnings']
+    assert dm_trapz['integrator'] == 'trapz'
+    assert dm_trapz['neval'] == 1
+    assert dm_trapz['points'] == 10001
+    # The warnings are recorded and still raised
+    assert any('IntegrationWarning' in warning
+               for warning in dm_limit['warnings'])
+    assert len(caught) == len(dm_limit['warnings'])
+    assert dm_named['integrator'] == 'gauss-kronrod'
+    assert dm_breakdown['integrator'] == 'breakdown'
@@ -0,0 +1,102 @@
+""" Tests on the sightline integrators """
+
+import warnings
+
+import numpy as np
+import pytest
+from scipy.integrate import IntegrationWarning
+
+from ne2001 import density
+from ne2001 import integrators
+
+
+def integrand(rows, s):
+    return np.exp(-s)*np.cos(3*s)*(rows[:, None] + 1)
+
+
+def test_integrators():
+    a = np.array([0, 0, 1, 0.])
+    b = np.array([0, 1, 5, 50.])
+    exact = (np.arange(1, 5) *
+             (np.exp(-a)*(np.cos(3*a) - 3*np.sin(3*a)) -
+              np.exp(-b)*(np.cos(3*b) - 3*np.sin(3*b)))/10)
+    for name in ('quad', 'trapezoid', 'simpson', 'gauss-legendre',
+                 'gauss-kronrod'):
+        integrate = integrators.get_integrator(name)
+        integral, error = integrate(integrand, a, b, epsrel=1e-8,
+                                    epsabs=1e-10, step_size=0.01,
+                                    block_size=1000)
+        assert integral.shape == error.shape == a.shape
+        assert np.all(np.abs(integral - exact) <= 1.01*error + 1e-12), name
+        assert np.all(error < 1e-4), name
+
+    with pytest.raises(ValueError):
+        integrators.get_integrator('romberg')
+
+    # Too few intervals for the required accuracy
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        integrators.gauss_kronrod(integrand, a, b, epsrel=1e-14, epsabs=0,
+                                  initial=1, limit=2)
+    assert any(issubclass(warning.category, IntegrationWarning)
+               for warning in caught)
+
+    # No more than `limit` intervals per sightline
+    evaluated = []
+
+    def counted(rows, s):
+        evaluated.append(np.bincount(rows, minlength=a.size))
+        return integrand(rows, s)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', IntegrationWarning)
+        integrators.gauss_kronrod(counted, a, b, epsrel=1e-14, epsabs=0,
+                                  initial=4, limit=7, block_size=10**6)
+    # The initial intervals and both halves of each bisection
+    assert np.max(np.sum(evaluated, axis=0)) == 4 + 2*(7 - 4)
+
+    # The error of [0, 1] is accepted against the tolerance of the first
+    # estimate (101), but bisecting [1, 2] brings the integral down to 1
+    calls = []
+    # Null Kronrod integral, error 0.4 on [0, 1] in the first call
+    spread = integrators._WEIGHTS_G7 - integrators._WEIGHTS_K15.dot(
+        integrators._WEIGHTS_G7)/2
+    spread *= 0.8/integrators._WEIGHTS_G7.dot(spread)
+
+    def misleading(rows, s):
+        calls.append(s)
+        if len(calls) > 1:
+            return np.where(s < 1, 1., 0.)
+        return np.where(s < 1, 1 + spread, 100 + 100*spread)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        integral, error = integrators.gauss_kronrod(
+            misleading, 0., 2., epsrel=1e-2, epsabs=0, initial=2)
+    assert len(calls) == 2
+    assert abs(integral - 1) < 1e-12 and abs(error - 0.4) < 1e-12
+    assert any(issubclass(warning.category, IntegrationWarning)
+               for warning in caught)
+
+
+def test_DM_integrate():
+    ne = density.ElectronDensity()
+    l = np.array([-2, 30, 120])
+    b = np.array([12, 2, -5])
+    d = np.array([1, 10, 2.5])
+    DM, error = ne.DM_integrate(l, b, d, epsrel=1e-6, epsabs=0)
+    assert DM.unit == error.unit == density.DM_unit
+    assert DM.shape == error.shape == (3,)
+    assert abs(DM[0].value - 23.98557)/23.98557 < 1e-3
+    assert np.all(error <= 1e-6*DM)
+    for name in ('trapezoid', 'simpson'):
+        DM_name, error = ne.DM_integrate(l, b, d, name, quantity=False)
+        assert np.allclose(DM_name, DM.value, rtol=1e-3)
+
+    assert abs(ne.DM(l[1], b[1], d[1], integrator='gauss-kronrod') -
+               DM[1]) < 1e-3*DM[1]
+    # Arrays of sightlines give arrays, and scalars a scalar
+    DM_named = ne.DM(l, b, d, integrator='gauss-kronrod')
+    assert DM_named.shape == (3,)
+    assert np.allclose(DM_named, DM, rtol=1e-3)
+    assert ne.DM(l[1], b[1], d[1], integrator='simpson').shape == ()
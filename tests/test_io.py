@@ -15,9 +15,18 @@ def test_params():
     # Thick disk
     assert 'thick_disk' in params
     assert 'thin_disk' in params
+    assert ne_io.Params(ifile=None) == {}
+    assert ne_io.Params(ifile=None, a=1) == dict(a=1)
 
 def test_galparam():
     gal_param = ne_io.read_galparam()
     assert isinstance(gal_param, dict)
     assert 'thick_disk' in gal_param
     assert 'thin_disk' in gal_param
+
+
+def test_fingerprint():
+    params = ne_io.Params()
+    assert params.fingerprint() == ne_io.Params().fingerprint()
+    new_params = ne_io.Params(thick_disk=dict(e_density=0.03))
+    assert params.fingerprint() != new_params.fingerprint()
@@ -0,0 +1,65 @@
+""" Tests on the numba backend """
+
+import numpy as np
+import pytest
+from numpy.random import rand
+from numpy.random import seed
+
+from ne2001 import density
+from ne2001 import kernels
+from ne2001.integrators import trapezoid_rule
+
+
+def random_points(n=20000):
+    "Points in the Galaxy, many of them in the local ISM and at the center"
+    seed(5)
+    xyz = (rand(3, n) - 0.5)*np.array([[40], [40], [4]])
+    xyz[:, :n//4] = (density.XYZ_SUN[:, None] +
+                     (rand(3, n//4) - 0.5)*np.array([[2], [2], [1]]))
+    xyz[:, n//4:n//3] = (rand(3, n//3 - n//4) - 0.5)*0.4
+    return xyz
+
+
+def test_numba_backend():
+    pytest.importorskip('numba')
+    ed = density.ElectronDensity()
+    ed_numba = density.ElectronDensity(backend='numba')
+    assert ed_numba.backend == 'numba'
+
+    xyz = random_points()
+    ne = ed.ne(xyz)
+    ne_numba = ed_numba.ne(xyz)
+    assert np.allclose(ne_numba, ne, rtol=1e-12, atol=1e-14)
+    for component in ('voids', 'lism', 'clumps', 'spiral_arms',
+                      'galactic_center'):
+        assert np.any(ed.components[component].ne(xyz) > 0)
+    assert np.isclose(ed_numba.ne(xyz[:, 0]), ne[0], rtol=1e-12)
+    assert ed_numba.ne(xyz.reshape(3, 2, -1)).shape == (2, xyz.shape[1]//2)
+
+    DM = ed.DM(30, 2, 5, integrator=trapezoid_rule)
+    assert np.isclose(ed_numba.DM(30, 2, 5, integrator=trapezoid_rule),
+                      DM, rtol=1e-12)
+
+    # The arm lookup table and the subsets of the components are
+    # evaluated with numpy, with a warning
+    with pytest.warns(UserWarning):
+        ed_numba.use_arm_grid(cache=False)
+    assert ed_numba._kernel is None
+    assert np.allclose(ed_numba.ne(xyz), ed_numba._combined.ne(xyz))
+    ed_numba.use_exact_arms()
+    assert ed_numba._kernel is not None
+    with pytest.warns(UserWarning):
+        subset = density.ElectronDensity(backend='numba',
+                                         components=['thick_disk', 'voids'])
+    assert subset.backend == 'numba' and subset._kernel is None
+    assert np.array_equal(subset.ne(xyz), density.ElectronDensity(
+        components=['thick_disk', 'voids']).ne(xyz))
+
+
+def test_numba_missing(monkeypatch):
+    monkeypatch.setattr(kernels, 'numba', None)
+    with pytest.warns(UserWarning):
+        ed = density.ElectronDensity(backend='numba')
+    assert ed.backend == 'numpy'
+    with pytest.raises(ValueError):
+        density.ElectronDensity(backend='fortran')
@@ -8,11 +8,13 @@ from numpy.random import rand
 from numpy.random import randint
 from numpy.random import seed
 from scipy import integrate
+from scipy import interpolate
 
 from ne2001 import density
 from ne2001 import ne_io
 from ne2001 import utils
 from ne2001.cli import main
+from ne2001.integrators import trapezoid_rule
 
 PARAMS = ne_io.Params()
 density.set_xyz_sun(np.array([0, 8.5, 0]))
@@ -20,9 +22,9 @@ density.set_xyz_sun(np.array([0, 8.5, 0]))
 
 def test_main():
     runner = CliRunner()
-    result = runner.invoke(main, [])
+    result = runner.invoke(main, ['--help'])
 
-    assert result.output == '()\n'
+    assert 'serve' in result.output
     assert result.exit_code == 0
 
 
@@ -141,7 +143,7 @@ def test_electron_density_trapz():
     ne = density.ElectronDensity()
     l, b, d = -2, 12, 1
     DM = 23.98557
-    assert abs(ne.DM(l, b, d, integrator=integrate.trapz).value - DM)/DM < tol
+    assert abs(ne.DM(l, b, d, integrator=trapezoid_rule).value - DM)/DM < tol
 
 
 def test_dist():
@@ -157,3 +159,335 @@ def test_dist():
         err = abs(d_DM.value - d)/d
         print(err, l, b, d, d_DM)
         assert err < tol, (l, b, d)
+
+    # Smooth sightline: the DM at the distance is the DM
+    disk = density.ElectronDensity(components=['thick_disk', 'thin_disk'])
+    d_DM = disk.dist(30, 2, 100, tol=1e-6)
+    DM, _ = disk.DM_integrate(30, 2, d_DM, epsrel=1e-9, epsabs=0)
+    assert abs(DM[0].value - 100) < 1e-4
+    assert disk.dist(30, 2, 0) == 0
+    with pytest.warns(UserWarning):
+        assert disk.dist(30, 2, 1e5, dmax=50).value == 50
+    # Deprecated step_size, positional or by keyword
+    for d_old in (lambda: disk.dist(30, 2, 100, 0.5),
+                  lambda: disk.dist(30, 2, 100, step_size=0.5)):
+        with pytest.warns(DeprecationWarning):
+            assert abs(d_old() - d_DM) < 1e-3*d_DM
+
+
+def test_DM_many():
+    tol = 1e-6
+    ne = density.ElectronDensity()
+    l = np.array([-2, 10, 120])
+    b = np.array([12, 30, -5])
+    d = np.array([1, 0.5, 2.5])
+    DMs = ne.DM_many(l, b, d, block_size=1)
+    assert DMs.unit == density.DM_unit
+    assert DMs.shape == (3,)
+    for li, bi, di, DMi in zip(l, b, d, DMs):
+        DM = ne.DM(li, bi, di, integrator=trapezoid_rule)
+        assert abs(DMi - DM)/DM < tol
+
+    DMs = ne.DM_many(l, b, d, quantity=False)
+    assert isinstance(DMs, np.ndarray)
+    assert not hasattr(DMs, 'unit')
+    assert abs(DMs[0] - 23.98557)/23.98557 < 1e-3
+
+
+def test_integrals():
+    tol = 1e-6
+    ne = density.ElectronDensity()
+    l = np.array([-2, 30, 120])
+    b = np.array([12, 2, -5])
+    d = np.array([1, 10, 2.5])
+    res = ne.integrals_many(l, b, d, nu=0.5, block_size=1)
+    assert res.DM.unit == density.DM_unit
+    assert res.tau.unit == density.tau_unit
+    assert np.allclose(res.DM, ne.DM_many(l, b, d, block_size=1), rtol=tol)
+    assert np.all(res.SM_tau > 0)
+    for i in range(3):
+        scalar = ne.integrals(l[i], b[i], d[i], nu=0.5, quantity=False)
+        assert np.allclose(scalar, [val[i].value for val in res], rtol=tol)
+    assert np.allclose(res.tau.value,
+                       1000*(res.SM_tau.value/292)**1.2*d*0.5**-4.4)
+    assert np.allclose(res.scint_bw.value, 1.16/(2*np.pi*res.tau.value))
+
+    # The density and F ne**2 are those of ne
+    seed(3)
+    xyz = (rand(3, 2000) - 0.5)*np.array([[40], [40], [4]])
+    ne_xyz, fne2 = ne.ne_F(xyz)
+    assert np.allclose(ne_xyz, ne.ne(xyz))
+    assert np.all(fne2 >= 0)
+
+    # One component: SM is proportional to EM
+    disk = density.ElectronDensity(components=['thick_disk'])
+    res = disk.integrals_many(l, b, d, quantity=False)
+    F = disk.params['thick_disk']['F']
+    assert np.allclose(res.SM, density.SM_FACTOR*F*res.EM/1000, rtol=tol)
+    x = np.linspace(0, 1, 1001)
+    ne_s = disk.ne(utils.galactic_to_galactocentric(l[0], b[0], x*d[0],
+                                                    density.XYZ_SUN))
+    EM = trapezoid_rule(ne_s**2, x)*d[0]*1000
+    assert abs(res.EM[0] - EM)/EM < tol
+
+
+def test_DM_breakdown():
+    ne = density.ElectronDensity()
+    # Through the Gum nebula void, towards the Galactic center, off-plane
+    l = np.array([-81.5, 30, 120])
+    b = np.array([-0.6, 2, -5])
+    d = np.array([1, 10, 2.5])
+    DM = ne.DM(l, b, d, breakdown=True)
+    assert set(DM) == set(ne.components) | {'total'}
+    assert DM['total'].unit == density.DM_unit
+    assert np.allclose(DM['total'], ne.DM_many(l, b, d))
+    assert np.allclose(sum(DM[name] for name in ne.components),
+                       DM['total'])
+    # The clumps are added, the thin disk is masked by the voids and the
+    # local ISM
+    assert np.allclose(DM['clumps'], ne._clumps.DM_many(l, b, d))
+    thin_disk = ne._thin_disk.DM_many(l, b, d)
+    assert np.all(DM['thin_disk'] < thin_disk)
+
+    DM = ne.DM(-81.5, -0.6, 1, breakdown=True, quantity=False)
+    assert np.ndim(DM['voids']) == 0
+    assert DM['voids'] > 0
+    with pytest.raises(ValueError):
+        ne.DM(l, b, d, breakdown=True, integrator=integrate.quad)
+    # DM's positional and tolerance options do not apply
+    with pytest.raises(TypeError):
+        ne.DM(l, b, d, 1e-4, breakdown=True)
+    with pytest.raises(TypeError):
+        ne.DM(l, b, d, breakdown=True, epsrel=1e-4)
+
+
+def test_dist_many():
+    tol = 1e-2
+    ne = density.ElectronDensity()
+    l = np.array([-2, 10, 120])
+    b = np.array([12, 30, -5])
+    d = np.array([1, 0.5, 2.5])
+    DM = ne.DM_many(l, b, d)
+    dist, beyond = ne.dist_many(l, b, DM)
+    assert dist.unit == density.d_unit
+    assert not beyond.any()
+    assert all(abs(dist.value - d)/d < tol)
+
+    dist, beyond = ne.dist_many([-2, -2], [12, 12], [20, 1e4],
+                                quantity=False)
+    assert list(beyond) == [False, True]
+    assert dist[1] == 100.
+
+
+def test_cache():
+    tol = 1e-3
+    ne = density.ElectronDensity()
+    cache = ne.enable_cache(maxsize=2)
+    l, b, d = -2, 12, 1
+    DM = 23.98557
+    assert abs(ne.DM(l, b, d).value - DM)/DM < tol
+    assert abs(ne.DM(l + 1e-3, b, [0.5, d]).value[-1] - DM)/DM < tol
+    assert abs(ne.dist(l, b, DM).value - d)/d < tol
+    info = ne.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (2, 1, 1)
+
+    ne.DM(l, b, 2)
+    assert ne.cache_info().extensions == 1
+    ne.DM(10, 30, 1)
+    ne.DM(20, 30, 1)
+    info = ne.cache_info()
+    assert (info.evictions, info.currsize) == (1, 2)
+    assert cache.key(l, b) not in cache._profiles
+
+    # Bounded by the total number of samples
+    cache = ne.enable_cache(max_samples=3000)
+    ne.DM(10, 30, 1)
+    ne.DM(20, 30, 2)
+    info = ne.cache_info()
+    assert (info.evictions, info.currsize) == (1, 1)
+    assert info.nbytes <= 8*3000
+
+    # Switching the spiral arms drops the cached profiles
+    DM = ne.DM(30, 0, 5)
+    grid = ne.use_arm_grid(step=1., cache=False)
+    assert ne.cache_info().currsize == 0
+    DM_grid = ne.DM(30, 0, 5)
+    assert DM_grid != DM
+    assert np.isclose(DM_grid, ne.DM_many(30, 0, 5)[0], rtol=tol)
+    ne.use_exact_arms()
+    assert ne.DM(30, 0, 5) == DM
+    del grid
+
+    # Arrays of sightlines, and distances beyond dmax
+    cache = ne.enable_cache(dmax=5.)
+    l = np.array([[30, 30.001], [60, 90]])
+    DM = ne.DM(l, 2, [1, 2]).value
+    assert DM.shape == (2, 2)
+    assert ne.cache_info().currsize == 3
+    assert DM[0, 0] == ne.DM(30, 2, 1).value
+    assert np.isclose(DM[1, 1], ne.DM(90, 2, 2).value)
+    assert np.allclose(ne.dist(l, 2, DM).value, [1, 2], rtol=tol)
+    with pytest.warns(UserWarning):
+        DM = ne.DM([30, 60], 2, [1, 6]).value
+    assert np.isfinite(DM[0]) and np.isnan(DM[1])
+    with pytest.warns(UserWarning):
+        assert ne.dist(30, 2, 1e4).value == 5
+
+    ne.disable_cache()
+    assert ne.cache_info() is None
+
+
+def test_arm_search():
+    tol = 1e-3
+    adict = PARAMS['spiral_arms']['adict']
+    search = adict['search']
+    x, y = (1 - 2*rand(2, 200)) * 15
+    for j in range(adict['narms']):
+        # Brute force on a dense sampling of the arm spline
+        kmax = adict['kmax'][j]
+        arm = adict['arm'][j, :kmax]
+        k = np.linspace(0, kmax, 20*kmax)
+        xy_arm = interpolate.CubicSpline(np.arange(kmax), arm)(k)
+        smin = np.sqrt(np.min((x[:, None] - xy_arm[:, 0])**2 +
+                              (y[:, None] - xy_arm[:, 1])**2, axis=1))
+        smin_search = search.distance(j, x, y)
+        assert all(smin_search <= smin + 1e-12)
+        # The search is restricted to the neighbourhood of the
+        # nearest arm point
+        close = smin < 3
+        assert np.allclose(smin_search[close], smin[close], atol=tol)
+
+
+def test_arm_grid(tmpdir, monkeypatch):
+    monkeypatch.setenv('NE2001_CACHE_DIR', str(tmpdir))
+    ne = density.ElectronDensity()
+    arms = density.NEobject(density.ne_spiral_arm,
+                            **PARAMS['spiral_arms'])
+    grid = ne.use_arm_grid(step=0.1, extent=6.)
+    assert grid.weight.shape == (5, 121, 121)
+    assert 0 < grid.max_rel_error < 0.1
+    assert len(tmpdir.listdir()) == 1
+
+    xyz = (1 - 2*rand(3, 100)) * np.array([[8], [8], [0.5]])
+    ne_arms = arms.ne(xyz)
+    ne_grid = ne._spiral_arms.ne(xyz)
+    outside = np.any(np.abs(xyz[:2]) > 6, axis=0)
+    assert np.allclose(ne_grid[outside], ne_arms[outside])
+    assert np.allclose(ne_grid, ne_arms,
+                       atol=2*grid.max_error*PARAMS['spiral_arms']['e_density'])
+
+    # From the cache
+    grid_cached = ne.use_arm_grid(step=0.1, extent=6.)
+    assert np.all(grid_cached.weight == grid.weight)
+    ne.use_exact_arms()
+    assert np.all(ne._spiral_arms.ne(xyz) == ne_arms)
+
+
+def test_objects_index():
+    for objects in (density.Clumps(), density.Voids()):
+        xyz = (objects.xyz.T[randint(0, objects.gl.size, 1000)].T +
+               (1-2*rand(3, 1000))*0.3)
+        ne_dense = (objects._factor(xyz)*objects.ne0).sum(axis=-1)
+        assert np.allclose(objects.ne(xyz), ne_dense, rtol=1e-12, atol=0)
+        assert objects.ne(xyz.reshape(3, 10, 100)).shape == (10, 100)
+        assert all(objects.ne(np.zeros((3, 0))) == [])
+
+
+def test_analytic_objects():
+    ed = density.ElectronDensity()
+    step = 1e-4
+    for objects, j in ((ed._clumps, 50), (ed._voids, 0)):
+        l, b, d = objects.gl[j], objects.gb[j], 1.5*objects.distance[j]
+        DM, s1, s2, index = objects.sightline(l, b, d)
+        assert j in index
+        assert all((s1 >= 0) & (s1 < s2) & (s2 <= d))
+        DM_analytic = ed.DM(l, b, d, analytic_objects=True,
+                            integrator=trapezoid_rule, step_size=step)
+        DM_fine = ed.DM(l, b, d, integrator=trapezoid_rule, step_size=step)
+        # Edges of uniform voids are resolved to one step
+        assert np.isclose(DM_analytic.value, DM_fine.value, rtol=1e-4,
+                          atol=2*step*objects.ne0[j]*1000)
+
+
+def test_intervals():
+    ed = density.ElectronDensity()
+    seed(2)
+    for obj in (ed._galactic_center, ed._lism.lhb, ed._lism.ldr, ed._voids):
+        lo, hi = obj.bounds()
+        xyz = ((lo + hi)/2 + (hi - lo)*(rand(10000, 3) - 0.5)*2).T
+        outside = np.any((xyz.T < lo) | (xyz.T > hi), axis=1)
+        assert outside.any() and all(obj.ne(xyz[:, outside]) == 0)
+    assert ed.bounds() is None
+    assert np.allclose(ed._galactic_center.intervals(0, 0, 10),
+                       [[8.355, 8.645]])
+
+    l, b, d = ed._clumps.gl[50], ed._clumps.gb[50], ed._clumps.distance[50]
+    DM_fine = ed.DM(l, b, d, integrator=trapezoid_rule, step_size=1e-4)
+    assert np.isclose(ed.DM(l, b, d, intervals=True).value, DM_fine.value,
+                      rtol=1e-3)
+    assert np.isclose(ed.DM(l, b, d, intervals=True,
+                            integrator=trapezoid_rule,
+                            step_size=1e-4).value,
+                      DM_fine.value, rtol=1e-4)
+
+
+def test_lazy_combinators():
+    ed = density.ElectronDensity()
+    seed(3)
+    xyz = (rand(3, 20000) - 0.5)*np.array([[30], [30], [4]])
+    xyz[:, :5000] = (density.XYZ_SUN[:, None] +
+                     (rand(3, 5000) - 0.5)*np.array([[2], [2], [1]]))
+    comp = ed.components
+    ne = {name: obj.ne(xyz) for name, obj in comp.items()}
+    smooth = (ne['thick_disk'] + ne['thin_disk'] + ne['spiral_arms'] +
+              ne['galactic_center'])
+    ne_eager = (np.where(ne['voids'] > 0, ne['voids'],
+                         np.where(ne['lism'] > 0, ne['lism'], smooth)) +
+                ne['clumps'])
+
+    ed.reset_npoints()
+    assert np.allclose(ed.ne(xyz), ne_eager, rtol=1e-12, atol=0)
+    assert ed.ne(xyz[:, 0]) == ne_eager[0]
+    # (3, 1) and (3, 3) arrays are not mistaken for single points
+    for n in (1, 3):
+        assert np.allclose(ed.ne(xyz[:, :n]), ne_eager[:n], rtol=1e-12)
+    npoints = ed.npoints_by_component()
+    assert ed.npoints == 20005
+    # The right operands are only evaluated where the left ones are zero
+    assert npoints['lism'] <= np.sum(ne['voids'] <= 0)
+    assert npoints['thin_disk'] <= np.sum((ne['voids'] <= 0) &
+                                          (ne['lism'] <= 0)) + 1
+    # Objects are only evaluated within their bounds
+    assert npoints['galactic_center'] < npoints['clumps'] < 20005
+    assert all(ed.ne(np.zeros((3, 0))) == [])
+
+
+def test_ne_many(tmpdir):
+    ed = density.ElectronDensity()
+    seed(6)
+    xyz = (rand(3, 40, 50) - 0.5)*np.array([[[30]], [[30]], [[2]]])
+    ne = ed.ne(xyz)
+    assert np.allclose(ed.ne_many(xyz, block_size=64), ne, rtol=1e-12)
+    out = np.empty((40, 50))
+    npoints = ed.npoints
+    assert ed.ne_many(xyz, out=out, max_memory=100*density.BYTES_PER_POINT,
+                      workers=4) is out
+    assert np.allclose(out, ne, rtol=1e-12)
+    # No count lost by the threads
+    assert ed.npoints - npoints == out.size
+    ed.reset_npoints()
+    ed.ne_many(xyz, block_size=64)
+    serial = ed.npoints_by_component()
+    ed.reset_npoints()
+    ed.ne_many(xyz, block_size=64, workers=4)
+    assert ed.npoints_by_component() == serial
+    # Memory mapped input, single precision
+    path = str(tmpdir.join('xyz.npy'))
+    np.save(path, xyz)
+    ne32 = ed.ne_many(np.load(path, mmap_mode='r'), block_size=500,
+                      dtype=np.float32)
+    # Computed in float64, stored in float32
+    assert ne32.dtype == np.float32
+    assert np.array_equal(ne32, ne.astype(np.float32))
+    with pytest.raises(ValueError):
+        ed.ne_many(xyz, out=np.empty(2000))
@@ -0,0 +1,58 @@
+""" Tests on the octree density cache """
+
+import numpy as np
+import pytest
+from numpy.random import rand
+
+from ne2001 import density
+from ne2001 import ne_io
+from ne2001 import octree
+
+PARAMS = ne_io.Params()
+
+
+def test_octree(tmpdir):
+    rtol = 1e-2
+    disk = density.NEobject(density.thick_disk, **PARAMS['thick_disk'])
+    tree = octree.DensityOctree.build(disk, center=(0, 8.5, 0), size=4.,
+                                      rtol=rtol, min_depth=1, max_depth=6)
+    assert tree.nleaves < tree.nnodes
+    assert tree.meta['max_error'] < rtol
+
+    xyz = np.array([0, 8.5, 0]) + (1 - 2*rand(100, 3))*1.9
+    ne_tree = tree.ne(xyz.T)
+    ne_disk = disk.ne(xyz.T)
+    assert np.allclose(ne_tree, ne_disk, rtol=2*rtol)
+    assert np.isclose(tree.ne(xyz[0]), ne_disk[0], rtol=2*rtol)
+
+    # Outside the box
+    xyz_out = np.array([[0, 0, 0], [0, 8.5, 0]]).T
+    assert tree.ne(xyz_out)[0] == disk.ne(xyz_out)[0]
+
+    # Any shape (3, ...)
+    grid = xyz.T.reshape(3, 4, 25)
+    assert np.array_equal(tree.ne(grid), ne_tree.reshape(4, 25))
+
+    # Only saved with a fingerprint of the model
+    path = str(tmpdir.join('octree.npz'))
+    with pytest.raises(ValueError):
+        tree.save(path)
+    disk = density.ElectronDensity(components=['thick_disk'])
+    tree = octree.DensityOctree.build(disk, center=(0, 8.5, 0), size=4.,
+                                      rtol=rtol, min_depth=1, max_depth=6)
+    ne_tree = tree.ne(xyz.T)
+    tree.save(path)
+    tree = octree.DensityOctree.load(path, density=disk)
+    assert np.allclose(tree.ne(xyz.T), ne_tree)
+    assert tree.fallback is disk
+    with pytest.raises(ValueError):
+        octree.DensityOctree.load(path, density=density.NEobject(
+            density.thick_disk, **PARAMS['thick_disk']))
+
+    ne = density.ElectronDensity()
+    tree = octree.DensityOctree.build(ne, size=40., min_depth=1,
+                                      max_depth=1)
+    tree.save(path)
+    assert octree.DensityOctree.load(path, density=ne).nnodes == 9
+    with pytest.raises(ValueError):
+        octree.DensityOctree.load(path, density=disk)
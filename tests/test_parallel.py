@@ -0,0 +1,80 @@
+""" Tests on the process-pool executor """
+
+import numpy as np
+from numpy.random import rand
+from numpy.random import seed
+
+from ne2001 import density
+from ne2001 import parallel
+
+
+def test_model_state():
+    ed = density.ElectronDensity()
+    seed(3)
+    xyz = (rand(3, 5000) - 0.5)*np.array([[40], [40], [4]])
+    with parallel.SharedState(parallel.model_state(ed)) as shared:
+        shm, state = parallel.attach(shared.spec)
+        model = parallel.model_from_state(state)
+        assert model.fingerprint == ed.fingerprint
+        assert np.shares_memory(model._voids.rotation,
+                                state['voids']['rotation'])
+        assert np.array_equal(model.ne(xyz), ed.ne(xyz))
+        del model, state
+        shm.close()
+
+
+def test_model_state_pickled(monkeypatch):
+    # Without multiprocessing.shared_memory
+    monkeypatch.setattr(parallel, 'shared_memory', None)
+    ed = density.ElectronDensity(components=['thick_disk', 'thin_disk'])
+    with parallel.SharedState(parallel.model_state(ed)) as shared:
+        shm, state = parallel.attach(shared.spec)
+        assert shm is None
+        model = parallel.model_from_state(state)
+        assert model.fingerprint == ed.fingerprint
+        assert model.DM(30, 2, 10) == ed.DM(30, 2, 10)
+
+
+def test_objects_table():
+    clumps = density.Clumps()
+    from_table = density.Clumps(clumps._data.as_array())
+    assert from_table._file is None
+    assert np.array_equal(from_table.xyz, clumps.xyz)
+    assert from_table.digest() == density.Clumps(clumps._data).digest()
+
+
+def test_map_DM():
+    ed = density.ElectronDensity()
+    seed(4)
+    l = rand(30)*360
+    b = (rand(30) - 0.5)*60
+    d = rand(30)*15
+    d[3] = 0
+    DM = ed.DM_many(l, b, d, nsamp=1000)
+    assert np.array_equal(ed.map_DM(l, b, d, workers=2, nsamp=1000), DM)
+    assert ed.map_DM([], [], [], workers=2).shape == (0,)
+
+
+def test_pool_shapes():
+    ed = density.ElectronDensity(components=['thick_disk', 'thin_disk'])
+    seed(5)
+    l = rand(3, 4)*360
+    b = (rand(3, 4) - 0.5)*60
+    DM_in = rand(3, 4)*200
+    with parallel.ModelPool(ed, workers=2) as pool:
+        dist, beyond = pool.dist(l, b, DM_in, quantity=False, nsamp=1000)
+        assert dist.shape == beyond.shape == (3, 4)
+        ref, ref_beyond = ed.dist_many(l.ravel(), b.ravel(), DM_in.ravel(),
+                                       nsamp=1000, quantity=False)
+        assert np.array_equal(dist.ravel(), ref)
+        assert np.array_equal(beyond.ravel(), ref_beyond)
+        DM = pool.DM(l, b, dist, quantity=False, nsamp=1000)
+        assert DM.shape == (3, 4)
+
+
+def test_batches():
+    d = np.array([1., 5., 0., 3., 3.])
+    batches = parallel._batches(d, 3)
+    assert np.array_equal(np.sort(np.concatenate(batches)), np.arange(5))
+    assert batches[0][0] == 1
+    assert len(parallel._batches(np.zeros(4), 8)) == 4
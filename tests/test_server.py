@@ -0,0 +1,84 @@
+""" Tests on the model server """
+
+import asyncio
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from ne2001 import density
+from ne2001 import server
+
+
+def test_batching():
+    model = density.ElectronDensity()
+    l = np.array([10., 30., 200.])
+    b = np.array([1., -2., 5.])
+    d = np.array([1., 5., 2.])
+
+    async def run():
+        srv = server.ModelServer(model, window=0.05)
+        requests = [dict(id=i, op='DM', l=l[i], b=b[i], d=d[i], nsamp=500)
+                    for i in range(3)]
+        requests.append(dict(id=3, op='ne', x=[0, 1], y=[8.5, 8], z=0))
+        requests.append(dict(id=4, op='dist', l=30, b=-2, DM=[10, 1e5],
+                             nsamp=500))
+        responses = await asyncio.gather(*[srv.handle(request)
+                                           for request in requests])
+        return srv, responses
+
+    srv, responses = asyncio.run(run())
+    assert [response['id'] for response in responses] == list(range(5))
+    DM = np.concatenate([response['result'] for response in responses[:3]])
+    assert np.allclose(DM, model.DM_many(l, b, d, nsamp=500,
+                                         quantity=False))
+    assert np.allclose(responses[3]['result'],
+                       model.ne(np.array([[0, 1], [8.5, 8], [0, 0]])))
+    assert responses[4]['result'][1] == [False, True]
+
+    metrics = srv.metrics.summary()
+    assert metrics['requests'] == dict(DM=3, ne=1, dist=1)
+    assert metrics['batches'] == 3
+    assert metrics['batch_size']['max'] == 3
+
+    response = asyncio.run(srv.handle(dict(id=5, op='DM', l=1)))
+    assert 'Missing argument' in response['error']
+    assert srv.metrics.errors == 1
+
+
+def test_serve(tmp_path):
+    path = str(tmp_path / 'ne2001.sock')
+    ready = threading.Event()
+    thread = threading.Thread(target=server.serve, daemon=True,
+                              kwargs=dict(path=path,
+                                          ready=lambda _: ready.set()))
+    thread.start()
+    assert ready.wait(60)
+
+    with server.Client(path, timeout=60) as client:
+        assert client.call('ping') == 'pong'
+        DM = client.call('DM', l=[30, 40], b=2, d=5, nsamp=500)
+        fingerprint = client.call('reload')
+        assert fingerprint == density.ElectronDensity().fingerprint
+        assert client.call('DM', l=[30, 40], b=2, d=5, nsamp=500) == DM
+        assert client.call('reload', params=dict(
+            thick_disk=dict(e_density=0.04, height=0.97, radius=17.5,
+                            F=0.18))) != fingerprint
+        assert client.call('DM', l=[30, 40], b=2, d=5,
+                           nsamp=500)[0] > DM[0]
+        assert client.call('metrics')['requests']['DM'] == 3
+        with pytest.raises(server.RequestError):
+            client.call('DM_many')
+        # Invalid or too expensive options
+        for options in (dict(step_size=0), dict(step_size='1'),
+                        dict(nsamp=0.5), dict(nsamp=True),
+                        dict(step_size=1e-9), dict(nsamp=10**8)):
+            with pytest.raises(server.RequestError):
+                client.call('DM', l=30, b=2, d=5, **options)
+        with pytest.raises(server.RequestError):
+            client.call('dist', l=30, b=2, DM=50, dmax=1e6)
+        assert client.call('dist', l=30, b=2, DM=50, nsamp=500.)
+
+        client.sock.sendall(b'not json\n')
+        assert 'error' in json.loads(client._file.readline())
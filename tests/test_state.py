@@ -0,0 +1,106 @@
+""" Tests on the model state and the compiled model cache """
+
+import os
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from numpy.random import rand
+from numpy.random import seed
+
+from ne2001 import density
+from ne2001 import state
+
+
+def test_load_model(tmp_path, monkeypatch):
+    monkeypatch.setenv('NE2001_CACHE_DIR', str(tmp_path))
+    seed(6)
+    xyz = (rand(3, 5000) - 0.5)*np.array([[40], [40], [4]])
+    ed = density.ElectronDensity()
+
+    model = state.load_model()
+    assert len(os.listdir(str(tmp_path))) == 1
+    # No table parsing once compiled
+    monkeypatch.setattr(Table, 'read', None)
+    model = state.load_model()
+    assert model.fingerprint == ed.fingerprint
+    assert np.array_equal(model.ne(xyz), ed.ne(xyz))
+
+    # Other components are compiled again (reading the clumps file)
+    with pytest.raises(TypeError):
+        state.load_model(components=['thick_disk', 'clumps'])
+    assert (state.model_key(components=['thick_disk']) !=
+            state.model_key(thick_disk=dict(ed.params['thick_disk'],
+                                            e_density=0.04)) !=
+            state.model_key())
+    # Parameters without a parameters file
+    params = dict(ed.params)
+    assert (state.model_key(ifile=None, **params) !=
+            state.model_key(ifile=None, **dict(params, thick_disk=dict(
+                params['thick_disk'], e_density=0.04))))
+
+    # A corrupt file is rebuilt
+    monkeypatch.undo()
+    monkeypatch.setenv('NE2001_CACHE_DIR', str(tmp_path))
+    path = str(tmp_path / os.listdir(str(tmp_path))[0])
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    with open(path, 'wb') as fh:
+        fh.write(data[:len(data)//2])
+    assert state.load_model().fingerprint == ed.fingerprint
+    assert os.path.getsize(path) == len(data)
+
+
+def test_save_state(tmp_path):
+    ed = density.ElectronDensity(components=['thin_disk', 'voids'])
+    path = str(tmp_path / 'model.npz')
+    state.save_state(path, state.model_state(ed))
+    model = state.model_from_state(state.load_state(path))
+    assert list(model.components) == ['thin_disk', 'voids']
+    xyz = (rand(3, 1000) - 0.5)*20
+    assert np.array_equal(model.ne(xyz), ed.ne(xyz))
+
+
+def test_components():
+    seed(7)
+    xyz = (rand(3, 5000) - 0.5)*np.array([[40], [40], [4]])
+    ed = density.ElectronDensity()
+    subset = density.ElectronDensity(components=['lism', 'thick_disk',
+                                                 'clumps'])
+    assert subset._spiral_arms is None
+    assert 'adict' not in subset.params['spiral_arms']
+    assert subset.fingerprint != ed.fingerprint
+    assert np.array_equal(
+        subset.ne(xyz), ((ed._lism | ed._thick_disk) + ed._clumps).ne(xyz))
+    with pytest.raises(ValueError):
+        subset.use_arm_grid()
+    with pytest.raises(ValueError):
+        density.ElectronDensity(components=['halo'])
+
+
+def test_registry(tmp_path, monkeypatch):
+    monkeypatch.setenv('NE2001_CACHE_DIR', str(tmp_path))
+    state.REGISTRY.clear()
+    ed = density.ElectronDensity.get()
+    # Built through the compiled model cache
+    assert len(list(tmp_path.glob('model_*.npz'))) == 1
+    assert density.ElectronDensity.get() is ed
+    assert density.ElectronDensity.get(backend='numba') is not ed
+    thick_disk = dict(ed.params['thick_disk'], e_density=0.04)
+    other = density.ElectronDensity.get(thick_disk=thick_disk)
+    assert other is not ed
+    assert other.params['thick_disk']['e_density'] == 0.04
+    assert state.REGISTRY.info()[:2] == (1, 3)
+    with pytest.raises(ValueError):
+        ed.enable_cache()
+
+    assert density.ElectronDensity.invalidate()
+    assert not density.ElectronDensity.invalidate()
+    assert density.ElectronDensity.get() is not ed
+    # The state does not depend on the backend
+    assert len(list(tmp_path.glob('model_*.npz'))) == 2
+
+    registry = state.ModelRegistry(maxsize=1)
+    registry.get(components=['thick_disk'])
+    registry.get(components=['thin_disk'])
+    assert registry.info().evictions == 1
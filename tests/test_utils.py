@@ -63,3 +63,22 @@ def test_parse_DM():
         DM = utils.parse_DM('abc')
     with pytest.raises(IOError):
         DM = utils.parse_DM(1*u.s)
+
+
+def test_intervals():
+    """ Ray-box intersection and union of intervals """
+    lo, hi = np.array([1., -1, -1]), np.array([2., 1, 1])
+    assert np.allclose(utils.ray_box([0, 0, 0], [1, 0, 0], lo, hi, 10),
+                       (1, 2))
+    assert np.allclose(utils.ray_box([0, 0, 0], [1, 0, 0], lo, hi, 1.5),
+                       (1, 1.5))
+    assert utils.ray_box([0, 0, 0], [0, 1, 0], lo, hi, 10) is None
+    assert utils.ray_box([0, 0, 0], [1, 0, 0], lo, hi, 0.5) is None
+    # Unbounded along z
+    lo[-1], hi[-1] = -np.inf, np.inf
+    assert np.allclose(utils.ray_box([0, 0, 5], [1, 0, 0], lo, hi, 10),
+                       (1, 2))
+
+    union = utils.union_intervals([[3, 4], [0, 1], [0.5, 2], [1.5, 1.8]])
+    assert np.allclose(union, [[0, 2], [3, 4]])
+    assert utils.union_intervals([]).shape == (0, 2)